@@ -0,0 +1,291 @@
+import asyncio
+import logging
+import subprocess
+import threading
+from types import TracebackType
+from typing import Any, Callable, Dict, List, Optional, TextIO, Tuple, Type
+
+from bampkgbuild import docker as _docker
+from bampkgbuild.docker import docker, docker_container
+
+logger = logging.getLogger(__name__)
+
+# Output is read this much at a time, and split into lines here, so a line
+# can be any length.
+CHUNK_SIZE = 64 * 1024
+
+# Called with the stream name ("stdout" or "stderr") and one line of output.
+Sink = Callable[[str, str], None]
+
+
+class log_sink:
+    # Sends output to the log with a prefix, and to a file if given one.
+    def __init__(self, prefix: str, output: Optional[TextIO] = None) -> None:
+        self.prefix = prefix
+        self.output = output
+
+    def __call__(self, stream: str, line: str) -> None:
+        if self.output is not None:
+            self.output.write(line + "\n")
+            self.output.flush()
+        if stream == "stderr":
+            logger.warning("%s: %s" % (self.prefix, line))
+        else:
+            logger.info("%s: %s" % (self.prefix, line))
+
+
+class _lines:
+    # Collects the output of one stream, and passes it to the sink a line at
+    # a time.
+    def __init__(self, name: str, sink: Optional[Sink]) -> None:
+        self.name = name
+        self.sink = sink
+        self.data: List[bytes] = []
+        self.partial = b""
+
+    def feed(self, data: bytes) -> None:
+        self.data.append(data)
+        if self.sink is None:
+            return
+        lines = (self.partial + data).split(b"\n")
+        self.partial = lines.pop()
+        for line in lines:
+            self.sink(self.name, line.decode(errors="replace"))
+
+    def close(self) -> None:
+        if self.sink is not None and self.partial:
+            self.sink(self.name, self.partial.decode(errors="replace"))
+        self.partial = b""
+
+    def value(self) -> bytes:
+        return b"".join(self.data)
+
+
+async def _read(stream: asyncio.StreamReader, lines: _lines) -> None:
+    while True:
+        data = await stream.read(CHUNK_SIZE)
+        if not data:
+            break
+        lines.feed(data)
+    lines.close()
+
+
+async def _run_cli(
+    params: List[str], stdout: _lines, stderr: _lines, timeout: Optional[float]
+) -> int:
+    logger.debug(" ".join(params))
+    proc = await asyncio.create_subprocess_exec(
+        *params,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    assert proc.stdout is not None and proc.stderr is not None
+    done = asyncio.gather(
+        _read(proc.stdout, stdout), _read(proc.stderr, stderr), proc.wait()
+    )
+    try:
+        await asyncio.wait_for(done, timeout)
+    except BaseException:
+        if proc.returncode is None:
+            proc.kill()
+        await proc.wait()
+        raise
+    assert proc.returncode is not None
+    return proc.returncode
+
+
+class _api_exec:
+    # One command run through the podman API. The API client blocks, so it
+    # reads in a thread and hands the output to the event loop.
+    def __init__(self, container: docker_container) -> None:
+        self.container = container
+        self.lock = threading.Lock()
+        self.output: Any = None
+        self.aborted = False
+
+    def abort(self) -> None:
+        with self.lock:
+            self.aborted = True
+            output = self.output
+        if output is not None:
+            output.abort()
+
+    def run(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        cmd: List[str],
+        user: Optional[str],
+        cwd: Optional[str],
+        env: Optional[Dict[str, str]],
+        stdout: _lines,
+        stderr: _lines,
+    ) -> int:
+        assert _docker._backend is not None
+        user, env = self.container._exec_options(user, env)
+        logger.debug("exec %s: %s" % (self.container.container, " ".join(cmd)))
+
+        def on_stderr(data: bytes) -> None:
+            loop.call_soon_threadsafe(stderr.feed, data)
+
+        with _docker._backend.exec(
+            self.container.container, cmd, user, cwd, env, stderr=on_stderr
+        ) as output:
+            with self.lock:
+                self.output = output
+                aborted = self.aborted
+            if aborted:
+                output.abort()
+            while True:
+                data = output._next()
+                if data is None:
+                    break
+                loop.call_soon_threadsafe(stdout.feed, data)
+        loop.call_soon_threadsafe(stdout.close)
+        loop.call_soon_threadsafe(stderr.close)
+        return output.returncode or 0
+
+
+class adocker_container:
+    # docker_container, for asyncio. Commands never get a tty, their output
+    # goes a line at a time to the sink, and they can be cancelled or time
+    # out. What a cancelled or timed out command started may still be
+    # running, so the container is then not used again.
+    def __init__(self, sync: docker_container, owner: "adocker") -> None:
+        self.sync = sync
+        self.owner = owner
+
+    @property
+    def container(self) -> str:
+        return self.sync.container
+
+    @property
+    def fresh(self) -> bool:
+        return self.sync.fresh
+
+    async def _run(
+        self,
+        cmd: List[str],
+        user: Optional[str],
+        root: bool,
+        cwd: Optional[str],
+        env: Optional[Dict[str, str]],
+        sink: Optional[Sink],
+        timeout: Optional[float],
+        check: bool,
+    ) -> Tuple[int, bytes]:
+        if root:
+            user = "root"
+        stdout = _lines("stdout", sink)
+        stderr = _lines("stderr", sink)
+        try:
+            if _docker._backend is not None:
+                returncode = await self._run_api(
+                    cmd, user, cwd, env, stdout, stderr, timeout
+                )
+            else:
+                params = self.sync._get_params(cmd, user, cwd, tty=False, extra_env=env)
+                returncode = await _run_cli(params, stdout, stderr, timeout)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            self.owner.spoiled = True
+            raise
+
+        if check and returncode != 0:
+            raise subprocess.CalledProcessError(
+                returncode, cmd, stdout.value(), stderr.value()
+            )
+        return returncode, stdout.value()
+
+    async def _run_api(
+        self,
+        cmd: List[str],
+        user: Optional[str],
+        cwd: Optional[str],
+        env: Optional[Dict[str, str]],
+        stdout: _lines,
+        stderr: _lines,
+        timeout: Optional[float],
+    ) -> int:
+        loop = asyncio.get_running_loop()
+        job = _api_exec(self.sync)
+        future = loop.run_in_executor(
+            None, job.run, loop, cmd, user, cwd, env, stdout, stderr
+        )
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except BaseException:
+            # Ends the thread's read, and waits for it so nothing is still
+            # feeding the output afterwards.
+            job.abort()
+            await asyncio.gather(future, return_exceptions=True)
+            raise
+
+    async def run(
+        self,
+        cmd: List[str],
+        user: Optional[str] = None,
+        root: bool = False,
+        cwd: Optional[str] = None,
+        env: Optional[Dict[str, str]] = None,
+        sink: Optional[Sink] = None,
+        timeout: Optional[float] = None,
+        check: bool = True,
+    ) -> int:
+        returncode, _ = await self._run(cmd, user, root, cwd, env, sink, timeout, check)
+        return returncode
+
+    async def output(
+        self,
+        cmd: List[str],
+        user: Optional[str] = None,
+        root: bool = False,
+        cwd: Optional[str] = None,
+        env: Optional[Dict[str, str]] = None,
+        sink: Optional[Sink] = None,
+        timeout: Optional[float] = None,
+    ) -> bytes:
+        _, output = await self._run(cmd, user, root, cwd, env, sink, timeout, True)
+        return output
+
+    async def apt_upgrade(self, sink: Optional[Sink] = None) -> None:
+        if self.sync.fresh:
+            return
+        await self.run(["apt-get", "update", "--yes"], root=True, sink=sink)
+        await self.run(["apt-get", "upgrade", "--yes"], root=True, sink=sink)
+        self.sync.fresh = True
+
+
+class adocker:
+    # async with adocker(...) as container: await container.run([...])
+    #
+    # Takes the same arguments as docker(), and gets its container the same
+    # way: through the image cache, the pool and the podman API, whichever
+    # are in use. Those block, so they run in a thread.
+    def __init__(self, chroot_name: str, **kwargs: Any) -> None:
+        self.chroot_name = chroot_name
+        self.kwargs = kwargs
+        self.spoiled = False
+
+    async def __aenter__(self) -> adocker_container:
+        self.sync = await asyncio.to_thread(docker, self.chroot_name, **self.kwargs)
+        future = asyncio.ensure_future(asyncio.to_thread(self.sync.__enter__))
+        try:
+            container = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # The thread carries on, and a container it gets has to go back.
+            results = await asyncio.gather(future, return_exceptions=True)
+            if not isinstance(results[0], BaseException):
+                self.spoiled = True
+                await self.__aexit__(asyncio.CancelledError, None, None)
+            raise
+        return adocker_container(container, self)
+
+    async def __aexit__(
+        self,
+        type: Optional[Type[BaseException]],
+        value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        if self.spoiled:
+            self.sync.reuse = False
+        await asyncio.to_thread(self.sync.__exit__, type, value, traceback)
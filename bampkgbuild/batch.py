@@ -0,0 +1,63 @@
+import os
+from typing import Dict, List, Set, Tuple
+
+from debian import deb822
+
+from bampkgbuild.builddep_cache import BUILD_DEPENDS_FIELDS
+from bampkgbuild.rdepends_index import relation_names
+
+
+def read_manifest(path: str) -> List[str]:
+    # One .dsc per line, relative to the manifest. Blank lines and lines
+    # starting with # are ignored.
+    base_dir = os.path.dirname(os.path.abspath(path))
+    dsc_paths = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            dsc_paths.append(os.path.join(base_dir, line))
+    return dsc_paths
+
+
+def build_order(dsc_paths: List[str]) -> List[Tuple[str, str, List[str]]]:
+    # (dsc path, source name, dsc paths it must be built after), ordered so
+    # every package comes after everything it build depends on.
+    sources: Dict[str, str] = {}
+    binaries: Dict[str, str] = {}
+    wants: Dict[str, Set[str]] = {}
+    for dsc_path in dsc_paths:
+        with open(dsc_path) as f:
+            dsc = deb822.Dsc(f)
+        sources[dsc_path] = dsc["Source"]
+        for binary in dsc.get("Binary", "").split(","):
+            binary = binary.strip()
+            if binary:
+                binaries[binary] = dsc_path
+        wants[dsc_path] = set()
+        for field in BUILD_DEPENDS_FIELDS:
+            value = dsc.get(field)
+            if value is not None:
+                wants[dsc_path] |= relation_names(value)
+
+    depends = {
+        dsc_path: sorted(
+            {binaries[name] for name in names if name in binaries} - {dsc_path}
+        )
+        for dsc_path, names in wants.items()
+    }
+
+    order: List[Tuple[str, str, List[str]]] = []
+    done: Set[str] = set()
+    todo = list(dsc_paths)
+    while todo:
+        ready = [p for p in todo if all(d in done for d in depends[p])]
+        if not ready:
+            cycle = ", ".join(sorted(sources[p] for p in todo))
+            raise RuntimeError("Build dependency cycle between %s" % cycle)
+        for dsc_path in ready:
+            order.append((dsc_path, sources[dsc_path], depends[dsc_path]))
+            done.add(dsc_path)
+            todo.remove(dsc_path)
+    return order
@@ -0,0 +1,108 @@
+import hashlib
+import logging
+import re
+import subprocess
+from typing import Any, Dict, List, Optional
+
+from bampkgbuild.cache import lru_cache
+from bampkgbuild.docker import (
+    EXTRA_REPO_LIST,
+    check_output,
+    docker_container,
+    image_id,
+    remove_image,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZE = 20.0
+
+BUILD_DEPENDS_FIELDS = ["Build-Depends", "Build-Depends-Arch", "Build-Depends-Indep"]
+
+
+def image_size(image: str) -> int:
+    output = check_output(
+        ["podman", "image", "inspect", "--format", "{{.Size}}", image]
+    )
+    return int(output.strip())
+
+
+# An Inst line of apt-get --simulate: name, version and architecture.
+INST_LINE = re.compile(r"^Inst (\S+) (?:\[\S+\] )?\((\S+) .*\[(\S+)\]\)", re.M)
+
+# What identifies a package, whichever repository it comes from.
+PACKAGE_FIELDS = ("Package", "Version", "Architecture", "SHA256")
+
+
+def resolve_build_depends(chroot: docker_container, dsc_path: str) -> List[str]:
+    # name:arch=version of everything apt-get build-dep would install.
+    output = chroot.check_output(
+        ["apt-get", "build-dep", "--simulate", dsc_path], root=True
+    )
+    return sorted(
+        f"{name}:{arch}={version}"
+        for name, version, arch in INST_LINE.findall(output.decode())
+    )
+
+
+class builddep_cache(lru_cache):
+    # Images with the build dependencies of a package already installed, kept
+    # until they are the least recently used and over the size budget.
+    what = "build dependencies"
+
+    def __init__(self, budget: float = DEFAULT_SIZE) -> None:
+        super().__init__("builddeps", budget)
+
+    def key(self, chroot: docker_container, image: str, dsc_path: str) -> Optional[str]:
+        # The packages build-dep would install in chroot, which must be up
+        # to date, with their checksums, so a key does not change with the
+        # repositories they come from, only with what they are. None if
+        # there is nothing worth keeping, or apt cannot say.
+        try:
+            packages = resolve_build_depends(chroot, dsc_path)
+            if not packages:
+                return None
+            show = chroot.check_output(
+                ["apt-cache", "show", "--no-all-versions"] + packages
+            )
+        except subprocess.CalledProcessError as e:
+            logger.debug("Cannot resolve build dependencies: %s" % e)
+            return None
+
+        h = hashlib.sha256()
+        h.update(("%s\n" % image_id(image)).encode())
+        for package in packages:
+            h.update(("%s\n" % package).encode())
+        for line in show.decode().splitlines():
+            if line.split(":", 1)[0] in PACKAGE_FIELDS:
+                h.update(("%s\n" % line).encode())
+        return h.hexdigest()
+
+    def _name(self, entry: Dict[str, Any]) -> str:
+        return entry["image"]
+
+    def _exists(self, key: str, entry: Dict[str, Any]) -> bool:
+        return image_id(entry["image"]) is not None
+
+    def _remove(self, key: str, entry: Dict[str, Any]) -> bool:
+        try:
+            remove_image(entry["image"])
+        except subprocess.CalledProcessError:
+            # Still in use by a running build.
+            return False
+        return True
+
+    def lookup(self, key: str) -> Optional[str]:
+        with self._use(key) as entry:
+            if entry is None:
+                return None
+        return entry["image"]
+
+    def store(self, chroot: docker_container, base_image: str, key: str) -> None:
+        image = "localhost/bampkgbuild/builddeps:%s" % key[:32]
+        # The image is shared by every later build with the same build
+        # dependencies, whatever extra repository each of them uses.
+        chroot.check_call(["rm", "-f", EXTRA_REPO_LIST], root=True)
+        chroot.commit(image)
+        size = max(image_size(image) - image_size(base_image), 0)
+        self._add(key, {"image": image, "size": size})
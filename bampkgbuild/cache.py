@@ -0,0 +1,179 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def cache_dir(*parts: str) -> str:
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    path = os.path.join(base, "bampkgbuild", *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def safe_name(name: str) -> str:
+    return "".join(c if c.isalnum() or c in "-_." else "_" for c in name)
+
+
+def update_hashes(path: str, *hashes: Any) -> None:
+    # Reads the file once, however many hashes it goes into.
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            for h in hashes:
+                h.update(data)
+
+
+def hash_file(path: str, algorithm: str = "sha256") -> str:
+    h = hashlib.new(algorithm)
+    update_hashes(path, h)
+    return h.hexdigest()
+
+
+@contextmanager
+def locked(path: str) -> Iterator[None]:
+    # Works across processes as well as across threads, as every caller
+    # gets its own open file.
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def load_index(path: str) -> Dict[str, Any]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_index(path: str, index: Dict[str, Any]) -> None:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+    os.rename(tmp_path, path)
+
+
+def load_pickle(path: str, version: int, key: str) -> Tuple[bool, Any]:
+    # Whether path has a value pickled by save_pickle with this version and
+    # key, and the value.
+    try:
+        with open(path, "rb") as f:
+            cached = pickle.load(f)
+        if cached["version"] == version and cached["key"] == key:
+            return True, cached["value"]
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError, KeyError):
+        pass
+    return False, None
+
+
+def save_pickle(path: str, version: int, key: str, value: Any) -> None:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(
+            {"version": version, "key": key, "value": value},
+            f,
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+    os.rename(tmp_path, path)
+
+
+class lru_cache:
+    # Entries of an index.json, each with a "size" and a "last_used", kept
+    # within a budget by evicting the least recently used. The index is only
+    # read and written with the lock held, by any process. Subclasses say
+    # where an entry's data is, by overriding _exists, _remove and _name;
+    # by default it is the directory named by the key.
+    what = "cache entry"
+
+    def __init__(self, name: str, budget: float) -> None:
+        self.budget = int(budget * 1024**3)
+        self.dir = cache_dir(name)
+        self.index_path = os.path.join(self.dir, "index.json")
+        self.lock_path = self.index_path + ".lock"
+
+    def _name(self, entry: Dict[str, Any]) -> str:
+        raise NotImplementedError
+
+    def _exists(self, key: str, entry: Dict[str, Any]) -> bool:
+        return os.path.isdir(os.path.join(self.dir, key))
+
+    def _remove(self, key: str, entry: Dict[str, Any]) -> bool:
+        # False if it cannot go yet, e.g. as it is in use.
+        shutil.rmtree(os.path.join(self.dir, key), ignore_errors=True)
+        return True
+
+    @contextmanager
+    def _use(self, key: str) -> Iterator[Optional[Dict[str, Any]]]:
+        # The entry for key, marked as used, with the lock held so it is not
+        # evicted meanwhile. None if there is none, or its data is gone.
+        with locked(self.lock_path):
+            index = load_index(self.index_path)
+            entry = index.get(key)
+            if entry is None:
+                yield None
+                return
+            if not self._exists(key, entry):
+                # Removed behind our back; it is made again.
+                del index[key]
+                save_index(self.index_path, index)
+                yield None
+                return
+            entry["last_used"] = time.time()
+            save_index(self.index_path, index)
+            logger.info("Using %s %s" % (self.what, self._name(entry)))
+            yield entry
+
+    def _copy_in(self, src_dir: str, names: List[str]) -> Tuple[str, int]:
+        # A new directory with copies of names, to pass to _add, and the
+        # size of them.
+        tmp_dir = tempfile.mkdtemp(dir=self.dir)
+        size = 0
+        for name in names:
+            dst_path = os.path.join(tmp_dir, name)
+            shutil.copyfile(os.path.join(src_dir, name), dst_path)
+            size += os.path.getsize(dst_path)
+        return tmp_dir, size
+
+    def _add(
+        self, key: str, entry: Dict[str, Any], tmp_dir: Optional[str] = None
+    ) -> None:
+        # entry needs its "size". tmp_dir, if any, becomes the directory of
+        # key.
+        with locked(self.lock_path):
+            if tmp_dir is not None:
+                dst_dir = os.path.join(self.dir, key)
+                shutil.rmtree(dst_dir, ignore_errors=True)
+                os.rename(tmp_dir, dst_dir)
+
+            index = load_index(self.index_path)
+            entry["last_used"] = time.time()
+            index[key] = entry
+            self._evict(index)
+            save_index(self.index_path, index)
+
+    def _evict(self, index: Dict[str, Any]) -> None:
+        total = sum(entry["size"] for entry in index.values())
+        by_age = sorted(index.items(), key=lambda item: item[1]["last_used"])
+        for key, entry in by_age:
+            if total <= self.budget:
+                break
+            logger.info("Evicting %s %s" % (self.what, self._name(entry)))
+            if not self._remove(key, entry):
+                continue
+            total -= entry["size"]
+            del index[key]
@@ -0,0 +1,90 @@
+import logging
+import subprocess
+from typing import Dict, List, Optional, Tuple
+
+from bampkgbuild import trace
+from bampkgbuild.cache import cache_dir, safe_name
+from bampkgbuild.docker import docker_container
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZE = 5.0
+
+MOUNT_DIR = "/ccache"
+
+# The Debian compiler wrappers come first.
+PATH = "/usr/lib/ccache:/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"
+
+HIT_STATS = ["direct_cache_hit", "preprocessed_cache_hit"]
+MISS_STATS = ["cache_miss"]
+
+
+class compiler_cache:
+    # A persistent ccache directory for each chroot and architecture, so
+    # objects from different compilers and architectures never mix.
+    def __init__(self, size: float = DEFAULT_SIZE) -> None:
+        self.size = size
+
+    def volume(self, chroot_name: str, architecture: str) -> Tuple[str, str]:
+        path = cache_dir("ccache", safe_name(chroot_name), architecture)
+        return (path, MOUNT_DIR)
+
+    def env(self, base_dir: str) -> Dict[str, str]:
+        # Every build is in a new temporary directory. The base dir makes
+        # the paths ccache sees relative, and dpkg must not add its own
+        # build path to the compiler flags, or nothing would ever hit.
+        return {
+            "CCACHE_DIR": MOUNT_DIR,
+            "CCACHE_MAXSIZE": "%.1fG" % self.size,
+            "CCACHE_BASEDIR": base_dir,
+            "CCACHE_NOHASHDIR": "true",
+            "DEB_BUILD_MAINT_OPTIONS": "reproducible=-fixfilepath,-fixdebugpath",
+            "PATH": PATH,
+        }
+
+    def install(self, chroot: docker_container) -> None:
+        with trace.span("ccache install"):
+            chroot.check_call(["apt-get", "install", "--yes", "ccache"], root=True)
+
+    def stats(self, chroot: docker_container) -> Dict[str, int]:
+        try:
+            output = chroot.check_output(
+                ["ccache", "--print-stats"], env={"CCACHE_DIR": MOUNT_DIR}
+            )
+        except subprocess.CalledProcessError:
+            # Older than ccache 4.
+            return {}
+        stats = {}
+        for line in output.decode().splitlines():
+            key, _, value = line.partition("\t")
+            if value.isdigit():
+                stats[key] = int(value)
+        return stats
+
+    def build(
+        self,
+        chroot: docker_container,
+        params: List[str],
+        build_dir: str,
+        dst_dir: str,
+        env: Optional[Dict[str, str]] = None,
+    ) -> None:
+        # Stats are compared before and after, instead of zeroed, as other
+        # builds may be using the same directory.
+        build_env = self.env(dst_dir)
+        if env is not None:
+            build_env.update(env)
+        before = self.stats(chroot)
+        chroot.check_call(params, cwd=build_dir, env=build_env)
+        after = self.stats(chroot)
+
+        def total(keys: List[str]) -> int:
+            return sum(after.get(key, 0) - before.get(key, 0) for key in keys)
+
+        hits = total(HIT_STATS)
+        misses = total(MISS_STATS)
+        if hits + misses > 0:
+            logger.info(
+                "ccache: %d hits, %d misses, %.0f%% hit rate"
+                % (hits, misses, 100.0 * hits / (hits + misses))
+            )
@@ -0,0 +1,39 @@
+import logging
+import os
+import tempfile
+
+from bampkgbuild.cache import cache_dir, hash_file
+from bampkgbuild.staging import clone_file
+
+logger = logging.getLogger(__name__)
+
+
+class deb_pool:
+    # Downloaded .debs, stored by their SHA256, so a package already fetched
+    # by any earlier run is never downloaded again.
+    def __init__(self) -> None:
+        self.dir = cache_dir("debs")
+
+    def path(self, sha256: str) -> str:
+        return os.path.join(self.dir, sha256[:2], sha256 + ".deb")
+
+    def has(self, sha256: str) -> bool:
+        return os.path.exists(self.path(sha256))
+
+    def add(self, src_path: str) -> str:
+        sha256 = hash_file(src_path)
+        dst_path = self.path(sha256)
+        if not os.path.exists(dst_path):
+            os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+            # Renamed into place, so nobody sees a partial file.
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dst_path))
+            os.close(fd)
+            os.remove(tmp_path)
+            clone_file(src_path, tmp_path)
+            os.rename(tmp_path, dst_path)
+        return sha256
+
+    def export(self, sha256: str, dst_path: str) -> None:
+        if os.path.exists(dst_path):
+            os.remove(dst_path)
+        clone_file(self.path(sha256), dst_path)
@@ -1,41 +1,117 @@
+import io
 import os
+import getpass
 import logging.config
 import subprocess
+import sys
+import tarfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from contextlib import contextmanager
-from tempfile import NamedTemporaryFile
-from typing import List, Optional, Iterator, Any, Tuple
+from types import TracebackType
+from typing import (
+    Callable,
+    Dict,
+    IO,
+    Iterable,
+    List,
+    Optional,
+    Iterator,
+    Any,
+    Tuple,
+    Type,
+    TYPE_CHECKING,
+    Union,
+    cast,
+)
+
+from bampkgbuild import trace
+
+if TYPE_CHECKING:
+    from bampkgbuild.image_cache import image_cache
+    from bampkgbuild.podman_api import podman_api
 
 logger = logging.getLogger(__name__)
 
+# The pool in use by docker(), see container_pool.__enter__.
+_pool: Optional["container_pool"] = None
+
+# The image cache in use by docker(), see image_cache.__enter__.
+_image_cache: Optional["image_cache"] = None
+
+# The podman API in use instead of the CLI, see podman_api.__enter__.
+_backend: Optional["podman_api"] = None
+
+# (host path, container path) mounted read only into every container, see
+# add_mount.
+_mounts: List[Tuple[str, str]] = []
+
+# Held by whatever has the terminal, so the background signing and an
+# interactive shell never prompt at the same time.
+_terminal = threading.RLock()
+
+# Where docker(tmpfs=...) mounts a RAM backed workspace.
+TMPFS_DIR = "/tmpfs"
+
+# Where apt keeps the package lists in the chroots.
+LISTS_DIR = "/var/lib/apt/lists"
+
+# The apt source add_extra_repo writes. It points at a repository only this
+# run can see, so it never stays in a container or image used again.
+EXTRA_REPO_LIST = "/etc/apt/sources.list.d/extra_repo.list"
+
+# Run as root before a container is handed out again. Anything that changes
+# more than this (installed packages, ...) must not set reuse=True. A
+# container with a host directory on /build is never reset, see
+# docker.__init__.
+RESET_CMD = f"rm -f {EXTRA_REPO_LIST} && find /build -mindepth 1 -delete"
+
 
 class docker_container:
-    def __init__(self, container: str, gpg: bool) -> None:
+    def __init__(self, container: str, gpg: bool, fresh: bool = False) -> None:
         self.container = container
         self.gpg = gpg
+        # True if apt is already up to date in this container.
+        self.fresh = fresh
+
+    def _exec_options(
+        self, user: Optional[str], extra_env: Optional[Dict[str, str]]
+    ) -> Tuple[str, Dict[str, str]]:
+        env = {}
+        if user is not None:
+            env["USER"] = user
+        else:
+            user = str(os.getuid())
+            env["USER"] = login_name()
+
+        if self.gpg:
+            env["GNUPGHOME"] = "/gpg"
+
+        if extra_env is not None:
+            env.update(extra_env)
+        return user, env
 
     def _get_params(
-        self, cmd: List[str], user: Optional[str], cwd: Optional[str]
+        self,
+        cmd: List[str],
+        user: Optional[str],
+        cwd: Optional[str],
+        tty: bool = True,
+        extra_env: Optional[Dict[str, str]] = None,
     ) -> List[str]:
-        env = {}
+        user, env = self._exec_options(user, extra_env)
         params = [
             "podman",
             "exec",
-            "-ti",
+            "-ti" if tty else "-i",
+            "--user",
+            user,
         ]
 
-        if user is not None:
-            params.extend(["--user", user])
-            env["USER"] = user
-        else:
-            params.extend(["--user", str(os.getuid())])
-            env["USER"] = str(os.getlogin())
-
         if cwd is not None:
             params.extend(["--workdir", cwd])
 
-        if self.gpg:
-            params.extend(["--env", "GNUPGHOME=/gpg"])
-
         for key, value in env.items():
             params.extend(["--env", f"{key}={value}"])
 
@@ -43,42 +119,205 @@ class docker_container:
         params.extend(cmd)
         return params
 
+    def _api_exec(
+        self,
+        cmd: List[str],
+        user: Optional[str],
+        cwd: Optional[str],
+        extra_env: Optional[Dict[str, str]],
+        capture: bool,
+    ) -> bytes:
+        assert _backend is not None
+        user, env = self._exec_options(user, extra_env)
+        logger.debug("exec %s: %s" % (self.container, " ".join(cmd)))
+        with _backend.exec(self.container, cmd, user, cwd, env) as output:
+            if capture:
+                data = output.read()
+            else:
+                output.copy_to(sys.stdout.buffer)
+                data = b""
+        if output.returncode != 0:
+            raise subprocess.CalledProcessError(output.returncode or 0, cmd, data)
+        return data
+
     def check_call(
         self,
         cmd: List[str],
         user: Optional[str] = None,
         root: bool = False,
         cwd: Optional[str] = None,
+        env: Optional[Dict[str, str]] = None,
+        interactive: bool = False,
     ) -> int:
+        # Anything interactive needs a terminal, which only the CLI has.
         if root:
             user = "root"
-        params = self._get_params(cmd, user, cwd)
-        return check_call(params)
+        if _backend is not None and not interactive:
+            self._api_exec(cmd, user, cwd, env, capture=False)
+            return 0
+        params = self._get_params(cmd, user, cwd, tty=sys.stdin.isatty(), extra_env=env)
+        if not interactive:
+            return check_call(params)
+        with _terminal:
+            return check_call(params)
 
     def check_output(
-        self, cmd: List[str], user: Optional[str] = None, root=False, cwd=None
+        self,
+        cmd: List[str],
+        user: Optional[str] = None,
+        root=False,
+        cwd=None,
+        env: Optional[Dict[str, str]] = None,
     ) -> bytes:
         if root:
             user = "root"
-        params = self._get_params(cmd, user, cwd)
+        if _backend is not None:
+            return self._api_exec(cmd, user, cwd, env, capture=True)
+        # No tty, so the output has plain \n line endings.
+        params = self._get_params(cmd, user, cwd, tty=False, extra_env=env)
         return check_output(params)
 
     @contextmanager
     def create_file(self, whence: str, user: Optional[str] = None) -> Iterator[Any]:
-        with NamedTemporaryFile() as tmp_file:
-            yield tmp_file
-            tmp_file.flush()
-            check_call(
-                [
-                    "docker",
-                    "cp",
-                    tmp_file.name,
-                    f"{self.container}:{whence}",
-                ]
-            )
+        f = io.BytesIO()
+        yield f
+        name = os.path.basename(whence)
+        self.put_files(os.path.dirname(whence), [(name, f.getvalue())], user=user)
+
+    def put_files(
+        self,
+        dst_dir: str,
+        files: Iterable[Tuple[str, Union[bytes, str]]],
+        user: Optional[str] = None,
+        mode: int = 0o644,
+    ) -> None:
+        # Writes every (name, data) to dst_dir in one tar stream. data is
+        # either the bytes to write or a path on this host; files can be a
+        # generator, nothing is collected first.
+        if _backend is not None:
+            self._api_put_files(dst_dir, files, user, mode)
+            return
+
+        params = self._get_params(
+            ["tar", "-x", "--no-same-owner", "-C", dst_dir, "-f", "-"],
+            user,
+            None,
+            tty=False,
+        )
+        logger.debug(" ".join(params))
+        proc = subprocess.Popen(params, stdin=subprocess.PIPE)
+        assert proc.stdin is not None
+        try:
+            _write_tar(proc.stdin, files, user, mode)
+        except BrokenPipeError:
+            # tar went away; its exit status says why.
+            pass
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            returncode = proc.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, params)
+
+    def _api_put_files(
+        self,
+        dst_dir: str,
+        files: Iterable[Tuple[str, Union[bytes, str]]],
+        user: Optional[str],
+        mode: int,
+    ) -> None:
+        # The tar is written to a pipe by another thread, while the request
+        # sends what comes out of it.
+        assert _backend is not None
+        read_fd, write_fd = os.pipe()
+        errors: List[BaseException] = []
+
+        def write() -> None:
+            try:
+                with os.fdopen(write_fd, "wb") as f:
+                    _write_tar(f, files, user, mode)
+            except BrokenPipeError:
+                pass
+            except BaseException as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=write)
+        thread.start()
+        try:
+            with os.fdopen(read_fd, "rb") as f:
+                _backend.put_archive(self.container, dst_dir, f)
+        finally:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    @contextmanager
+    def _tar_out(self, src_dir: str, names: Optional[List[str]]) -> Iterator[Any]:
+        cmd = ["tar", "-c", "-C", src_dir, "-f", "-", "--"] + (names or ["."])
+        if _backend is not None:
+            user, env = self._exec_options(None, None)
+            with _backend.exec(self.container, cmd, user, None, env) as output:
+                # A stream is only ever read, which is all exec_output does.
+                stream = cast(IO[bytes], output)
+                with tarfile.open(fileobj=stream, mode="r|") as tar:
+                    yield tar
+            if output.returncode != 0:
+                raise subprocess.CalledProcessError(output.returncode or 0, cmd)
+            return
+
+        params = self._get_params(cmd, None, None, tty=False)
+        logger.debug(" ".join(params))
+        proc = subprocess.Popen(params, stdout=subprocess.PIPE)
+        assert proc.stdout is not None
+        try:
+            with tarfile.open(fileobj=proc.stdout, mode="r|") as tar:
+                yield tar
+            # The padding after the end of the archive.
+            while proc.stdout.read(64 * 1024):
+                pass
+        finally:
+            proc.stdout.close()
+            returncode = proc.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, params)
+
+    def get_files(self, src: str, dst: str, names: Optional[List[str]] = None) -> None:
+        # Copies names, or everything, in the src directory into dst.
+        with self._tar_out(src, names) as tar:
+            if hasattr(tarfile, "data_filter"):
+                tar.extractall(dst, filter="data")
+            else:
+                tar.extractall(dst)
 
-    def get_files(self, src: str, dst: str) -> None:
-        check_call(["docker", "cp", f"{self.container}:{src}", dst])
+    def read_files(
+        self, src: str, names: Optional[List[str]] = None
+    ) -> Iterator[Tuple[str, bytes]]:
+        # (name, data) of every regular file in the src directory, or just
+        # of names, as they come out of the tar stream.
+        with self._tar_out(src, names) as tar:
+            for member in tar:
+                if member.isfile():
+                    f = tar.extractfile(member)
+                    assert f is not None
+                    yield os.path.normpath(member.name), f.read()
+
+    def commit(self, image: Optional[str] = None) -> str:
+        params = ["podman", "commit", self.container]
+        if image is not None:
+            params.append(image)
+        return check_output(params).strip().decode()
+
+    def apt_upgrade(self) -> None:
+        if self.fresh:
+            logger.debug("Skipping apt upgrade, %s is up to date" % self.container)
+            return
+        with trace.span("apt update"):
+            self.check_call(["apt-get", "update", "--yes"], root=True)
+        with trace.span("apt upgrade"):
+            self.check_call(["apt-get", "upgrade", "--yes"], root=True)
+        self.fresh = True
 
 
 class docker:
@@ -87,63 +326,393 @@ class docker:
         chroot_name: str,
         gpg: bool = False,
         volume: Optional[Tuple[str, str]] = None,
+        reuse: bool = False,
+        pooled: bool = True,
+        prepared: bool = False,
+        tmpfs: Optional[str] = None,
     ) -> None:
         self.chroot_name = chroot_name
         self.gpg = gpg
         self.volume = volume
+        self.tmpfs = tmpfs
+        self.mounts = tuple(_mounts)
+        self.reuse = reuse and not self._mounted_on_build()
+        self.pool = _pool if pooled else None
 
-    def __enter__(self) -> docker_container:
+        # A prepared image is one of ours, that is already up to date.
+        self.image = chroot_name
+        self.fresh = prepared
+        if _image_cache is not None and not prepared:
+            self.image, self.fresh = _image_cache.resolve(chroot_name)
+
+    def _mounted_on_build(self) -> bool:
+        # RESET_CMD empties /build, which must not be the user's files.
+        for _, dst, _ in self._volumes():
+            if dst == "/build" or dst.startswith("/build/"):
+                return True
+        return False
+
+    def _key(self) -> Tuple[Any, ...]:
+        gpg_dir = os.environ["GNUPGHOME"] if self.gpg else None
+        return (self.image, gpg_dir, self.volume, self.mounts, self.tmpfs)
+
+    def _volumes(self) -> List[Tuple[str, str, List[str]]]:
+        # (host path, container path, options) of every bind mount.
+        volumes: List[Tuple[str, str, List[str]]] = [("/tmp", "/tmp", [])]
+
+        volume = self.volume
+        if volume is not None:
+            volumes.append((volume[0], volume[1], []))
+
+        if self.gpg:
+            volumes.append((os.environ["GNUPGHOME"], "/gpg", []))
+
+        for src, dst in self.mounts:
+            volumes.append((src, dst, ["ro"]))
+        return volumes
+
+    def _tmpfs_options(self) -> List[str]:
+        # Builds run their tools from here, so it cannot be noexec.
+        return [f"size={self.tmpfs}", "mode=1777", "exec"]
+
+    def _create_params(self) -> List[str]:
         params = [
             "podman",
             "create",
             "-t",
             "-i",
-            "-v",
-            "/tmp:/tmp",
         ]
 
-        volume = self.volume
-        if volume is not None:
-            params.extend(["--volume", f"{volume[0]}:{volume[1]}"])
+        for src, dst, options in self._volumes():
+            params.extend(["--volume", ":".join([src, dst] + options)])
 
-        if self.gpg:
-            gpg_dir = os.environ["GNUPGHOME"]
-            params.extend(["--volume", f"{gpg_dir}:/gpg"])
+        if self.tmpfs is not None:
+            tmpfs_options = ",".join(self._tmpfs_options())
+            params.extend(["--tmpfs", f"{TMPFS_DIR}:{tmpfs_options}"])
 
         params.extend(["--userns", "keep-id"])
 
-        params.append(self.chroot_name)
-        self.container = check_output(params).strip().decode()
+        params.append(self.image)
+        return params
 
+    def _create_spec(self) -> Dict[str, Any]:
+        # _create_params, for the podman API.
+        mounts: List[Dict[str, Any]] = [
+            {
+                "type": "bind",
+                "source": src,
+                "destination": dst,
+                "options": ["rbind"] + options,
+            }
+            for src, dst, options in self._volumes()
+        ]
+
+        if self.tmpfs is not None:
+            mounts.append(
+                {
+                    "type": "tmpfs",
+                    "source": "tmpfs",
+                    "destination": TMPFS_DIR,
+                    "options": self._tmpfs_options(),
+                }
+            )
+
+        return {
+            "image": self.image,
+            "terminal": True,
+            "stdin": True,
+            "mounts": mounts,
+            "userns": {"nsmode": "keep-id"},
+        }
+
+    def _create(self) -> str:
+        if _backend is not None:
+            with trace.span("container create"):
+                container = _backend.create(self._create_spec())
+            with trace.span("container start"):
+                _backend.start(container)
+            return container
+
+        with trace.span("container create"):
+            container = check_output(self._create_params()).strip().decode()
+
+        with trace.span("container start"):
+            check_call(
+                [
+                    "podman",
+                    "start",
+                    container,
+                ]
+            )
+        return container
+
+    def __enter__(self) -> docker_container:
+        pool = self.pool
+        if pool is not None:
+            self.container = pool.acquire(self._key(), self._create)
+        else:
+            self.container = self._create()
+
+        docker = docker_container(self.container, self.gpg, self.fresh)
+        return docker
+
+    def __exit__(
+        self,
+        type: Optional[Type[BaseException]],
+        value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        pool = self.pool
+        if pool is not None:
+            pool.release(self._key(), self.container, self.reuse and type is None)
+        else:
+            remove_container(self.container)
+
+
+class _pooled_container:
+    def __init__(self, container: str) -> None:
+        self.container = container
+        self.uses = 0
+        self.last_used = time.monotonic()
+
+
+class container_pool:
+    # Keeps started containers around, keyed by image and mounts. A container
+    # is only handed out again if the previous user passed reuse=True.
+    # Otherwise a fresh one is started in the background for the next user
+    # of the same key, but only after a user of that key had to wait for
+    # one, so nothing is started that is never used. Old containers are
+    # removed in the background.
+    def __init__(self, max_idle: float = 300.0, max_uses: int = 20) -> None:
+        self.max_idle = max_idle
+        self.max_uses = max_uses
+        self.lock = threading.Lock()
+        self.idle: Dict[Tuple[Any, ...], List[_pooled_container]] = {}
+        self.warming: Dict[Tuple[Any, ...], List[Future]] = {}
+        self.in_use: Dict[str, _pooled_container] = {}
+        self.create: Dict[Tuple[Any, ...], Callable[[], str]] = {}
+        # Users of each key that found no container ready.
+        self.missed: Dict[Tuple[Any, ...], int] = {}
+        self.executor = ThreadPoolExecutor(max_workers=4)
+
+    def __enter__(self) -> "container_pool":
+        global _pool
+        _pool = self
+        return self
+
+    def __exit__(
+        self,
+        type: Optional[Type[BaseException]],
+        value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        global _pool
+        _pool = None
+        self.close()
+
+    def acquire(self, key: Tuple[Any, ...], create: Callable[[], str]) -> str:
+        self._expire()
+        with self.lock:
+            self.create[key] = create
+            idle = self.idle.get(key, [])
+            pooled = idle.pop() if len(idle) > 0 else None
+            warming = self.warming.get(key, [])
+            future = warming.pop(0) if pooled is None and len(warming) > 0 else None
+
+        if pooled is None and future is not None:
+            try:
+                pooled = _pooled_container(future.result())
+            except Exception as e:
+                logger.warning("Warm container for %s failed: %s" % (key[0], e))
+
+        if pooled is None:
+            with self.lock:
+                self.missed[key] = self.missed.get(key, 0) + 1
+            pooled = _pooled_container(create())
+
+        pooled.uses += 1
+        with self.lock:
+            self.in_use[pooled.container] = pooled
+        return pooled.container
+
+    def release(self, key: Tuple[Any, ...], container: str, reusable: bool) -> None:
+        with self.lock:
+            pooled = self.in_use.pop(container)
+
+        if reusable and pooled.uses < self.max_uses:
+            try:
+                _reset_container(container)
+            except subprocess.CalledProcessError:
+                logger.warning("Cannot reset container %s" % container)
+            else:
+                pooled.last_used = time.monotonic()
+                with self.lock:
+                    self.idle.setdefault(key, []).append(pooled)
+                return
+
+        self.executor.submit(_retire_container, container)
+        with self.lock:
+            idle = self.idle.get(key, [])
+            warming = self.warming.setdefault(key, [])
+            missed = self.missed.get(key, 0)
+            if len(idle) == 0 and len(warming) == 0 and missed > 0:
+                self.missed[key] = missed - 1
+                warming.append(self.executor.submit(self.create[key]))
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            for key, idle in self.idle.items():
+                for pooled in list(idle):
+                    if now - pooled.last_used > self.max_idle:
+                        idle.remove(pooled)
+                        expired.append(pooled.container)
+        for container in expired:
+            self.executor.submit(_retire_container, container)
+
+    def close(self) -> None:
+        with self.lock:
+            containers = [p.container for idle in self.idle.values() for p in idle]
+            warming = [f for futures in self.warming.values() for f in futures]
+            self.idle = {}
+            self.warming = {}
+
+        for future in warming:
+            try:
+                containers.append(future.result())
+            except Exception:
+                pass
+
+        for container in containers:
+            self.executor.submit(_retire_container, container)
+        self.executor.shutdown(wait=True)
+
+
+def _retire_container(container: str) -> None:
+    try:
+        remove_container(container)
+    except subprocess.CalledProcessError as e:
+        logger.warning("Cannot remove container %s: %s" % (container, e))
+
+
+def _reset_container(container: str) -> None:
+    with trace.span("container reset"):
+        if _backend is not None:
+            docker_container(container, False).check_call(
+                ["sh", "-c", RESET_CMD], root=True
+            )
+            return
         check_call(
-            [
-                "podman",
-                "start",
-                self.container,
-            ]
+            ["podman", "exec", "--user", "root", container, "sh", "-c", RESET_CMD]
         )
 
-        docker = docker_container(self.container, self.gpg)
-        return docker
 
-    def __exit__(self, type: str, value: str, traceback: str) -> None:
+def remove_container(container: str) -> None:
+    if _backend is not None:
+        with trace.span("container kill"):
+            _backend.kill(container)
+        with trace.span("container rm"):
+            _backend.remove(container)
+        return
+
+    with trace.span("container kill"):
         check_call(
             [
                 "podman",
                 "kill",
-                self.container,
+                container,
             ]
         )
 
+    with trace.span("container rm"):
         check_call(
             [
                 "podman",
                 "rm",
-                self.container,
+                container,
             ]
         )
 
 
+def _write_tar(
+    f: IO[bytes],
+    files: Iterable[Tuple[str, Union[bytes, str]]],
+    user: Optional[str],
+    mode: int,
+) -> None:
+    # Owned by whoever the files are for, in case they are extracted as
+    # they are, as the podman API does.
+    uid = 0 if user in ("root", "0") else os.getuid()
+    gid = 0 if user in ("root", "0") else os.getgid()
+
+    def owner(info: tarfile.TarInfo) -> tarfile.TarInfo:
+        info.uid, info.gid = uid, gid
+        info.uname = info.gname = ""
+        return info
+
+    with tarfile.open(fileobj=f, mode="w|") as tar:
+        for name, data in files:
+            if isinstance(data, str):
+                tar.add(data, arcname=name, filter=owner)
+                continue
+            info = owner(tarfile.TarInfo(name))
+            info.size = len(data)
+            info.mode = mode
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(data))
+
+
+def login_name() -> str:
+    try:
+        return os.getlogin()
+    except OSError:
+        # No controlling terminal, e.g. from cron.
+        return getpass.getuser()
+
+
+def image_id(image: str) -> Optional[str]:
+    try:
+        output = check_output(
+            ["podman", "image", "inspect", "--format", "{{.Id}}", image]
+        )
+    except subprocess.CalledProcessError:
+        return None
+    return output.strip().decode()
+
+
+def set_backend(backend: Optional["podman_api"]) -> None:
+    global _backend
+    _backend = backend
+
+
+def set_image_cache(cache: Optional["image_cache"]) -> None:
+    global _image_cache
+    _image_cache = cache
+
+
+def add_mount(src: str, dst: str) -> None:
+    _mounts.append((src, dst))
+
+
+def remove_mount(src: str, dst: str) -> None:
+    _mounts.remove((src, dst))
+
+
+def host_path(path: str) -> Optional[str]:
+    # Where a path inside the containers is on this host, if it is anywhere.
+    if path == "/tmp" or path.startswith("/tmp/"):
+        return path
+    for src, dst in _mounts:
+        if path == dst or path.startswith(dst + "/"):
+            return src + path[len(dst) :]
+    return None
+
+
+def remove_image(image: str) -> None:
+    check_call(["podman", "rmi", image])
+
+
 def check_call(cmd: List[str]) -> int:
     logger.debug(" ".join(cmd))
     return subprocess.check_call(cmd)
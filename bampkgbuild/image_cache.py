@@ -0,0 +1,206 @@
+import argparse
+import hashlib
+import logging
+import os
+import subprocess
+import threading
+import time
+from types import TracebackType
+from typing import Dict, List, Optional, Tuple, Type
+
+from bampkgbuild import trace
+from bampkgbuild.cache import cache_dir, load_index, locked, safe_name, save_index
+from bampkgbuild.docker import (
+    check_call,
+    check_output,
+    docker_container,
+    image_id,
+    remove_container,
+    remove_image,
+    set_image_cache,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_AGE = 6.0
+
+SOURCES_CMD = "cat /etc/apt/sources.list /etc/apt/sources.list.d/* 2>/dev/null; true"
+
+
+def cached_name(chroot_name: str, key: str, created: float) -> str:
+    # brianmay/debian-amd64:sid -> localhost/bampkgbuild/debian-amd64:sid-<key>-<date>
+    repository, _, tag = chroot_name.partition(":")
+    name = repository.split("/")[-1]
+    stamp = time.strftime("%Y%m%d%H%M", time.localtime(created))
+    return f"localhost/bampkgbuild/{name}:{tag or 'latest'}-{key[:12]}-{stamp}"
+
+
+class image_cache:
+    # Keeps an apt updated and upgraded copy of every chroot image. A copy is
+    # used until it is older than max_age hours, or the base image changes.
+    # The hash of the apt sources a container of the base image sees is
+    # stored with the base image id when the copy is made, so using a copy
+    # needs no container. Sources that change without the base image, e.g.
+    # with the host's container configuration, are picked up by the next
+    # refresh.
+    #
+    # A replaced copy is not removed straight away, as another run may be
+    # about to start containers from it. It is retired, and removed once it
+    # has been retired for max_age hours.
+    def __init__(self, max_age: float = DEFAULT_MAX_AGE) -> None:
+        self.max_age = max_age
+        self.dir = cache_dir("images")
+        self.index_path = os.path.join(self.dir, "index.json")
+        self.lock = threading.Lock()
+        self.resolved: Dict[str, str] = {}
+
+    def __enter__(self) -> "image_cache":
+        set_image_cache(self)
+        return self
+
+    def __exit__(
+        self,
+        type: Optional[Type[BaseException]],
+        value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        set_image_cache(None)
+
+    def _fresh(self, entry: Dict, base_id: Optional[str]) -> bool:
+        age = time.time() - entry["created"]
+        return entry["base"] == base_id and age < self.max_age * 3600
+
+    def resolve(self, chroot_name: str) -> Tuple[str, bool]:
+        # Returns the image to start and whether it is already up to date.
+        with self.lock:
+            image = self.resolved.get(chroot_name)
+        if image is not None:
+            return image, True
+
+        base_id = image_id(chroot_name)
+        if base_id is None:
+            return chroot_name, False
+
+        lock_path = os.path.join(self.dir, safe_name(chroot_name) + ".lock")
+        with locked(lock_path):
+            entry = load_index(self.index_path).get(chroot_name)
+            if entry is not None and self._fresh(entry, base_id):
+                if image_id(entry["image"]) is not None:
+                    image = entry["image"]
+
+            if image is None:
+                image = self._refresh(chroot_name, base_id, entry)
+
+        with self.lock:
+            self.resolved[chroot_name] = image
+        return image, True
+
+    def _refresh(self, chroot_name: str, base_id: str, old: Optional[Dict]) -> str:
+        logger.info("Refreshing cached image for %s" % chroot_name)
+        with trace.span("image refresh", chroot=chroot_name):
+            return self._refresh_image(chroot_name, base_id, old)
+
+    def _refresh_image(
+        self, chroot_name: str, base_id: str, old: Optional[Dict]
+    ) -> str:
+        container = (
+            check_output(["podman", "create", "-t", "-i", chroot_name]).strip().decode()
+        )
+        try:
+            check_call(["podman", "start", container])
+            chroot = docker_container(container, False)
+            sources = chroot.check_output(["sh", "-c", SOURCES_CMD], root=True)
+            key = hashlib.sha256(sources).hexdigest()
+            created = time.time()
+            image = cached_name(chroot_name, key, created)
+            chroot.check_call(["apt-get", "update", "--yes"], root=True)
+            chroot.check_call(["apt-get", "upgrade", "--yes"], root=True)
+            chroot.commit(image)
+        finally:
+            remove_container(container)
+
+        retired = []
+        if old is not None:
+            retired = old.get("retired", [])
+            if old["image"] != image:
+                retired.append({"image": old["image"], "retired": created})
+        retired = self._remove_retired(retired, created)
+
+        with locked(self.index_path + ".lock"):
+            index = load_index(self.index_path)
+            index[chroot_name] = {
+                "image": image,
+                "base": base_id,
+                "key": key,
+                "created": created,
+                "retired": retired,
+            }
+            save_index(self.index_path, index)
+
+        return image
+
+    def _remove_retired(self, retired: List[Dict], now: float) -> List[Dict]:
+        # Returns the ones that have to stay.
+        keep = []
+        for entry in retired:
+            if now - entry["retired"] < self.max_age * 3600:
+                keep.append(entry)
+                continue
+            try:
+                remove_image(entry["image"])
+            except subprocess.CalledProcessError:
+                if image_id(entry["image"]) is not None:
+                    logger.warning("Cannot remove old image %s" % entry["image"])
+                    keep.append(entry)
+        return keep
+
+    def prune(self, remove_all: bool) -> None:
+        with locked(self.index_path + ".lock"):
+            index = load_index(self.index_path)
+            for chroot_name, entry in list(index.items()):
+                retired = entry.get("retired", [])
+                if not remove_all and self._fresh(entry, image_id(chroot_name)):
+                    entry["retired"] = self._remove_retired(retired, time.time())
+                    continue
+                # Pruning was asked for, so the retired ones go too.
+                self._remove_retired(retired, float("inf"))
+                logger.info("Removing %s" % entry["image"])
+                try:
+                    remove_image(entry["image"])
+                except subprocess.CalledProcessError:
+                    logger.warning("Cannot remove image %s" % entry["image"])
+                    continue
+                del index[chroot_name]
+            save_index(self.index_path, index)
+
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(
+        prog="bampkgbuild image-cache",
+        description="List or prune the cached up to date chroot images.",
+    )
+    parser.add_argument("action", choices=["list", "prune"])
+    parser.add_argument(
+        "--image-max-age",
+        default=DEFAULT_MAX_AGE,
+        type=float,
+        help="Hours before a cached image is out of date.",
+    )
+    parser.add_argument(
+        "--all",
+        action="store_true",
+        default=False,
+        help="Prune every cached image, not just out of date ones.",
+    )
+    args = parser.parse_args(argv)
+
+    cache = image_cache(args.image_max_age)
+    if args.action == "list":
+        index = load_index(cache.index_path)
+        for chroot_name, entry in sorted(index.items()):
+            created = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["created"]))
+            fresh = cache._fresh(entry, image_id(chroot_name))
+            state = "fresh" if fresh else "stale"
+            print(f"{chroot_name} {entry['image']} {created} {state}")
+    elif args.action == "prune":
+        cache.prune(args.all)
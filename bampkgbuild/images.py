@@ -0,0 +1,230 @@
+import argparse
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+import stat
+import subprocess
+from typing import Any, Dict, List, Tuple
+
+from bampkgbuild import trace
+from bampkgbuild.cache import cache_dir, load_index, locked, save_index
+from bampkgbuild.docker import check_call, image_id
+from bampkgbuild.scheduler import scheduler
+
+logger = logging.getLogger(__name__)
+
+# architecture: (base repository, platform)
+ARCHITECTURES = {
+    "i386": ("docker.io/i386/debian", "linux/i386"),
+    "amd64": ("docker.io/debian", "linux/amd64"),
+    "source": ("docker.io/debian", "linux/amd64"),
+}
+
+# tag: (distribution, SECURITY, EXPERIMENTAL, also tag <tag>-security)
+DISTRIBUTIONS = {
+    "experimental": ("sid", "none", "libc6", False),
+    "sid": ("sid", "none", "", False),
+    "bookworm": ("bookworm", "bullseye", "", True),
+    "trixie": ("trixie", "bullseye", "", True),
+}
+
+
+class image_build:
+    # One podman build, tagged with every name that wants exactly this
+    # image.
+    def __init__(self, base: str, platform: str, args: Dict[str, str]) -> None:
+        self.base = base
+        self.platform = platform
+        self.args = args
+        self.names: List[str] = []
+
+    def key(self, base_id: str, context_hash: str) -> str:
+        data = {
+            "base": base_id,
+            "platform": self.platform,
+            "args": self.args,
+            "context": context_hash,
+        }
+        return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def matrix() -> List[image_build]:
+    builds: Dict[str, image_build] = {}
+    for tag, (distribution, security, experimental, variant) in DISTRIBUTIONS.items():
+        for architecture, (repository, platform) in ARCHITECTURES.items():
+            base = f"{repository}:{distribution}"
+            args = {
+                "IMAGE": base,
+                "DISTRIBUTION": distribution,
+                "SECURITY": security,
+                "EXPERIMENTAL": experimental,
+            }
+            build_key = json.dumps([base, platform, args], sort_keys=True)
+            build = builds.setdefault(build_key, image_build(base, platform, args))
+            name = f"brianmay/debian-{architecture}:{tag}"
+            build.names.append(name)
+            if variant:
+                build.names.append(name + "-security")
+    return list(builds.values())
+
+
+def context_hash(context_dir: str) -> str:
+    # The Dockerfile and everything under tools/, which is all the build
+    # copies in.
+    h = hashlib.sha256()
+    paths = ["Dockerfile"]
+    for root, dirs, files in os.walk(os.path.join(context_dir, "tools")):
+        dirs.sort()
+        for name in sorted(files):
+            paths.append(os.path.relpath(os.path.join(root, name), context_dir))
+    for path in paths:
+        full_path = os.path.join(context_dir, path)
+        mode = os.stat(full_path).st_mode
+        h.update(b"%s\0%o\0" % (path.encode(), stat.S_IMODE(mode)))
+        with open(full_path, "rb") as f:
+            h.update(hashlib.sha256(f.read()).digest())
+    return h.hexdigest()
+
+
+class image_builder:
+    # Remembers the key every image was last built with, so an image is
+    # only built again when its base image, the build context or its build
+    # args change.
+    def __init__(self, context_dir: str, force: bool = False) -> None:
+        self.context_dir = context_dir
+        self.force = force
+        self.index_path = os.path.join(cache_dir("image-builds"), "index.json")
+        self.context = context_hash(context_dir)
+
+    def pull(self, base: str, platform: str) -> str:
+        with trace.span("image pull", image=base):
+            check_call(["podman", "pull", "--platform", platform, base])
+        base_id = image_id(base)
+        if base_id is None:
+            raise RuntimeError("Cannot find %s after pulling it" % base)
+        return base_id
+
+    def up_to_date(self, build: image_build, key: str) -> bool:
+        if self.force:
+            return False
+        index = load_index(self.index_path)
+        for name in build.names:
+            entry = index.get(name)
+            if entry is None or entry["key"] != key:
+                return False
+            if image_id(name) != entry["id"]:
+                return False
+        return True
+
+    def build(self, build: image_build, base_id: str) -> Dict[str, Any]:
+        key = build.key(base_id, self.context)
+        if self.up_to_date(build, key):
+            logger.info("Up to date: %s" % ", ".join(build.names))
+            return {"names": build.names, "built": False}
+
+        cmd = ["podman", "build", "--force-rm", "--platform", build.platform]
+        if self.force:
+            cmd.append("--no-cache")
+        for arg, value in sorted(build.args.items()):
+            cmd.extend(["--build-arg", f"{arg}={value}"])
+        for name in build.names:
+            cmd.extend(["--tag", name])
+        cmd.append(self.context_dir)
+        with trace.span("image build", image=build.names[0]):
+            check_call(cmd)
+
+        with locked(self.index_path + ".lock"):
+            index = load_index(self.index_path)
+            for name in build.names:
+                index[name] = {"key": key, "id": image_id(name)}
+            save_index(self.index_path, index)
+        return {"names": build.names, "built": True}
+
+
+def build_images(
+    builds: List[image_build], builder: image_builder, jobs: int
+) -> List[Dict[str, Any]]:
+    # Every base image is pulled once, and the builds using it start as
+    # soon as it is there.
+    sched = scheduler(jobs)
+    pulls: Dict[Tuple[str, str], str] = {}
+    names = []
+    for build in builds:
+        pull = (build.base, build.platform)
+        if pull not in pulls:
+
+            def do_pull(pull: Tuple[str, str] = pull) -> str:
+                return builder.pull(*pull)
+
+            pulls[pull] = sched.add("pull:%s:%s" % pull, do_pull)
+
+        def run(build: image_build = build, pull_name: str = pulls[pull]) -> Any:
+            return builder.build(build, sched.result(pull_name))
+
+        names.append(sched.add(f"build:{build.names[0]}", run, [pulls[pull]]))
+    sched.run()
+    return [sched.result(name) for name in names]
+
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(
+        prog="bampkgbuild images",
+        description="Build the chroot images that are out of date.",
+    )
+    parser.add_argument(
+        "--context",
+        default=".",
+        help="Directory with the Dockerfile and tools/.",
+    )
+    parser.add_argument(
+        "--jobs", "-j", type=int, default=4, help="Pulls and builds to run at once."
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        default=False,
+        help="Build every image again, without using cached layers.",
+    )
+    parser.add_argument(
+        "--list",
+        action="store_true",
+        default=False,
+        help="Only list the images that would be built.",
+    )
+    parser.add_argument(
+        "patterns", nargs="*", help="Only images with names matching these globs."
+    )
+    args = parser.parse_args(argv)
+
+    builds = matrix()
+    if args.patterns:
+        builds = [
+            build
+            for build in builds
+            if any(
+                fnmatch.fnmatch(name, pattern)
+                for name in build.names
+                for pattern in args.patterns
+            )
+        ]
+
+    if args.list:
+        for build in builds:
+            print("%s %s: %s" % (build.base, build.platform, " ".join(build.names)))
+        return
+
+    context_dir = os.path.abspath(args.context)
+    if not os.path.exists(os.path.join(context_dir, "Dockerfile")):
+        raise RuntimeError("No Dockerfile in %s" % context_dir)
+
+    builder = image_builder(context_dir, args.force)
+    try:
+        results = build_images(builds, builder, args.jobs)
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError("Image build failed: %s" % e)
+    for result in results:
+        state = "built" if result["built"] else "up to date"
+        for name in result["names"]:
+            print(f"{name} {state}")
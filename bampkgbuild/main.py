@@ -7,15 +7,43 @@ import tempfile
 import shutil
 import subprocess
 import re
+import io
+import hashlib
+import tarfile
 from email.utils import formatdate
 from debian import deb822
 from debian import changelog
-from contextlib import contextmanager
+from contextlib import contextmanager, ExitStack
 import logging.config
-from bampkgbuild.docker import docker
+from bampkgbuild.docker import (
+    EXTRA_REPO_LIST,
+    TMPFS_DIR,
+    docker,
+    docker_container,
+    container_pool,
+    remove_image,
+)
+from bampkgbuild.scheduler import scheduler
+from bampkgbuild import image_cache
+from bampkgbuild import images
+from bampkgbuild import builddep_cache
+from bampkgbuild import result_cache
+from bampkgbuild import batch
+from bampkgbuild.cache import update_hashes
+from bampkgbuild import ccache as ccache_module
+from bampkgbuild.ccache import compiler_cache
+from bampkgbuild import podman_api
+from bampkgbuild import precheck
+from bampkgbuild import repo
+from bampkgbuild import resources as resources_module
+from bampkgbuild.resources import resource_manager
+from bampkgbuild import scan
+from bampkgbuild import staging
+from bampkgbuild.signing import signing_session
+from bampkgbuild.source_cache import source_cache
+from bampkgbuild import trace
 from colorlog import ColoredFormatter
-from typing import List, Optional, Iterator
-
+from typing import Callable, Dict, IO, List, Literal, Optional, Iterator, Tuple
 
 logger = logging.getLogger(__name__)
 
@@ -43,12 +71,14 @@ def setup_logging() -> None:
     root.addHandler(console)
 
 
-def check_call(cmd: List[str]) -> int:
+def check_call(cmd: List[str], cwd: Optional[str] = None) -> int:
     logger.debug(" ".join(cmd))
-    return subprocess.check_call(cmd)
+    return subprocess.check_call(cmd, cwd=cwd)
 
 
-def deb_build_src(src_dir: str, chroot_name: str) -> str:
+def deb_build_src(
+    src_dir: str, chroot_name: str, cache: Optional[source_cache] = None
+) -> str:
     changelog_file = os.path.join(src_dir, "debian/changelog")
     cl = changelog.Changelog(open(changelog_file))
     parent_dir = os.path.join(src_dir, "..")
@@ -66,6 +96,13 @@ def deb_build_src(src_dir: str, chroot_name: str) -> str:
     src_abs = os.path.abspath(src_dir)
     src_name = os.path.basename(src_abs)
 
+    cache_key = None
+    if cache is not None:
+        cache_key = cache.key(src_abs, chroot_name)
+        dsc_path = cache.lookup(cache_key, parent_dir)
+        if dsc_path is not None:
+            return dsc_path
+
     if os.path.isdir(os.path.join(src_abs, ".git")):
         with docker(chroot_name, volume=(parent_abs, "/build")) as chroot:
             chroot.check_call(
@@ -87,43 +124,22 @@ def deb_build_src(src_dir: str, chroot_name: str) -> str:
     version = re.sub(r"^\d+:", "", str(cl.version), 1)
     dsc_file = "%s_%s.dsc" % (cl.package, version)
     dsc_file = os.path.join(parent_dir, dsc_file)
+    if cache is not None and cache_key is not None:
+        cache.store(cache_key, dsc_file)
     return dsc_file
 
 
-def deb_copy_source(tmp_dir: str, dsc_path: str) -> str:
-    src_dir = os.path.dirname(dsc_path)
-    dst_dir = tmp_dir
-    dsc_file = os.path.basename(dsc_path)
-
-    d = deb822.Dsc(open(dsc_path))
-
-    src_path = dsc_path
-    dst_path = os.path.join(dst_dir, dsc_file)
-    shutil.copyfile(src_path, dst_path)
-
-    for f in d["files"]:
-        src_path = os.path.join(src_dir, f["name"])
-        dst_path = os.path.join(dst_dir, f["name"])
-        shutil.copyfile(src_path, dst_path)
-
-    dsc_path = os.path.join(dst_dir, dsc_file)
-    return dsc_path
-
-
-def deb_update_source(
-    tmp_dir: str, dsc_path: str, distribution: str, add_to_version: str
+def deb_copy_source(
+    tmp_dir: str, dsc_path: str, store: Optional[staging.source_store] = None
 ) -> str:
-    dsc_file = os.path.basename(dsc_path)
-    build_dir = os.path.join(tmp_dir, "source")
-
-    with chdir(tmp_dir):
-        check_call(["dpkg-source", "-x", dsc_file, build_dir])
-
-    changelog_file = "debian/changelog"
-    changelog_path = os.path.join(build_dir, changelog_file)
+    if store is not None:
+        return store.copy(dsc_path, tmp_dir)
+    return staging.stage_source(dsc_path, tmp_dir)
 
-    cl = changelog.Changelog(open(changelog_path))
 
+def update_changelog(
+    cl: changelog.Changelog, distribution: str, add_to_version: str
+) -> bool:
     first_block = cl[0]
     version = str(first_block.version)
 
@@ -154,7 +170,135 @@ def deb_update_source(
         cl.add_change("  * Rebuild for %s." % distribution)
         cl.add_change("")
 
-    if write_changelog:
+    return write_changelog
+
+
+def update_control(in_file: IO[bytes], out_file: IO[bytes]) -> None:
+    for d in deb822.Deb822.iter_paragraphs(in_file):
+        d["Bugs"] = "mailto:Brian May <brian@linuxpenguins.xyz>"
+        d.dump(out_file)
+        out_file.write(b"\n")
+
+
+# How full the tmpfs workspace must be for a failed build to be tried
+# again on disk.
+TMPFS_FULL_PERCENT = 95
+
+# The debian.tar is read with "r|*", which takes any of these, and written
+# back compressed the same way.
+DEBIAN_TAR_MODES: Dict[str, Literal["w|gz", "w|bz2", "w|xz"]] = {
+    ".gz": "w|gz",
+    ".bz2": "w|bz2",
+    ".xz": "w|xz",
+}
+
+DSC_CHECKSUMS = [
+    ("Files", "md5sum", "md5"),
+    ("Checksums-Sha1", "sha1", "sha1"),
+    ("Checksums-Sha256", "sha256", "sha256"),
+]
+
+
+def deb_update_debian_tar(
+    tmp_dir: str, dsc_path: str, distribution: str, add_to_version: str
+) -> Optional[str]:
+    # For 3.0 (quilt) sources only debian.tar changes, so rewrite the two
+    # files in it as it streams past, instead of unpacking and repacking
+    # the upstream tarballs as well.
+    with open(dsc_path) as dsc_file:
+        dsc = deb822.Dsc(dsc_file)
+    if dsc.get("Format") != "3.0 (quilt)":
+        return None
+
+    debian_tar = None
+    for entry in dsc["Files"]:
+        m = re.search(r"\.debian\.tar(\.[a-z0-9]+)$", entry["name"])
+        if m is not None and m.group(1) in DEBIAN_TAR_MODES:
+            debian_tar = entry["name"]
+            write_mode = DEBIAN_TAR_MODES[m.group(1)]
+    if debian_tar is None:
+        return None
+
+    cl = None
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+    with open(fd, "wb") as out_f:
+        with tarfile.open(os.path.join(tmp_dir, debian_tar), "r|*") as in_tar:
+            with tarfile.open(fileobj=out_f, mode=write_mode) as out_tar:
+                for member in in_tar:
+                    name = os.path.normpath(member.name)
+                    data = in_tar.extractfile(member) if member.isfile() else None
+                    if data is None or name not in (
+                        "debian/changelog",
+                        "debian/control",
+                    ):
+                        out_tar.addfile(member, data)
+                        continue
+
+                    contents = data.read()
+                    if name == "debian/changelog":
+                        cl = changelog.Changelog(contents)
+                        if update_changelog(cl, distribution, add_to_version):
+                            contents = str(cl).encode()
+                    else:
+                        control = io.BytesIO()
+                        update_control(io.BytesIO(contents), control)
+                        contents = control.getvalue()
+                    member.size = len(contents)
+                    out_tar.addfile(member, io.BytesIO(contents))
+
+    if cl is None:
+        os.remove(tmp_path)
+        return None
+
+    version = re.sub(r"^\d+:", "", str(cl.version), 1)
+    new_debian_tar = "%s_%s%s" % (
+        cl.package,
+        version,
+        debian_tar[debian_tar.index(".debian.tar") :],
+    )
+    os.rename(tmp_path, os.path.join(tmp_dir, new_debian_tar))
+
+    # Only the debian.tar entries change; the orig tarballs are not read.
+    hashes = {key: hashlib.new(algorithm) for _, key, algorithm in DSC_CHECKSUMS}
+    update_hashes(os.path.join(tmp_dir, new_debian_tar), *hashes.values())
+    size = str(os.path.getsize(os.path.join(tmp_dir, new_debian_tar)))
+
+    dsc["Version"] = str(cl.version)
+    for field, key, _ in DSC_CHECKSUMS:
+        if field not in dsc:
+            continue
+        for entry in dsc[field]:
+            if entry["name"] == debian_tar:
+                entry["name"] = new_debian_tar
+                entry["size"] = size
+                entry[key] = hashes[key].hexdigest()
+
+    new_dsc_path = os.path.join(tmp_dir, "%s_%s.dsc" % (cl.package, version))
+    with open(new_dsc_path, "wb") as dsc_out:
+        dsc.dump(dsc_out)
+    return new_dsc_path
+
+
+def deb_update_source(
+    tmp_dir: str, dsc_path: str, distribution: str, add_to_version: str
+) -> str:
+    new_dsc_path = deb_update_debian_tar(
+        tmp_dir, dsc_path, distribution, add_to_version
+    )
+    if new_dsc_path is not None:
+        return new_dsc_path
+
+    dsc_file = os.path.basename(dsc_path)
+    build_dir = os.path.join(tmp_dir, "source")
+
+    check_call(["dpkg-source", "-x", dsc_file, build_dir], cwd=tmp_dir)
+
+    changelog_file = "debian/changelog"
+    changelog_path = os.path.join(build_dir, changelog_file)
+
+    cl = changelog.Changelog(open(changelog_path))
+
+    if update_changelog(cl, distribution, add_to_version):
         cl.write_to_open_file(open(changelog_path, "w"))
 
     control_file = "debian/control"
@@ -165,15 +309,11 @@ def deb_update_source(
 
     with open(control_path, "rb") as in_file:
         with open(control_path_tmp, "wb") as out_file:
-            for d in deb822.Deb822.iter_paragraphs(in_file):
-                d["Bugs"] = "mailto:Brian May <brian@linuxpenguins.xyz>"
-                d.dump(out_file)
-                out_file.write(b"\n")
+            update_control(in_file, out_file)
 
     os.rename(control_path_tmp, control_path)
 
-    with chdir(tmp_dir):
-        check_call(["dpkg-source", "-b", "source"])
+    check_call(["dpkg-source", "-b", "source"], cwd=tmp_dir)
 
     version = re.sub(r"^\d+:", "", str(cl.version), 1)
     dsc_file = "%s_%s.dsc" % (cl.package, version)
@@ -182,21 +322,9 @@ def deb_update_source(
     return dsc_path
 
 
-def deb_build(
-    tmp_dir: str,
-    dsc_path: str,
-    chroot_name: str,
-    distribution: str,
-    architecture: str,
-    arch_any: bool,
-    arch_all: bool,
-    source: bool,
-    extra_repo: Optional[str],
-) -> Optional[str]:
-    dst_dir = os.path.join(tmp_dir, "build", architecture)
-    dsc_path = os.path.abspath(dsc_path)
-    build_dir = os.path.join(dst_dir, "source")
-
+def deb_build_params(
+    distribution: str, arch_any: bool, arch_all: bool, source: bool
+) -> List[str]:
     params = [
         "dpkg-buildpackage",
         "--unsigned-source",
@@ -217,25 +345,22 @@ def deb_build(
         raise RuntimeError("Nothing to build")
 
     params.append("--build=" + ",".join(build))
+    return params
 
-    with docker(chroot_name) as chroot:
-        if extra_repo is not None:
-            name = "/etc/apt/sources.list.d/extra_repo.list"
-            with chroot.create_file(name, user="root") as f:
-                data = "%s\n" % (extra_repo)
-                f.write(data.encode("ASCII"))
 
-        try:
-            chroot.check_call(["mkdir", "-p", dst_dir])
-            chroot.check_call(["dpkg-source", "-x", dsc_path, build_dir], cwd=dst_dir)
-            chroot.check_call(["apt-get", "update", "--yes"], root=True)
-            chroot.check_call(["apt-get", "upgrade", "--yes"], root=True)
-            chroot.check_call(["apt-get", "build-dep", "--yes", build_dir], root=True)
-            chroot.check_call(params, cwd=build_dir)
-        except Exception:
-            chroot.check_call(["bash"], cwd=build_dir, root=True)
-            raise
+def add_extra_repo(chroot: docker_container, extra_repo: Optional[str]) -> None:
+    if extra_repo is not None:
+        data = "%s\n" % (extra_repo)
+        chroot.put_files(
+            os.path.dirname(EXTRA_REPO_LIST),
+            [(os.path.basename(EXTRA_REPO_LIST), data.encode("ASCII"))],
+            user="root",
+        )
+        # apt has not seen the new repository yet.
+        chroot.fresh = False
+
 
+def find_changes(dst_dir: str) -> Optional[str]:
     changes_file = None
     for name in os.listdir(dst_dir):
         if name.endswith(".changes"):
@@ -249,37 +374,239 @@ def deb_build(
     return changes_file
 
 
-def deb_sign(changes_file: str, chroot_name: str) -> None:
-    with docker(chroot_name, gpg=True) as chroot:
+def dpkg_buildpackage(
+    chroot: docker_container,
+    params: List[str],
+    build_dir: str,
+    work_dir: str,
+    ccache: Optional[compiler_cache],
+    resources: Optional[resource_manager],
+) -> None:
+    with ExitStack() as stack:
+        env: Dict[str, str] = {}
+        if resources is not None:
+            env.update(stack.enter_context(resources.share(chroot)))
+        if ccache is not None:
+            ccache.build(chroot, params, build_dir, work_dir, env)
+        else:
+            chroot.check_call(params, cwd=build_dir, env=env)
+
+
+def tmpfs_full(chroot: docker_container) -> bool:
+    # Whether a build that failed in the tmpfs workspace most likely ran out
+    # of space. What it already wrote is still there, so the mount is full.
+    output = chroot.check_output(["df", "-P", TMPFS_DIR])
+    capacity = output.decode().splitlines()[-1].split()[4]
+    return int(capacity.rstrip("%")) >= TMPFS_FULL_PERCENT
+
+
+def deb_build(
+    tmp_dir: str,
+    dsc_path: str,
+    chroot_name: str,
+    distribution: str,
+    architecture: str,
+    arch_any: bool,
+    arch_all: bool,
+    source: bool,
+    extra_repo: Optional[str],
+    interactive: bool = True,
+    builddeps: Optional[builddep_cache.builddep_cache] = None,
+    results: Optional[result_cache.result_cache] = None,
+    ccache: Optional[compiler_cache] = None,
+    tmpfs: Optional[str] = None,
+    resources: Optional[resource_manager] = None,
+) -> Optional[str]:
+    dst_dir = os.path.join(tmp_dir, "build", architecture)
+    dsc_path = os.path.abspath(dsc_path)
+
+    # With tmpfs, the source is unpacked and built in RAM, and only the
+    # files in the .changes are copied to dst_dir.
+    work_dir = dst_dir
+    if tmpfs is not None:
+        work_dir = os.path.join(TMPFS_DIR, architecture)
+    build_dir = os.path.join(work_dir, "source")
+
+    params = deb_build_params(distribution, arch_any, arch_all, source)
+
+    volume = None
+    if ccache is not None:
+        volume = ccache.volume(chroot_name, architecture)
+
+    builder = docker(chroot_name, volume=volume, tmpfs=tmpfs)
+
+    results_key = None
+    if results is not None:
+        results_key = results.key(
+            dsc_path,
+            builder.image,
+            distribution,
+            architecture,
+            arch_any,
+            arch_all,
+            source,
+            extra_repo,
+        )
+        with trace.span("result lookup"):
+            changes_file = results.lookup(results_key, dst_dir)
+        if changes_file is not None:
+            return changes_file
+
+    def unpack(chroot: docker_container) -> None:
+        chroot.check_call(["mkdir", "-p", dst_dir, work_dir])
+        with trace.span("dpkg-source -x"):
+            chroot.check_call(["dpkg-source", "-x", dsc_path, build_dir], cwd=work_dir)
+
+    def build_dep(chroot: docker_container) -> None:
+        with trace.span("build-dep"):
+            chroot.check_call(["apt-get", "build-dep", "--yes", build_dir], root=True)
+
+    def build(chroot: docker_container) -> None:
+        with trace.span("dpkg-buildpackage"):
+            dpkg_buildpackage(chroot, params, build_dir, work_dir, ccache, resources)
+
+    def in_workspace(
+        chroot: docker_container, step: Callable[[docker_container], None]
+    ) -> None:
+        # Runs step, and if it failed as the tmpfs workspace is full, unpacks
+        # again in dst_dir on disk and runs it there.
+        nonlocal work_dir, build_dir
         try:
-            chroot.check_call(["debsign", changes_file])
+            step(chroot)
         except subprocess.CalledProcessError:
-            print("Push any key to try signing again.")
-            sys.stdin.readline()
-            chroot.check_call(["debsign", changes_file])
+            if work_dir == dst_dir or not tmpfs_full(chroot):
+                raise
+            logger.warning("tmpfs full, building %s on disk" % architecture)
+            chroot.check_call(["rm", "-rf", work_dir])
+            work_dir = dst_dir
+            build_dir = os.path.join(work_dir, "source")
+            unpack(chroot)
+            if step is not unpack:
+                step(chroot)
+
+    with ExitStack() as stack:
+        chroot = stack.enter_context(builder)
+        add_extra_repo(chroot, extra_repo)
+
+        # The key is what build-dep would install, so it takes an up to
+        # date container to find out. With a hit, the build moves to a
+        # container from the image that already has it all.
+        builddeps_key = None
+        builddeps_image = None
+        if builddeps is not None:
+            chroot.apt_upgrade()
+            with trace.span("build-dep resolve"):
+                builddeps_key = builddeps.key(chroot, builder.image, dsc_path)
+            if builddeps_key is not None:
+                builddeps_image = builddeps.lookup(builddeps_key)
+            if builddeps_image is not None:
+                stack.close()
+                # Not pooled, nothing else will use this image soon.
+                chroot = stack.enter_context(
+                    docker(
+                        builddeps_image,
+                        volume=volume,
+                        pooled=False,
+                        prepared=True,
+                        tmpfs=tmpfs,
+                    )
+                )
+                add_extra_repo(chroot, extra_repo)
+
+        try:
+            in_workspace(chroot, unpack)
+            chroot.apt_upgrade()
+            in_workspace(chroot, build_dep)
+            if ccache is not None:
+                ccache.install(chroot)
+            if builddeps is not None and builddeps_key is not None:
+                if builddeps_image is None:
+                    with trace.span("build-dep commit"):
+                        builddeps.store(chroot, builder.image, builddeps_key)
+            in_workspace(chroot, build)
+            if work_dir != dst_dir:
+                with trace.span("copy results"):
+                    chroot.check_call(
+                        [
+                            "sh",
+                            "-c",
+                            'dcmd cp "$1"/*.changes "$2"',
+                            "sh",
+                            work_dir,
+                            dst_dir,
+                        ]
+                    )
+        except Exception:
+            if interactive:
+                chroot.check_call(["bash"], cwd=build_dir, root=True, interactive=True)
+            raise
+
+    changes_file = find_changes(dst_dir)
+    if results is not None and results_key is not None and changes_file is not None:
+        results.store(results_key, changes_file)
+    return changes_file
+
+
+def deb_lint_in(chroot: docker_container, changes_file: str) -> None:
+    with trace.span("lint"):
+        _deb_lint_in(chroot, changes_file)
+
+
+def _deb_lint_in(chroot: docker_container, changes_file: str) -> None:
+    chroot.check_call(
+        [
+            "apt-get",
+            "--yes",
+            "-oDpkg::Options::=--force-confold",
+            "install",
+            "lintian",
+        ],
+        root=True,
+    )
+    #    chroot.check_call([
+    #        "apt-get", "--yes", "-t", "experimental",
+    #        "install", "lintian4python"], root=True)
+    chroot.check_call(["lintian", changes_file])
+    #    chroot.check_call(["lintian4py", changes_file])
 
 
 def deb_lint(changes_file: str, chroot_name: str) -> None:
-    with docker(chroot_name) as chroot:
-        chroot.check_call(["apt-get", "update", "--yes"], root=True)
-        chroot.check_call(["apt-get", "upgrade", "--yes"], root=True)
-        chroot.check_call(
-            [
-                "apt-get",
-                "--yes",
-                "-oDpkg::Options::=--force-confold",
-                "install",
-                "lintian",
-            ],
-            root=True,
-        )
-        #        chroot.check_call([
-        #            "apt-get", "--yes", "-t", "experimental",
-        #            "install", "lintian4python"], root=True)
-        chroot.check_call(["lintian", changes_file])
+    # lintian is already in the image, so this leaves the container reusable.
+    with docker(chroot_name, reuse=True) as chroot:
+        chroot.apt_upgrade()
+        deb_lint_in(chroot, changes_file)
 
 
-#        chroot.check_call(["lintian4py", changes_file])
+def deb_test_in(chroot: docker_container, changes_file: str, test_mode: str) -> None:
+    with trace.span("test"):
+        _deb_test_in(chroot, changes_file, test_mode)
+
+
+def _deb_test_in(chroot: docker_container, changes_file: str, test_mode: str) -> None:
+    build_dir = os.path.dirname(changes_file)
+    if test_mode == "manual_no_unpack":
+        chroot.check_call(["bash"], cwd=build_dir, root=True, interactive=True)
+        return
+
+    d = deb822.Changes(open(changes_file))
+
+    debs = []
+    for f in d["files"]:
+        if f["name"].endswith(".deb"):
+            debs.append(os.path.join(build_dir, f["name"]))
+
+    chroot.check_call(["dpkg", "--unpack", "--"] + debs, root=True)
+    chroot.check_call(
+        ["apt-get", "--yes", "-f", "-oDpkg::Options::=--force-confold", "install"],
+        root=True,
+    )
+
+    if test_mode == "auto":
+        pass
+    elif test_mode == "manual":
+        chroot.check_call(["bash"], cwd=build_dir, root=True, interactive=True)
+    else:
+        raise RuntimeError("Unknown test mode %s" % test_mode)
 
 
 def deb_test(
@@ -288,40 +615,148 @@ def deb_test(
     if test_mode == "none":
         return
     elif test_mode == "manual_no_unpack":
-        build_dir = os.path.dirname(changes_file)
         with docker(chroot_name) as chroot:
-            chroot.check_call(["bash"], cwd=build_dir, root=True)
+            deb_test_in(chroot, changes_file, test_mode)
         return
 
-    build_dir = os.path.dirname(changes_file)
-    d = deb822.Changes(open(changes_file))
+    with docker(chroot_name) as chroot:
+        add_extra_repo(chroot, extra_repo)
+        chroot.apt_upgrade()
+        deb_test_in(chroot, changes_file, test_mode)
 
-    debs = []
-    for f in d["files"]:
-        if f["name"].endswith(".deb"):
-            debs.append(os.path.join(build_dir, f["name"]))
 
-    with docker(chroot_name) as chroot:
-        if extra_repo is not None:
-            name = "/etc/apt/sources.list.d/extra_repo.list"
-            with chroot.create_file(name, user="root") as f:
-                data = "%s\n" % (extra_repo)
-                f.write(data.encode("ASCII"))
-
-        chroot.check_call(["apt-get", "update", "--yes"], root=True)
-        chroot.check_call(["apt-get", "upgrade", "--yes"], root=True)
-        chroot.check_call(["dpkg", "--unpack", "--"] + debs, root=True)
-        chroot.check_call(
-            ["apt-get", "--yes", "-f", "-oDpkg::Options::=--force-confold", "install"],
-            root=True,
+def deb_pipeline(
+    tmp_dir: str,
+    dsc_path: str,
+    chroot_name: str,
+    distribution: str,
+    architecture: str,
+    arch_any: bool,
+    arch_all: bool,
+    source: bool,
+    extra_repo: Optional[str],
+    sign: Callable[[str], None],
+    lint: bool,
+    test_mode: str,
+    interactive: bool = True,
+    builddeps: Optional[builddep_cache.builddep_cache] = None,
+    results: Optional[result_cache.result_cache] = None,
+    ccache: Optional[compiler_cache] = None,
+    resources: Optional[resource_manager] = None,
+) -> Optional[str]:
+    # Same as deb_build, deb_lint, deb_test and signing, but apt is only
+    # updated once, unless cached build dependencies are used. The container
+    # is committed after the upgrade, and the test runs in a container
+    # started from that image, so it never sees the build dependencies.
+    dst_dir = os.path.join(tmp_dir, "build", architecture)
+    dsc_path = os.path.abspath(dsc_path)
+    build_dir = os.path.join(dst_dir, "source")
+
+    params = deb_build_params(distribution, arch_any, arch_all, source)
+
+    volume = None
+    if ccache is not None:
+        volume = ccache.volume(chroot_name, architecture)
+
+    builder = docker(chroot_name, volume=volume)
+
+    results_key = None
+    if results is not None:
+        results_key = results.key(
+            dsc_path,
+            builder.image,
+            distribution,
+            architecture,
+            arch_any,
+            arch_all,
+            source,
+            extra_repo,
         )
+        with trace.span("result lookup"):
+            changes_file = results.lookup(results_key, dst_dir)
+        if changes_file is not None:
+            # Nothing to share a container with.
+            if lint:
+                deb_lint(changes_file, chroot_name)
+            deb_test(changes_file, chroot_name, test_mode, extra_repo)
+            sign(changes_file)
+            return changes_file
+
+    with ExitStack() as stack:
+        with ExitStack() as containers:
+            chroot = containers.enter_context(builder)
+            add_extra_repo(chroot, extra_repo)
+
+            try:
+                chroot.check_call(["mkdir", "-p", dst_dir])
+                with trace.span("dpkg-source -x"):
+                    chroot.check_call(
+                        ["dpkg-source", "-x", dsc_path, build_dir], cwd=dst_dir
+                    )
+                chroot.apt_upgrade()
+                with trace.span("checkpoint commit"):
+                    checkpoint = chroot.commit()
+                stack.callback(remove_image, checkpoint)
+
+                # As in deb_build; the test still starts from the checkpoint.
+                builddeps_key = None
+                builddeps_image = None
+                if builddeps is not None:
+                    with trace.span("build-dep resolve"):
+                        builddeps_key = builddeps.key(chroot, builder.image, dsc_path)
+                    if builddeps_key is not None:
+                        builddeps_image = builddeps.lookup(builddeps_key)
+                    if builddeps_image is not None:
+                        containers.close()
+                        chroot = containers.enter_context(
+                            docker(
+                                builddeps_image,
+                                volume=volume,
+                                pooled=False,
+                                prepared=True,
+                            )
+                        )
+                        add_extra_repo(chroot, extra_repo)
+                        chroot.apt_upgrade()
+
+                with trace.span("build-dep"):
+                    chroot.check_call(
+                        ["apt-get", "build-dep", "--yes", build_dir], root=True
+                    )
+                if ccache is not None:
+                    ccache.install(chroot)
+                if builddeps is not None and builddeps_key is not None:
+                    if builddeps_image is None:
+                        with trace.span("build-dep commit"):
+                            builddeps.store(chroot, builder.image, builddeps_key)
+                with trace.span("dpkg-buildpackage"):
+                    dpkg_buildpackage(
+                        chroot, params, build_dir, dst_dir, ccache, resources
+                    )
+            except Exception:
+                if interactive:
+                    chroot.check_call(
+                        ["bash"], cwd=build_dir, root=True, interactive=True
+                    )
+                raise
 
-        if test_mode == "auto":
-            pass
-        elif test_mode == "manual":
-            chroot.check_call(["bash"], cwd=build_dir, root=True)
-        else:
-            raise RuntimeError("Unknown test mode %s" % test_mode)
+            changes_file = find_changes(dst_dir)
+            if changes_file is None:
+                return None
+
+            if results is not None and results_key is not None:
+                results.store(results_key, changes_file)
+
+            if lint:
+                deb_lint_in(chroot, changes_file)
+
+        if test_mode != "none":
+            # Not pooled, a pooled container would stop the image being removed.
+            with docker(checkpoint, pooled=False, prepared=True) as chroot:
+                deb_test_in(chroot, changes_file, test_mode)
+
+    sign(changes_file)
+    return changes_file
 
 
 def deb_test_source_only(changes_file: str, test_mode: str) -> None:
@@ -333,13 +768,19 @@ def deb_test_source_only(changes_file: str, test_mode: str) -> None:
     if test_mode == "auto":
         pass
     elif test_mode in ["manual", "manual_no_unpack"]:
-        with chdir(build_dir):
-            check_call(["bash"])
+        check_call(["bash"], cwd=build_dir)
     else:
         raise RuntimeError("Unknown test mode %s" % test_mode)
 
 
-def deb_upload(server: str, delayed: int, changes_file: str, chroot_name: str, real_distribution: str, upload_distribution: str) -> None:
+def deb_upload(
+    server: str,
+    delayed: int,
+    changes_file: str,
+    chroot_name: str,
+    real_distribution: str,
+    upload_distribution: str,
+) -> None:
     with open(changes_file) as f:
         changes = deb822.Changes(f)
 
@@ -364,13 +805,396 @@ def deb_upload(server: str, delayed: int, changes_file: str, chroot_name: str, r
     assert changes["Distribution"] == upload_distribution
     assert distributions != "UNRELEASED"
 
-    with docker(chroot_name) as chroot:
+    with trace.span("upload"), docker(chroot_name, reuse=True) as chroot:
         if delayed > 0:
             chroot.check_call(["dput", "--delayed=%d" % delayed, server, changes_file])
         else:
             chroot.check_call(["dput", server, changes_file])
 
 
+class build_options:
+    def __init__(
+        self,
+        test_mode: str,
+        interactive: bool,
+        pipeline: bool,
+        upload: bool,
+        delayed: int,
+        builddeps: Optional[builddep_cache.builddep_cache],
+        results: Optional[result_cache.result_cache],
+        store: Optional[staging.source_store],
+        ccache: Optional[compiler_cache],
+        tmpfs: Optional[str],
+        resources: Optional[resource_manager],
+        signer: signing_session,
+    ) -> None:
+        self.test_mode = test_mode
+        self.interactive = interactive
+        self.pipeline = pipeline
+        self.upload = upload
+        self.delayed = delayed
+        self.builddeps = builddeps
+        self.results = results
+        self.store = store
+        self.ccache = ccache
+        self.tmpfs = tmpfs
+        self.resources = resources
+        self.signer = signer
+
+
+def deb_build_arch(
+    tmp_dir: str,
+    dsc_path: str,
+    distribution: str,
+    real_distribution: str,
+    upload_distribution: str,
+    architecture: str,
+    arch_all: bool,
+    source: bool,
+    options: build_options,
+    extra_repo: Optional[str] = None,
+) -> Optional[str]:
+    build_chroot = f"brianmay/debian-{architecture}:{real_distribution}"
+    test_chroot = f"brianmay/debian-{architecture}:{real_distribution}"
+    lint = distribution in ["sid", "experimental"]
+    interactive = options.interactive
+
+    # Signing happens in the background; uploads wait for it. debsign
+    # rewrites the .changes and .dsc, so it only starts once lint and test
+    # are done reading them.
+    def sign(changes_file: str) -> None:
+        options.signer.sign(changes_file, build_chroot)
+
+    if options.pipeline:
+        return deb_pipeline(
+            tmp_dir,
+            dsc_path,
+            build_chroot,
+            upload_distribution,
+            architecture,
+            True,
+            arch_all,
+            source,
+            extra_repo,
+            sign,
+            lint,
+            options.test_mode,
+            interactive=interactive,
+            builddeps=options.builddeps,
+            results=options.results,
+            ccache=options.ccache,
+            resources=options.resources,
+        )
+
+    changes_file = deb_build(
+        tmp_dir,
+        dsc_path,
+        build_chroot,
+        upload_distribution,
+        architecture,
+        True,
+        arch_all,
+        source,
+        extra_repo,
+        interactive=interactive,
+        builddeps=options.builddeps,
+        results=options.results,
+        ccache=options.ccache,
+        tmpfs=options.tmpfs,
+        resources=options.resources,
+    )
+    if changes_file is not None:
+        if lint:
+            deb_lint(changes_file, test_chroot)
+        deb_test(changes_file, test_chroot, options.test_mode, extra_repo)
+        sign(changes_file)
+    return changes_file
+
+
+def deb_build_source_only(
+    tmp_dir: str,
+    dsc_path: str,
+    real_distribution: str,
+    upload_distribution: str,
+    options: build_options,
+    extra_repo: Optional[str] = None,
+) -> Optional[str]:
+    build_chroot = f"brianmay/debian-source:{real_distribution}"
+    changes_file = deb_build(
+        tmp_dir,
+        dsc_path,
+        build_chroot,
+        upload_distribution,
+        "source",
+        False,
+        False,
+        True,
+        extra_repo,
+        interactive=options.interactive,
+        builddeps=options.builddeps,
+        results=options.results,
+    )
+    if changes_file is not None:
+        deb_test_source_only(changes_file, options.test_mode)
+        options.signer.sign(changes_file, build_chroot)
+    return changes_file
+
+
+def plan_distribution(
+    sched: scheduler,
+    tmp_dir: str,
+    dsc_path: str,
+    distribution: str,
+    real_distribution: str,
+    upload_distribution: str,
+    architectures: List[str],
+    source: bool,
+    source_upload: bool,
+    server: str,
+    options: build_options,
+    upload_task: Optional[str],
+    name: str = "",
+    depends: Optional[List[str]] = None,
+    local_repo: Optional[repo.flat_repo] = None,
+) -> Tuple[Optional[str], List[str]]:
+    # Every build in this distribution shares tmp_dir, but writes to its own
+    # build/<architecture> directory, so only the copy has to come first.
+    # With a local_repo, the builds also wait for depends, and what they
+    # build goes into the repository for later builds.
+    extra_repo = None if local_repo is None else local_repo.sources_line()
+    depends = depends or []
+
+    def do_copy() -> str:
+        with trace.tagged(distribution=distribution):
+            with trace.span("deb_copy_source"):
+                return deb_copy_source(tmp_dir, dsc_path, options.store)
+
+    copy_task = sched.add(f"{name}copy:{distribution}", do_copy)
+
+    def get_dsc_path() -> str:
+        return sched.result(copy_task)
+
+    def do_upload(build_task: str, build_chroot: str) -> None:
+        changes_file = sched.result(build_task)
+        if changes_file is not None:
+            options.signer.wait(changes_file)
+            with trace.tagged(distribution=distribution):
+                deb_upload(
+                    server,
+                    options.delayed,
+                    changes_file,
+                    build_chroot,
+                    real_distribution,
+                    upload_distribution,
+                )
+
+    # Uploads are chained, so they still happen in distribution order.
+    def add_upload(build_task: str, build_chroot: str, depends: List[str]) -> str:
+        if upload_task is not None:
+            depends = depends + [upload_task]
+        return sched.add(
+            f"upload:{build_task}",
+            lambda: do_upload(build_task, build_chroot),
+            depends,
+        )
+
+    arch_tasks = []
+    arch_all = True
+    for architecture in architectures:
+
+        def do_build_arch(
+            architecture: str = architecture,
+            arch_all: bool = arch_all,
+            source: bool = source,
+        ) -> Optional[str]:
+            with trace.tagged(distribution=distribution, architecture=architecture):
+                changes_file = deb_build_arch(
+                    tmp_dir,
+                    get_dsc_path(),
+                    distribution,
+                    real_distribution,
+                    upload_distribution,
+                    architecture,
+                    arch_all,
+                    source,
+                    options,
+                    extra_repo,
+                )
+            if local_repo is not None and changes_file is not None:
+                local_repo.add(changes_file)
+            return changes_file
+
+        build_task = sched.add(
+            f"{name}build:{distribution}:{architecture}",
+            do_build_arch,
+            [copy_task] + depends,
+        )
+        arch_tasks.append(build_task)
+
+        if not source_upload and options.upload and source:
+            build_chroot = f"brianmay/debian-{architecture}:{real_distribution}"
+            upload_task = add_upload(build_task, build_chroot, [build_task])
+
+        arch_all = False
+        source = False
+
+    if source_upload:
+
+        def do_build_source_only() -> Optional[str]:
+            with trace.tagged(distribution=distribution, architecture="source"):
+                changes_file = deb_build_source_only(
+                    tmp_dir,
+                    get_dsc_path(),
+                    real_distribution,
+                    upload_distribution,
+                    options,
+                    extra_repo,
+                )
+            if local_repo is not None and changes_file is not None:
+                local_repo.add(changes_file)
+            return changes_file
+
+        build_task = sched.add(
+            f"{name}build:{distribution}:source",
+            do_build_source_only,
+            [copy_task] + depends,
+        )
+
+        if options.upload:
+            build_chroot = f"brianmay/debian-source:{real_distribution}"
+            upload_task = add_upload(
+                build_task, build_chroot, arch_tasks + [build_task]
+            )
+
+    return upload_task, arch_tasks
+
+
+def distribution_names(distribution: str) -> Tuple[str, str]:
+    # The chroot's distribution and the one to upload to.
+    real_distribution = distribution
+    upload_distribution = distribution
+
+    if distribution == "sid":
+        upload_distribution = "unstable"
+
+    if distribution == "oldstable":
+        real_distribution = "bookworm"
+        upload_distribution = "oldstable"
+
+    if distribution == "stable":
+        real_distribution = "trixie"
+        upload_distribution = "stable"
+
+    return real_distribution, upload_distribution
+
+
+def build_chroots(
+    build: List[str], architectures: List[str], source_upload: bool
+) -> List[Tuple[str, str]]:
+    # (distribution, chroot name) of every build plan_package plans.
+    chroots = []
+    for distribution in build:
+        real_distribution, _ = distribution_names(distribution)
+        for architecture in architectures:
+            chroots.append(
+                (distribution, f"brianmay/debian-{architecture}:{real_distribution}")
+            )
+        if source_upload:
+            chroots.append(
+                (distribution, f"brianmay/debian-source:{real_distribution}")
+            )
+    return chroots
+
+
+def check_build_depends(
+    dsc_paths: List[str],
+    build: List[str],
+    architectures: List[str],
+    source_upload: bool,
+    local_repos: Dict[str, repo.flat_repo],
+    batch_built: bool,
+    jobs: int,
+) -> None:
+    # Every build of the run, against the package lists of its chroot, so
+    # a missing build dependency stops the run before anything is built.
+    # Local repositories count, and with batch_built so does everything
+    # the batch builds.
+    extra: Dict[str, List[precheck.package_index]] = {}
+    for distribution, local_repo in local_repos.items():
+        with open(os.path.join(local_repo.dir, "Packages"), "rb") as f:
+            extra[distribution] = [precheck.package_index.parse("all", f.read())]
+    if batch_built:
+        built = precheck.package_index.from_dscs("all", dsc_paths)
+        for distribution in build:
+            extra.setdefault(distribution, []).append(built)
+
+    builds = [
+        (dsc_path, chroot_name, extra.get(distribution, []))
+        for dsc_path in dsc_paths
+        for distribution, chroot_name in build_chroots(
+            build, architectures, source_upload
+        )
+    ]
+    failed = precheck.precheck(builds, jobs)
+    if not failed:
+        return
+    for (dsc_path, chroot_name), missing in sorted(failed.items()):
+        logger.error(
+            "%s on %s: cannot satisfy %s"
+            % (os.path.basename(dsc_path), chroot_name, ", ".join(missing))
+        )
+    raise RuntimeError("Build dependencies cannot be satisfied, see above")
+
+
+def plan_package(
+    sched: scheduler,
+    stack: ExitStack,
+    dsc_path: str,
+    build: List[str],
+    architectures: List[str],
+    source_upload: bool,
+    options: build_options,
+    upload_task: Optional[str],
+    name: str = "",
+    depends: Optional[Dict[str, List[str]]] = None,
+    local_repos: Optional[Dict[str, repo.flat_repo]] = None,
+) -> Tuple[Optional[str], Dict[str, List[str]]]:
+    depends = depends or {}
+    local_repos = local_repos or {}
+    build_tasks = {}
+    source = True
+    for distribution in build:
+        real_distribution, upload_distribution = distribution_names(distribution)
+
+        split = distribution.split("-")
+        server = "ftp-master"
+        if split[-1] == "security":
+            server = "security-master"
+
+        tmp_dir = stack.enter_context(temp_dir())
+        upload_task, build_tasks[distribution] = plan_distribution(
+            sched,
+            tmp_dir,
+            dsc_path,
+            distribution,
+            real_distribution,
+            upload_distribution,
+            architectures,
+            source,
+            source_upload,
+            server,
+            options,
+            upload_task,
+            name,
+            depends.get(distribution, []),
+            local_repos.get(distribution),
+        )
+        if len(architectures) > 0:
+            source = False
+
+    return upload_task, build_tasks
+
+
 @contextmanager
 def temp_dir() -> Iterator[str]:
     tmp_dir = tempfile.mkdtemp()
@@ -392,9 +1216,183 @@ def chdir(directory: str) -> Iterator[str]:
         os.chdir(old_dir)
 
 
+def deb_build_all(args: argparse.Namespace) -> None:
+    if args.working_dir:
+        with trace.span("deb_build_src"):
+            sources = None
+            if args.cache:
+                sources = source_cache()
+            dsc_paths = [
+                deb_build_src(args.working_dir, "brianmay/debian-amd64:sid", sources)
+            ]
+    elif args.batch:
+        dsc_paths = batch.read_manifest(args.batch)
+    else:
+        dsc_paths = [args.dsc_path]
+
+    distros = set(args.distros)
+    if len(distros) == 0:
+        distros.add("debian")
+
+    distributions = set(args.distributions)
+    if len(distributions) == 0:
+        if "debian" in distros:
+            distributions.add("sid")
+
+    architectures = list(args.architectures)
+    if len(architectures) == 0:
+        architectures = ["i386", "amd64"]
+
+    if "debian" in distros:
+        build = []
+        source_upload = True
+        if "bullseye" in distributions:
+            build.append("bullseye")
+            if args.upload:
+                raise RuntimeError("Cannot upload to bullseye")
+        if "bullseye-security" in distributions:
+            source_upload = False
+            build.append("bullseye-security")
+        if "bookworm" in distributions:
+            build.append("bookworm")
+            if args.upload:
+                raise RuntimeError("Cannot upload to bookworm")
+        if "bookworm-security" in distributions:
+            source_upload = False
+            build.append("bookworm-security")
+        if "oldstable" in distributions:
+            build.append("oldstable")
+            source_upload = False
+        if "stable" in distributions:
+            build.append("stable")
+            source_upload = False
+        if "sid" in distributions:
+            build.append("sid")
+        if "experimental" in distributions:
+            build.append("experimental")
+
+        sched = scheduler(args.jobs)
+
+        builddeps = None
+        if args.builddep_cache_size > 0:
+            builddeps = builddep_cache.builddep_cache(args.builddep_cache_size)
+
+        results = None
+        if args.cache and args.cache_size > 0:
+            results = result_cache.result_cache(args.cache_size)
+
+        ccache = None
+        if args.ccache:
+            ccache = compiler_cache(args.ccache_size)
+
+        resources = None
+        if args.limits:
+            memory = None
+            if args.memory is not None:
+                memory = int(args.memory * 1024 * 1024 * 1024)
+            resources = resource_manager(args.cpus, memory, args.tmpfs_build)
+
+        # Not on the stack, it must be done before the temp dirs go.
+        signer = signing_session()
+
+        with ExitStack() as stack:
+            if args.pool:
+                stack.enter_context(container_pool())
+
+            options = build_options(
+                args.test,
+                args.jobs == 1,
+                args.pipeline,
+                args.upload,
+                args.delayed,
+                builddeps,
+                results,
+                stack.enter_context(staging.source_store()),
+                ccache,
+                args.tmpfs_build,
+                resources,
+                signer,
+            )
+
+            local_repos: Dict[str, repo.flat_repo] = {}
+            if args.local_repo:
+                managed = stack.enter_context(repo.managed_repos())
+                for distribution in build:
+                    local_repos[distribution] = stack.enter_context(
+                        managed.open(distribution)
+                    )
+            elif args.batch is not None:
+                for distribution in build:
+                    local_repos[distribution] = stack.enter_context(repo.flat_repo())
+
+            if args.precheck:
+                check_build_depends(
+                    dsc_paths,
+                    build,
+                    architectures,
+                    source_upload,
+                    local_repos,
+                    args.batch is not None,
+                    args.jobs,
+                )
+
+            if args.batch is not None:
+                build_tasks: Dict[str, Dict[str, List[str]]] = {}
+                upload_task: Optional[str] = None
+                for path, source_name, after in batch.build_order(dsc_paths):
+                    upload_task, build_tasks[path] = plan_package(
+                        sched,
+                        stack,
+                        path,
+                        build,
+                        architectures,
+                        source_upload,
+                        options,
+                        upload_task,
+                        name=f"{source_name}:",
+                        depends={
+                            distribution: [
+                                task
+                                for other in after
+                                for task in build_tasks[other][distribution]
+                            ]
+                            for distribution in build
+                        },
+                        local_repos=local_repos,
+                    )
+            else:
+                plan_package(
+                    sched,
+                    stack,
+                    dsc_paths[0],
+                    build,
+                    architectures,
+                    source_upload,
+                    options,
+                    None,
+                    local_repos=local_repos,
+                )
+
+            with signer:
+                sched.run()
+
+    # end if 'debian' in distros:
+
+
+COMMANDS = {
+    "image-cache": image_cache.main,
+    "images": images.main,
+    "scan": scan.main,
+}
+
+
 def main() -> None:
     setup_logging()
 
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        COMMANDS[sys.argv[1]](sys.argv[2:])
+        return
+
     parser = argparse.ArgumentParser(description="Build Debian packages with sbuild.")
 
     group = parser.add_mutually_exclusive_group(required=True)
@@ -402,6 +1400,11 @@ def main() -> None:
     group.add_argument(
         "--working", dest="working_dir", help="Act on tree in working directory."
     )
+    group.add_argument(
+        "--batch",
+        help="Build every dsc listed in this file, each after the ones "
+        "it build depends on, using the earlier results.",
+    )
 
     parser.add_argument(
         "--upload", action="store_true", default=False, help="upload result"
@@ -457,124 +1460,166 @@ def main() -> None:
         help="how to test?",
     )
 
-    args = parser.parse_args()
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        default=1,
+        type=int,
+        help="Number of distribution/architecture builds to run at once.",
+    )
 
-    if args.working_dir:
-        dsc_path = deb_build_src(args.working_dir, "brianmay/debian-amd64:sid")
-    else:
-        dsc_path = args.dsc_path
+    parser.add_argument(
+        "--ccache",
+        action="store_true",
+        default=False,
+        help="Keep a compiler cache for every chroot and architecture.",
+    )
 
-    distros = set(args.distros)
-    if len(distros) == 0:
-        distros.add("debian")
+    parser.add_argument(
+        "--ccache-size",
+        default=ccache_module.DEFAULT_SIZE,
+        type=float,
+        help="GiB to keep in each compiler cache.",
+    )
 
-    distributions = set(args.distributions)
-    if len(distributions) == 0:
-        if "debian" in distros:
-            distributions.add("sid")
+    parser.add_argument(
+        "--no-limits",
+        dest="limits",
+        action="store_false",
+        default=True,
+        help="Do not share CPUs and memory between the builds.",
+    )
 
-    architectures = list(args.architectures)
-    if len(architectures) == 0:
-        architectures = ["i386", "amd64"]
+    parser.add_argument(
+        "--cpus",
+        type=int,
+        help="CPUs to share between the builds, default all of them.",
+    )
 
-    if "debian" in distros:
-        build = []
-        source_upload = True
-        if "bullseye" in distributions:
-            build.append("bullseye")
-            if args.upload:
-                raise RuntimeError("Cannot upload to bullseye")
-        if "bullseye-security" in distributions:
-            source_upload = False
-            build.append("bullseye-security")
-        if "bookworm" in distributions:
-            build.append("bookworm")
-            if args.upload:
-                raise RuntimeError("Cannot upload to bookworm")
-        if "bookworm-security" in distributions:
-            source_upload = False
-            build.append("bookworm-security")
-        if "oldstable" in distributions:
-            build.append("oldstable")
-            source_upload = False
-        if "stable" in distributions:
-            build.append("stable")
-            source_upload = False
-        if "sid" in distributions:
-            build.append("sid")
-        if "experimental" in distributions:
-            build.append("experimental")
+    parser.add_argument(
+        "--memory",
+        type=float,
+        help="GiB of memory the builds may use between them, default %d%% "
+        "of it. Each build reserves its share, and none may use more than all "
+        "of it." % (resources_module.MEMORY_FRACTION * 100),
+    )
 
-        source = True
-        for distribution in build:
-            arch_all = True
-
-            real_distribution = distribution
-            upload_distribution = distribution
-
-            if distribution == "sid":
-                upload_distribution = "unstable"
-
-            if distribution == "oldstable":
-                real_distribution = "bookworm"
-                upload_distribution = "oldstable"
-
-            if distribution == "stable":
-                real_distribution = "trixie"
-                upload_distribution = "stable"
-
-            split = distribution.split("-")
-            server = "ftp-master"
-            if split[-1] == "security":
-                server = "security-master"
-
-            with temp_dir() as tmp_dir:
-                tmp_dsc_path = deb_copy_source(tmp_dir, dsc_path)
-                for architecture in architectures:
-                    build_chroot = f"brianmay/debian-{architecture}:{real_distribution}"
-                    test_chroot = f"brianmay/debian-{architecture}:{real_distribution}"
-                    changes_file = deb_build(
-                        tmp_dir,
-                        tmp_dsc_path,
-                        build_chroot,
-                        upload_distribution,
-                        architecture,
-                        True,
-                        arch_all,
-                        source,
-                        None,
-                    )
-                    if changes_file is not None:
-                        deb_sign(changes_file, build_chroot)
-                        if distribution in ["sid", "experimental"]:
-                            deb_lint(changes_file, test_chroot)
-                        deb_test(changes_file, test_chroot, args.test, None)
-                        if not source_upload and args.upload and source:
-                            deb_upload(server, args.delayed, changes_file, build_chroot, real_distribution, upload_distribution)
-                    arch_all = False
-                    source = False
-
-                if source_upload:
-                    build_chroot = f"brianmay/debian-source:{real_distribution}"
-                    test_chroot = f"brianmay/debian-source:{real_distribution}"
-                    changes_file = deb_build(
-                        tmp_dir,
-                        tmp_dsc_path,
-                        build_chroot,
-                        upload_distribution,
-                        "source",
-                        False,
-                        False,
-                        True,
-                        None,
+    parser.add_argument(
+        "--tmpfs-build",
+        metavar="SIZE",
+        help="Unpack and build in a tmpfs of this size, e.g. 8g, and go back "
+        "to disk if it fills up.",
+    )
+
+    parser.add_argument(
+        "--local-repo",
+        action="store_true",
+        default=False,
+        help="Add every build to a local repository, and build against it.",
+    )
+
+    parser.add_argument(
+        "--no-pool",
+        dest="pool",
+        action="store_false",
+        default=True,
+        help="Start a new container for every step.",
+    )
+
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        default=False,
+        help="Build, lint and test each architecture in one container session.",
+    )
+
+    parser.add_argument(
+        "--image-max-age",
+        default=image_cache.DEFAULT_MAX_AGE,
+        type=float,
+        help="Hours to use an apt upgraded copy of each chroot before "
+        "refreshing it. 0 disables the copies.",
+    )
+
+    parser.add_argument(
+        "--builddep-cache-size",
+        default=builddep_cache.DEFAULT_SIZE,
+        type=float,
+        help="GiB of images with build dependencies installed to keep. "
+        "0 disables them.",
+    )
+
+    parser.add_argument(
+        "--no-precheck",
+        dest="precheck",
+        action="store_false",
+        default=True,
+        help="Do not check that the build dependencies can be satisfied "
+        "before building anything.",
+    )
+
+    parser.add_argument(
+        "--no-cache",
+        dest="cache",
+        action="store_false",
+        default=True,
+        help="Always build, even if an identical build was done before, "
+        "or the --working tree has not changed.",
+    )
+
+    parser.add_argument(
+        "--cache-size",
+        default=result_cache.DEFAULT_SIZE,
+        type=float,
+        help="GiB of earlier build results to keep.",
+    )
+
+    parser.add_argument(
+        "--podman-api",
+        nargs="?",
+        const="",
+        metavar="SOCKET",
+        help="Talk to the podman service on this socket, default the usual "
+        "one, instead of running podman for every container operation.",
+    )
+
+    parser.add_argument(
+        "--trace",
+        help="Write a Chrome trace of the build phases to this file, "
+        "and print a summary.",
+    )
+
+    args = parser.parse_args()
+
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    if args.jobs > 1 and args.test in ["manual", "manual_no_unpack"]:
+        parser.error("--test=%s needs --jobs=1" % args.test)
+
+    if args.tmpfs_build is not None and args.pipeline:
+        parser.error("--tmpfs-build does not work with --pipeline")
+
+    try:
+        with ExitStack() as stack:
+            if args.podman_api is not None:
+                api = podman_api.podman_api(args.podman_api or None)
+                if api.ping():
+                    stack.enter_context(api)
+                else:
+                    logger.warning(
+                        "Cannot reach the podman service on %s, using the CLI"
+                        % api.socket_path
                     )
-                    if changes_file is not None:
-                        deb_sign(changes_file, build_chroot)
-                        deb_test_source_only(changes_file, args.test)
-                        if args.upload:
-                            deb_upload(server, args.delayed, changes_file, build_chroot, real_distribution, upload_distribution)
 
-    # end if 'debian' in distros:
+            if args.image_max_age > 0:
+                stack.enter_context(image_cache.image_cache(args.image_max_age))
+
+            deb_build_all(args)
+    finally:
+        if args.trace is not None:
+            trace.write_chrome_trace(args.trace)
+            print(trace.summary())
 
 
 if __name__ == "__main__":
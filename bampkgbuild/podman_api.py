@@ -0,0 +1,349 @@
+import http.client
+import json
+import logging
+import os
+import select
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import urllib.parse
+from contextlib import contextmanager
+from types import TracebackType
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    Union,
+)
+
+from bampkgbuild import docker
+
+logger = logging.getLogger(__name__)
+
+API_PREFIX = "/v4.0.0/libpod"
+
+# Idle connections kept for reuse.
+POOL_SIZE = 8
+
+# Methods that can be sent again if a kept alive connection turns out to
+# be closed.
+IDEMPOTENT = {"GET", "HEAD", "PUT", "DELETE"}
+
+STDOUT = 1
+STDERR = 2
+
+
+def default_socket() -> str:
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if os.getuid() != 0 and runtime_dir:
+        return os.path.join(runtime_dir, "podman", "podman.sock")
+    return "/run/podman/podman.sock"
+
+
+class unix_connection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str) -> None:
+        super().__init__("localhost")
+        self.socket_path = socket_path
+        self.unix_sock: Optional[socket.socket] = None
+
+    def connect(self) -> None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket_path)
+        # Kept, as http.client lets go of sock once a response says the
+        # connection will close, while the response still reads from it.
+        self.sock = self.unix_sock = sock
+
+
+def _closed(conn: unix_connection) -> bool:
+    # An idle connection has nothing to read, unless the service closed it.
+    if conn.sock is None:
+        return True
+    readable, _, _ = select.select([conn.sock], [], [], 0)
+    return bool(readable)
+
+
+def _read_exact(f: Any, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = f.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+class exec_output:
+    # The stdout of an exec, as a file. stderr goes straight to ours, or to
+    # the stderr callback.
+    def __init__(
+        self,
+        conn: unix_connection,
+        response: http.client.HTTPResponse,
+        stderr: Optional[Callable[[bytes], None]] = None,
+    ) -> None:
+        self.conn = conn
+        self.response = response
+        self.stderr = stderr
+        self.buffer = b""
+        self.done = False
+        self.returncode: Optional[int] = None
+
+    def _frame(self) -> Optional[Tuple[int, bytes]]:
+        # Without a tty, every write is sent as an 8 byte header with the
+        # stream and the size, then the data.
+        header = _read_exact(self.response, 8)
+        if len(header) < 8:
+            self.done = True
+            return None
+        stream, size = struct.unpack(">BxxxL", header)
+        return stream, _read_exact(self.response, size)
+
+    def _next(self) -> Optional[bytes]:
+        while not self.done:
+            frame = self._frame()
+            if frame is None:
+                break
+            stream, data = frame
+            if stream == STDERR:
+                if self.stderr is not None:
+                    self.stderr(data)
+                    continue
+                sys.stderr.buffer.write(data)
+                sys.stderr.buffer.flush()
+                continue
+            return data
+        return None
+
+    def read(self, n: int = -1) -> bytes:
+        while n < 0 or len(self.buffer) < n:
+            data = self._next()
+            if data is None:
+                break
+            self.buffer += data
+        if n < 0:
+            n = len(self.buffer)
+        data, self.buffer = self.buffer[:n], self.buffer[n:]
+        return data
+
+    def abort(self) -> None:
+        # From another thread: whatever is reading sees the end of the
+        # output. The command itself carries on in the container.
+        if self.conn.unix_sock is not None:
+            try:
+                self.conn.unix_sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def copy_to(self, f: IO[bytes]) -> None:
+        # Passes the output on as it arrives, rather than when it is done.
+        if self.buffer:
+            f.write(self.buffer)
+            self.buffer = b""
+        while True:
+            data = self._next()
+            if data is None:
+                break
+            f.write(data)
+            f.flush()
+
+
+class podman_api:
+    # Talks to the podman service (podman system service) over its unix
+    # socket, instead of starting a podman process for every operation.
+    # While in use, docker.py sends container create, start, exec, kill, rm
+    # and file copies here; anything needing a terminal still uses the CLI.
+    #
+    # Errors are raised as CalledProcessError, like a failed podman command.
+    def __init__(self, socket_path: Optional[str] = None) -> None:
+        self.socket_path = socket_path or default_socket()
+        self.lock = threading.Lock()
+        self.idle: List[unix_connection] = []
+
+    def __enter__(self) -> "podman_api":
+        docker.set_backend(self)
+        return self
+
+    def __exit__(
+        self,
+        type: Optional[Type[BaseException]],
+        value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        docker.set_backend(None)
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+    def _get(self) -> Tuple[unix_connection, bool]:
+        # A connection, and whether it was idle in the pool.
+        with self.lock:
+            while self.idle:
+                conn = self.idle.pop()
+                if not _closed(conn):
+                    return conn, True
+                conn.close()
+        return unix_connection(self.socket_path), False
+
+    def _put(self, conn: unix_connection) -> None:
+        with self.lock:
+            if len(self.idle) < POOL_SIZE:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def _send(
+        self,
+        conn: unix_connection,
+        method: str,
+        path: str,
+        body: Union[None, bytes, IO[bytes]],
+        headers: Dict[str, str],
+    ) -> http.client.HTTPResponse:
+        conn.request(method, API_PREFIX + path, body=body, headers=headers)
+        return conn.getresponse()
+
+    def _open(
+        self,
+        method: str,
+        path: str,
+        body: Union[None, Dict[str, Any], bytes, IO[bytes]] = None,
+    ) -> Tuple[unix_connection, http.client.HTTPResponse]:
+        # Sends the request, and returns the connection with the response
+        # to read from it.
+        headers = {}
+        if isinstance(body, dict):
+            body = json.dumps(body).encode()
+            headers["Content-Type"] = "application/json"
+        elif body is not None and not isinstance(body, bytes):
+            headers["Content-Type"] = "application/x-tar"
+
+        conn, pooled = self._get()
+        logger.debug("%s %s" % (method, path))
+        try:
+            return conn, self._send(conn, method, path, body, headers)
+        except ConnectionError as e:
+            # The service can close an idle connection just as it is used.
+            # Only what is safe to send twice is tried again, and a stream
+            # cannot be sent twice.
+            conn.close()
+            resendable = body is None or isinstance(body, bytes)
+            if not pooled or method not in IDEMPOTENT or not resendable:
+                raise
+            logger.debug("Retrying %s %s: %s" % (method, path, e))
+            conn = unix_connection(self.socket_path)
+            try:
+                return conn, self._send(conn, method, path, body, headers)
+            except Exception:
+                conn.close()
+                raise
+        except Exception:
+            conn.close()
+            raise
+
+    @contextmanager
+    def _request(
+        self,
+        method: str,
+        path: str,
+        body: Union[None, Dict[str, Any], bytes, IO[bytes]] = None,
+        reuse: bool = True,
+    ) -> Iterator[http.client.HTTPResponse]:
+        conn, response = self._open(method, path, body)
+        try:
+            yield response
+            response.read()
+        except Exception:
+            conn.close()
+            raise
+        if reuse and not response.will_close:
+            self._put(conn)
+        else:
+            conn.close()
+
+    def _call(
+        self,
+        method: str,
+        path: str,
+        body: Union[None, Dict[str, Any], bytes, IO[bytes]] = None,
+    ) -> Any:
+        with self._request(method, path, body) as response:
+            data = response.read()
+        if response.status >= 300:
+            raise subprocess.CalledProcessError(response.status, [method, path], data)
+        if data and response.getheader("Content-Type", "").startswith(
+            "application/json"
+        ):
+            return json.loads(data)
+        return None
+
+    def ping(self) -> bool:
+        try:
+            self._call("GET", "/_ping")
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.debug("podman API ping failed: %s" % e)
+            return False
+        return True
+
+    def create(self, spec: Dict[str, Any]) -> str:
+        return self._call("POST", "/containers/create", spec)["Id"]
+
+    def start(self, container: str) -> None:
+        self._call("POST", f"/containers/{container}/start")
+
+    def kill(self, container: str) -> None:
+        self._call("POST", f"/containers/{container}/kill")
+
+    def remove(self, container: str) -> None:
+        self._call("DELETE", f"/containers/{container}")
+
+    def put_archive(self, container: str, path: str, data: IO[bytes]) -> None:
+        # Sent chunked as it is read, data can be a pipe.
+        query = urllib.parse.urlencode({"path": path})
+        self._call("PUT", f"/containers/{container}/archive?{query}", data)
+
+    @contextmanager
+    def exec(
+        self,
+        container: str,
+        cmd: List[str],
+        user: str,
+        cwd: Optional[str],
+        env: Dict[str, str],
+        stderr: Optional[Callable[[bytes], None]] = None,
+    ) -> Iterator[exec_output]:
+        config: Dict[str, Any] = {
+            "Cmd": cmd,
+            "User": user,
+            "Env": [f"{key}={value}" for key, value in env.items()],
+            "AttachStdout": True,
+            "AttachStderr": True,
+            "Tty": False,
+        }
+        if cwd is not None:
+            config["WorkingDir"] = cwd
+        exec_id = self._call("POST", f"/containers/{container}/exec", config)["Id"]
+
+        # The connection is taken over by the output, it cannot be reused.
+        start = {"Detach": False, "Tty": False}
+        conn, r = self._open("POST", f"/exec/{exec_id}/start", start)
+        try:
+            if r.status >= 300:
+                raise subprocess.CalledProcessError(r.status, cmd, r.read())
+            output = exec_output(conn, r, stderr)
+            yield output
+            while output._next() is not None:
+                pass
+        finally:
+            r.close()
+            conn.close()
+
+        output.returncode = self._call("GET", f"/exec/{exec_id}/json")["ExitCode"]
@@ -0,0 +1,224 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from debian import deb822
+from debian.debian_support import version_compare
+
+from bampkgbuild import trace
+from bampkgbuild.builddep_cache import BUILD_DEPENDS_FIELDS
+from bampkgbuild.cache import cache_dir, load_pickle, locked, safe_name, save_pickle
+from bampkgbuild.docker import LISTS_DIR, docker, docker_container, image_id
+
+logger = logging.getLogger(__name__)
+
+# Bump when the pickled format changes.
+VERSION = 1
+
+FIELDS = {"Package", "Version", "Architecture", "Multi-Arch", "Provides"}
+
+# (version, architecture, multi-arch) of a package, or of what provides it.
+candidate = Tuple[Optional[str], str, str]
+
+VERSION_OPS = {
+    "<<": lambda c: c < 0,
+    "<=": lambda c: c <= 0,
+    "=": lambda c: c == 0,
+    ">=": lambda c: c >= 0,
+    ">>": lambda c: c > 0,
+}
+
+
+def arch_matches(arch: str, pattern: str) -> bool:
+    # Only the Linux architectures the chroots have.
+    return pattern in (arch, "any", "linux-any", f"any-{arch}", f"linux-{arch}")
+
+
+def wanted_on(relation: "deb822.PkgRelation.ParsedRelation", arch: str) -> bool:
+    # Whether apt-get build-dep looks at this alternative on arch, with no
+    # build profiles active.
+    restrictions = relation.get("arch")
+    if restrictions:
+        enabled = [r.arch for r in restrictions if r.enabled]
+        disabled = [r.arch for r in restrictions if not r.enabled]
+        if enabled and not any(arch_matches(arch, p) for p in enabled):
+            return False
+        if any(arch_matches(arch, p) for p in disabled):
+            return False
+
+    profiles = relation.get("restrictions")
+    if profiles:
+        return any(all(not r.enabled for r in term) for term in profiles)
+    return True
+
+
+class package_index:
+    # The packages apt can install in one chroot, and the virtual packages
+    # they provide. Only the candidate versions, like apt-get build-dep.
+    def __init__(
+        self,
+        arch: str,
+        packages: Dict[str, List[candidate]],
+        provides: Dict[str, List[candidate]],
+    ) -> None:
+        self.arch = arch
+        self.packages = packages
+        self.provides = provides
+
+    @classmethod
+    def parse(cls, arch: str, data: bytes) -> "package_index":
+        # Much faster than deb822 over every paragraph, and only a few fields
+        # are needed.
+        packages: Dict[str, List[candidate]] = {}
+        provides: Dict[str, List[candidate]] = {}
+        for stanza in data.decode("utf-8", "replace").split("\n\n"):
+            fields = {}
+            for line in stanza.splitlines():
+                if not line or line[0] in " \t":
+                    continue
+                key, _, value = line.partition(":")
+                if key in FIELDS:
+                    fields[key] = value.strip()
+            name = fields.get("Package")
+            if name is None:
+                continue
+
+            version = fields.get("Version", "")
+            package_arch = fields.get("Architecture", arch)
+            multi_arch = fields.get("Multi-Arch", "no")
+            packages.setdefault(name, []).append((version, package_arch, multi_arch))
+            if "Provides" in fields:
+                for group in deb822.PkgRelation.parse_relations(fields["Provides"]):
+                    for provided in group:
+                        provided_version = None
+                        if provided["version"] is not None:
+                            provided_version = provided["version"][1]
+                        provides.setdefault(provided["name"], []).append(
+                            (provided_version, package_arch, multi_arch)
+                        )
+        return cls(arch, packages, provides)
+
+    @classmethod
+    def from_dscs(cls, arch: str, dsc_paths: Iterable[str]) -> "package_index":
+        # What a batch is about to build. Nothing is known about the
+        # binaries yet but their names and version, so they are taken to
+        # satisfy any architecture.
+        packages: Dict[str, List[candidate]] = {}
+        for dsc_path in dsc_paths:
+            with open(dsc_path) as f:
+                dsc = deb822.Dsc(f)
+            for binary in dsc.get("Binary", "").split(","):
+                binary = binary.strip()
+                if binary:
+                    packages.setdefault(binary, []).append(
+                        (dsc["Version"], "all", "allowed")
+                    )
+        return cls(arch, packages, {})
+
+    def satisfies(
+        self, relation: "deb822.PkgRelation.ParsedRelation", arch: str
+    ) -> bool:
+        archqual = relation.get("archqual")
+        if archqual not in (None, "any", "native", arch):
+            # A foreign architecture; there are no lists for it here.
+            return True
+
+        version = relation.get("version")
+        name = relation["name"]
+        for cand_version, cand_arch, multi_arch in self.packages.get(
+            name, []
+        ) + self.provides.get(name, []):
+            if archqual == "any":
+                if multi_arch != "allowed":
+                    continue
+            elif cand_arch not in (arch, "all"):
+                continue
+            if version is not None:
+                op, wanted = version
+                if cand_version is None:
+                    # Unversioned provides never satisfy a versioned relation.
+                    continue
+                if not VERSION_OPS[op](version_compare(cand_version, wanted)):
+                    continue
+            return True
+        return False
+
+
+def unsatisfied(dsc_path: str, indexes: List[package_index]) -> List[str]:
+    # The relations in the build depends of dsc_path that nothing in indexes
+    # satisfies, for the architecture of the first.
+    arch = indexes[0].arch
+    with open(dsc_path) as f:
+        dsc = deb822.Dsc(f)
+
+    missing = []
+    for field in BUILD_DEPENDS_FIELDS:
+        value = dsc.get(field)
+        if value is None:
+            continue
+        for group in deb822.PkgRelation.parse_relations(value):
+            alternatives = [r for r in group if wanted_on(r, arch)]
+            if not alternatives:
+                continue
+            if not any(
+                index.satisfies(r, arch) for r in alternatives for index in indexes
+            ):
+                missing.append(deb822.PkgRelation.str([group]))
+    return missing
+
+
+def _index_chroot(chroot: docker_container) -> Optional[package_index]:
+    release = chroot.check_output(
+        ["sh", "-c", f"cat {LISTS_DIR}/*Release 2>/dev/null || true"]
+    )
+    if not release:
+        return None
+    arch = chroot.check_output(["dpkg", "--print-architecture"]).decode().strip()
+    return package_index.parse(arch, chroot.check_output(["apt-cache", "dumpavail"]))
+
+
+def load(chroot_name: str) -> Optional[package_index]:
+    # The lists an image already has, so never an apt-get update: those of
+    # an up to date image from the image cache, or whatever the image was
+    # built with. They are part of the image, so the index is kept for its
+    # image id and needs no container after the first time. None if the
+    # image has no lists.
+    builder = docker(chroot_name, reuse=True)
+    path = os.path.join(cache_dir("precheck"), safe_name(chroot_name) + ".pickle")
+    with locked(path + ".lock"):
+        key = image_id(builder.image)
+        found, index = False, None
+        if key is not None:
+            found, index = load_pickle(path, VERSION, key)
+        if not found:
+            logger.info("Indexing packages for %s" % chroot_name)
+            with builder as chroot:
+                index = _index_chroot(chroot)
+            if key is not None:
+                save_pickle(path, VERSION, key, index)
+        if index is None:
+            logger.info("No package lists in %s, not checking it" % builder.image)
+        return index
+
+
+def precheck(
+    builds: List[Tuple[str, str, List[package_index]]], jobs: int = 1
+) -> Dict[Tuple[str, str], List[str]]:
+    # builds is (dsc path, chroot name, more indexes) for everything about
+    # to be built, the more indexes being e.g. local repositories it will
+    # also use. Returns the unsatisfied relations of every build that has
+    # some.
+    chroot_names = sorted({chroot_name for _, chroot_name, _ in builds})
+    with trace.span("precheck"), ThreadPoolExecutor(jobs) as executor:
+        indexes = dict(zip(chroot_names, executor.map(load, chroot_names)))
+
+    failed = {}
+    for dsc_path, chroot_name, more in builds:
+        index = indexes[chroot_name]
+        if index is None:
+            continue
+        missing = unsatisfied(dsc_path, [index] + more)
+        if missing:
+            failed[(dsc_path, chroot_name)] = missing
+    return failed
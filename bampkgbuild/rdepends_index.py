@@ -0,0 +1,103 @@
+import hashlib
+import io
+import logging
+import os
+import re
+from typing import Dict, Iterable, List, Set
+
+from debian import deb822
+
+from bampkgbuild.builddep_cache import BUILD_DEPENDS_FIELDS
+from bampkgbuild.cache import cache_dir, load_pickle, locked, safe_name, save_pickle
+from bampkgbuild.docker import LISTS_DIR, docker_container
+
+logger = logging.getLogger(__name__)
+
+# Bump when the pickled format changes.
+VERSION = 1
+
+RELATION_NAME = re.compile(r"^\s*([^\s(\[<:]+)")
+
+
+def relation_names(value: str) -> Set[str]:
+    # Package names from a relation field, ignoring versions, architectures,
+    # build profiles and arch qualifiers. Every alternative counts.
+    names = set()
+    for relation in value.split(","):
+        for alternative in relation.split("|"):
+            m = RELATION_NAME.match(alternative)
+            if m is not None:
+                names.add(m.group(1))
+    return names
+
+
+class rdepends_index:
+    # Maps each package name to the source packages that build depend on it,
+    # from the Sources lists of one chroot.
+    def __init__(
+        self, rdepends: Dict[str, List[str]], binaries: Dict[str, List[str]]
+    ) -> None:
+        self.rdepends = rdepends
+        self.binaries = binaries
+
+    @classmethod
+    def parse(cls, sources: bytes) -> "rdepends_index":
+        rdepends: Dict[str, Set[str]] = {}
+        binaries: Dict[str, Set[str]] = {}
+        for src in deb822.Sources.iter_paragraphs(io.BytesIO(sources)):
+            package = src.get("Package")
+            if package is None:
+                continue
+            for binary in src.get("Binary", "").split(","):
+                binary = binary.strip()
+                if binary:
+                    binaries.setdefault(package, set()).add(binary)
+            for field in BUILD_DEPENDS_FIELDS:
+                value = src.get(field)
+                if value is None:
+                    continue
+                for name in relation_names(value):
+                    rdepends.setdefault(name, set()).add(package)
+
+        return cls(
+            {name: sorted(value) for name, value in rdepends.items()},
+            {name: sorted(value) for name, value in binaries.items()},
+        )
+
+    def lookup(self, packages: Iterable[str], recursive: bool = False) -> Set[str]:
+        # With recursive, also the sources that build depend on anything the
+        # sources found so far build, until nothing new turns up.
+        found: Set[str] = set()
+        todo = list(packages)
+        seen = set(todo)
+        while todo:
+            package = todo.pop()
+            for source in self.rdepends.get(package, []):
+                if source in found:
+                    continue
+                found.add(source)
+                if not recursive:
+                    continue
+                for binary in self.binaries.get(source, []):
+                    if binary not in seen:
+                        seen.add(binary)
+                        todo.append(binary)
+        return found
+
+
+def load(chroot: docker_container, chroot_name: str) -> rdepends_index:
+    # The index is rebuilt only when the Release files of the chroot change.
+    release = chroot.check_output(["sh", "-c", f"cat {LISTS_DIR}/*Release"])
+    key = hashlib.sha256(release).hexdigest()
+
+    path = os.path.join(cache_dir("rdepends"), safe_name(chroot_name) + ".pickle")
+    with locked(path + ".lock"):
+        found, index = load_pickle(path, VERSION, key)
+        if found:
+            return index
+
+        logger.info("Indexing build depends for %s" % chroot_name)
+        sources = chroot.check_output(["sh", "-c", f"lz4cat {LISTS_DIR}/*Sources.lz4"])
+        index = rdepends_index.parse(sources)
+        save_pickle(path, VERSION, key, index)
+        return index
@@ -0,0 +1,236 @@
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+from email.utils import formatdate
+from types import TracebackType
+from typing import Any, Dict, List, Optional, Tuple, Type
+
+from debian import deb822
+
+from bampkgbuild.cache import (
+    cache_dir,
+    load_index,
+    locked,
+    safe_name,
+    save_index,
+    update_hashes,
+)
+from bampkgbuild.docker import add_mount, host_path, remove_mount
+from bampkgbuild.scan import deb_control
+from bampkgbuild.staging import clone_file
+
+logger = logging.getLogger(__name__)
+
+# Where managed_repos are mounted in the containers.
+MOUNT_DIR = "/repo"
+
+INDEX_FILES = {"Packages", "Sources", "Release", "index.json", "index.json.lock"}
+
+
+def file_checksums(path: str) -> Dict[str, str]:
+    hashes = {"md5sum": hashlib.md5(), "sha256": hashlib.sha256()}
+    update_hashes(path, *hashes.values())
+    return {key: h.hexdigest() for key, h in hashes.items()}
+
+
+def checksum_field(files: List[Tuple[str, int, str]]) -> str:
+    # The value of a Files, Checksums-Sha256 or SHA256 field, from
+    # (checksum, size, name) of every file.
+    return "".join("\n %s %d %s" % f for f in files)
+
+
+def release_hash(extra_repo: Optional[str]) -> Optional[str]:
+    # The state of a local repository an extra_repo line points at, so what
+    # was built against it can be cached by it.
+    if extra_repo is None:
+        return None
+    m = re.search(r"file://(\S+)", extra_repo)
+    if m is None:
+        return None
+    path = host_path(m.group(1))
+    if path is None:
+        return None
+    try:
+        with open(os.path.join(path, "Release"), "rb") as f:
+            lines = [line for line in f if not line.startswith(b"Date:")]
+    except FileNotFoundError:
+        return None
+    return hashlib.sha256(b"".join(lines)).hexdigest()
+
+
+class flat_repo:
+    # A trusted flat apt repository. Without a path it is temporary and
+    # under /tmp, which the containers can see; otherwise it persists, and
+    # url_path is where the containers see it.
+    #
+    # Adding a .changes only reads the files it lists. Every other entry of
+    # Packages and Sources comes from index.json as it is.
+    def __init__(self, path: Optional[str] = None, url_path: Optional[str] = None):
+        self.path = path
+        self.url_path = url_path
+        self.lock = threading.Lock()
+
+    def __enter__(self) -> "flat_repo":
+        if self.path is None:
+            self.dir = tempfile.mkdtemp()
+            os.chmod(self.dir, 0o755)
+        else:
+            self.dir = self.path
+            os.makedirs(self.dir, exist_ok=True)
+        self.index_path = os.path.join(self.dir, "index.json")
+        self.lock_path = self.index_path + ".lock"
+        if not os.path.exists(os.path.join(self.dir, "Release")):
+            with locked(self.lock_path):
+                self._write_indexes(load_index(self.index_path))
+        return self
+
+    def __exit__(
+        self,
+        type: Optional[Type[BaseException]],
+        value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        if self.path is None:
+            shutil.rmtree(self.dir)
+
+    def sources_line(self) -> str:
+        url_path = self.dir if self.url_path is None else self.url_path
+        return "deb [trusted=yes] file://%s ./" % url_path
+
+    def add(self, changes_file: str) -> None:
+        src_dir = os.path.dirname(changes_file)
+        with open(changes_file) as f:
+            changes = deb822.Changes(f)
+        names = [f["name"] for f in changes["files"]]
+
+        with self.lock, locked(self.lock_path):
+            index = load_index(self.index_path)
+            packages = index.setdefault("packages", {})
+            sources = index.setdefault("sources", {})
+
+            for name in names:
+                if name.endswith(".deb"):
+                    self._copy(src_dir, name)
+                    control = deb_control(os.path.join(self.dir, name))
+                    control["Filename"] = "./" + name
+                    control["Size"] = str(os.path.getsize(os.path.join(self.dir, name)))
+                    checksums = file_checksums(os.path.join(self.dir, name))
+                    control["MD5sum"] = checksums["md5sum"]
+                    control["SHA256"] = checksums["sha256"]
+                    key = "%s %s" % (control["Package"], control["Architecture"])
+                    packages[key] = {"files": [name], "stanza": control.dump()}
+                elif name.endswith(".dsc"):
+                    entry = self._add_source(src_dir, name)
+                    if entry is not None:
+                        sources[entry["source"]] = entry
+
+            self._write_indexes(index)
+            save_index(self.index_path, index)
+            self._remove_unused(index)
+        logger.info("Added %s to %s" % (os.path.basename(changes_file), self.dir))
+
+    def _copy(self, src_dir: str, name: str) -> None:
+        dst_path = os.path.join(self.dir, name)
+        if os.path.exists(dst_path):
+            os.remove(dst_path)
+        clone_file(os.path.join(src_dir, name), dst_path)
+
+    def _add_source(self, src_dir: str, dsc_file: str) -> Optional[Dict[str, Any]]:
+        with open(os.path.join(src_dir, dsc_file)) as f:
+            dsc = deb822.Dsc(f)
+        names = [f["name"] for f in dsc["Files"]]
+        missing = [n for n in names if not os.path.exists(os.path.join(src_dir, n))]
+        if missing:
+            logger.warning("Not adding %s, missing %s" % (dsc_file, missing))
+            return None
+
+        for name in names + [dsc_file]:
+            self._copy(src_dir, name)
+
+        stanza = deb822.Deb822()
+        stanza["Package"] = dsc["Source"]
+        for field, value in dsc.items():
+            if field.lower() not in (
+                "source",
+                "files",
+                "checksums-sha1",
+                "checksums-sha256",
+            ):
+                stanza[field] = value
+        stanza["Directory"] = "."
+
+        files = []
+        sha256 = []
+        for name in names + [dsc_file]:
+            path = os.path.join(self.dir, name)
+            size = os.path.getsize(path)
+            checksums = file_checksums(path)
+            files.append((checksums["md5sum"], size, name))
+            sha256.append((checksums["sha256"], size, name))
+        stanza["Files"] = checksum_field(files)
+        stanza["Checksums-Sha256"] = checksum_field(sha256)
+
+        return {
+            "source": dsc["Source"],
+            "files": names + [dsc_file],
+            "stanza": stanza.dump(),
+        }
+
+    def _write_indexes(self, index: Dict[str, Any]) -> None:
+        sha256 = []
+        contents = {}
+        for name, section in [("Packages", "packages"), ("Sources", "sources")]:
+            entries = index.get(section, {})
+            data = "\n".join(entries[key]["stanza"] for key in sorted(entries))
+            contents[name] = data.encode()
+            sha256.append(
+                (hashlib.sha256(contents[name]).hexdigest(), len(contents[name]), name)
+            )
+        release = deb822.Deb822()
+        release["Date"] = formatdate(usegmt=True)
+        release["SHA256"] = checksum_field(sha256)
+        contents["Release"] = release.dump().encode()
+
+        # Each replaced whole, and Release last, so apt never sees a partial
+        # file or a Release out of step with the rest.
+        for name in ["Packages", "Sources", "Release"]:
+            path = os.path.join(self.dir, name)
+            with open(path + ".tmp", "wb") as f:
+                f.write(contents[name])
+            os.replace(path + ".tmp", path)
+
+    def _remove_unused(self, index: Dict[str, Any]) -> None:
+        # Files of versions that have since been replaced.
+        used = set(INDEX_FILES)
+        for section in ["packages", "sources"]:
+            for entry in index.get(section, {}).values():
+                used.update(entry["files"])
+        for name in os.listdir(self.dir):
+            if name not in used and not name.endswith(".tmp"):
+                os.remove(os.path.join(self.dir, name))
+
+
+class managed_repos:
+    # One persistent repository per distribution under the cache dir,
+    # mounted read only at MOUNT_DIR in every container while this is in
+    # use.
+    def __enter__(self) -> "managed_repos":
+        self.dir = cache_dir("repo")
+        add_mount(self.dir, MOUNT_DIR)
+        return self
+
+    def __exit__(
+        self,
+        type: Optional[Type[BaseException]],
+        value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        remove_mount(self.dir, MOUNT_DIR)
+
+    def open(self, distribution: str) -> flat_repo:
+        name = safe_name(distribution)
+        return flat_repo(os.path.join(self.dir, name), os.path.join(MOUNT_DIR, name))
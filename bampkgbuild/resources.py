@@ -0,0 +1,108 @@
+import logging
+import math
+import os
+import subprocess
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+from bampkgbuild.docker import check_call, docker_container
+
+logger = logging.getLogger(__name__)
+
+# Left for the host and the page cache.
+MEMORY_FRACTION = 0.8
+
+SIZE_SUFFIXES = {"k": 1024, "m": 1024**2, "g": 1024**3, "t": 1024**4}
+
+
+def host_cpus() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def host_memory() -> int:
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def parse_size(size: str) -> int:
+    # Bytes in a podman size, e.g. 8g.
+    size = size.strip().lower().rstrip("b")
+    if size and size[-1] in SIZE_SUFFIXES:
+        return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+    return int(size)
+
+
+class resource_manager:
+    # Shares the CPUs and memory between the builds running at the moment,
+    # and updates the others every time one starts or finishes.
+    #
+    # Memory is only reserved, a soft limit, as a hard one small enough to
+    # share would get a large build OOM killed even with the host idle.
+    # Only with an explicit memory is there a hard limit, and that is all
+    # of it for every build, so it never shrinks under a running one. A
+    # tmpfs workspace is charged to the container, so its size is added to
+    # both.
+    #
+    # A build's parallel=N is fixed when it starts, from the CPU share it
+    # gets then. When other builds finish it gets more CPU, but not more
+    # make jobs.
+    def __init__(
+        self,
+        cpus: Optional[int] = None,
+        memory: Optional[int] = None,
+        tmpfs: Optional[str] = None,
+    ) -> None:
+        self.cpus = host_cpus() if cpus is None else cpus
+        self.limit = memory
+        if memory is None:
+            memory = int(host_memory() * MEMORY_FRACTION)
+        self.memory = memory
+        self.tmpfs = 0 if tmpfs is None else parse_size(tmpfs)
+        self.lock = threading.Lock()
+        self.running: List[str] = []
+        self.can_update = True
+
+    def parallel(self) -> int:
+        return max(1, math.ceil(self.cpus / len(self.running)))
+
+    def _update_params(self) -> List[str]:
+        share = len(self.running)
+        params = [
+            "--cpus",
+            "%.2f" % (self.cpus / share),
+            "--memory-reservation",
+            str(self.memory // share + self.tmpfs),
+        ]
+        if self.limit is not None:
+            params.extend(["--memory", str(self.limit + self.tmpfs)])
+        return params
+
+    def _rebalance(self) -> None:
+        if not self.can_update or not self.running:
+            return
+        params = self._update_params()
+        for container in self.running:
+            try:
+                check_call(["podman", "update"] + params + [container])
+            except subprocess.CalledProcessError:
+                # Too old a podman, or no cgroups v2.
+                logger.warning("Cannot set container limits, only using parallel")
+                self.can_update = False
+                return
+
+    @contextmanager
+    def share(self, chroot: docker_container) -> Iterator[Dict[str, str]]:
+        # The environment for dpkg-buildpackage while it has the share.
+        with self.lock:
+            self.running.append(chroot.container)
+            parallel = self.parallel()
+            self._rebalance()
+        try:
+            yield {"DEB_BUILD_OPTIONS": f"parallel={parallel}"}
+        finally:
+            with self.lock:
+                self.running.remove(chroot.container)
+                self._rebalance()
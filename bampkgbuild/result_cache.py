@@ -0,0 +1,75 @@
+import hashlib
+import os
+import shutil
+from typing import Any, Dict, Optional
+
+from debian import deb822
+
+from bampkgbuild.cache import lru_cache, update_hashes
+from bampkgbuild.docker import image_id
+from bampkgbuild.repo import release_hash
+
+DEFAULT_SIZE = 10.0
+
+
+class result_cache(lru_cache):
+    # The .changes and everything it lists from earlier builds, keyed by
+    # everything that goes into the build.
+    what = "cached build result"
+
+    def __init__(self, budget: float = DEFAULT_SIZE) -> None:
+        super().__init__("results", budget)
+
+    def key(
+        self,
+        dsc_path: str,
+        image: str,
+        distribution: str,
+        architecture: str,
+        arch_any: bool,
+        arch_all: bool,
+        source: bool,
+        extra_repo: Optional[str],
+    ) -> str:
+        # image is what the build runs in, e.g. the copy from the image
+        # cache. The .dsc has the checksums of all its files, which were
+        # verified when it was staged, so hashing it covers them.
+        h = hashlib.sha256()
+        for value in [
+            image_id(image),
+            distribution,
+            architecture,
+            arch_any,
+            arch_all,
+            source,
+            extra_repo,
+            release_hash(extra_repo),
+        ]:
+            h.update(("%s\n" % value).encode())
+
+        update_hashes(dsc_path, h)
+        return h.hexdigest()
+
+    def _name(self, entry: Dict[str, Any]) -> str:
+        return entry["changes"]
+
+    def lookup(self, key: str, dst_dir: str) -> Optional[str]:
+        with self._use(key) as entry:
+            if entry is None:
+                return None
+            src_dir = os.path.join(self.dir, key)
+            os.makedirs(dst_dir, exist_ok=True)
+            for name in os.listdir(src_dir):
+                shutil.copyfile(
+                    os.path.join(src_dir, name), os.path.join(dst_dir, name)
+                )
+        return os.path.join(dst_dir, entry["changes"])
+
+    def store(self, key: str, changes_file: str) -> None:
+        with open(changes_file) as f:
+            changes = deb822.Changes(f)
+        names = [os.path.basename(changes_file)]
+        names.extend(f["name"] for f in changes["files"])
+
+        tmp_dir, size = self._copy_in(os.path.dirname(changes_file), names)
+        self._add(key, {"changes": names[0], "size": size}, tmp_dir)
@@ -0,0 +1,307 @@
+import argparse
+import bz2
+import gzip
+import io
+import json
+import lzma
+import re
+import subprocess
+import sys
+import tarfile
+import threading
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import IO, Any, Dict, Iterator, List, Optional, Pattern, Tuple, Type
+
+from debian import deb822
+
+try:
+    import zstandard  # type: ignore[import-not-found]
+except ImportError:
+    zstandard = None
+
+# What a truncated or corrupt deb raises. It is reported, and the others are
+# still scanned.
+SCAN_ERRORS: Tuple[Type[BaseException], ...] = (
+    tarfile.TarError,
+    EOFError,
+    OSError,
+    lzma.LZMAError,
+    zlib.error,
+    ValueError,
+    RuntimeError,
+)
+if zstandard is not None:
+    SCAN_ERRORS += (zstandard.ZstdError,)
+
+AR_MAGIC = b"!<arch>\n"
+AR_HEADER_SIZE = 60
+CHUNK_SIZE = 1024 * 1024
+
+# How much of the previous chunk is searched again, so matches across a
+# chunk boundary are found. Literals need no more than their own length;
+# regular expressions matching more than this across a boundary are missed.
+REGEX_OVERLAP = 4096
+
+
+class member_reader(io.RawIOBase):
+    # Reads at most size bytes of an ar member, so decompressors never see
+    # the members after it.
+    def __init__(self, f: IO[bytes], size: int) -> None:
+        super().__init__()
+        self.f = f
+        self.left = size
+
+    def read(self, n: int = -1) -> bytes:
+        if n < 0 or n > self.left:
+            n = self.left
+        data = self.f.read(n)
+        self.left -= len(data)
+        return data
+
+    def readinto(self, b: Any) -> int:
+        data = self.read(len(b))
+        b[: len(data)] = data
+        return len(data)
+
+    def readable(self) -> bool:
+        return True
+
+    def close(self) -> None:
+        pass
+
+
+def ar_members(f: IO[bytes]) -> Iterator[Tuple[str, member_reader]]:
+    if f.read(len(AR_MAGIC)) != AR_MAGIC:
+        raise RuntimeError("Not an ar archive")
+    while True:
+        header = f.read(AR_HEADER_SIZE)
+        if len(header) < AR_HEADER_SIZE:
+            return
+        name = header[0:16].decode().strip().rstrip("/")
+        size = int(header[48:58])
+        reader = member_reader(f, size)
+        yield name, reader
+        # Skip whatever the caller did not read, and the padding.
+        while reader.left > 0:
+            reader.read(CHUNK_SIZE)
+        if size % 2 == 1:
+            f.read(1)
+
+
+class zstd_pipe:
+    # zstd(1) for when the zstandard module is not installed.
+    def __init__(self, reader: IO[bytes]) -> None:
+        self.proc = subprocess.Popen(
+            ["zstd", "-dc"], stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        )
+        self.thread = threading.Thread(target=self._feed, args=(reader,))
+        self.thread.start()
+
+    def _feed(self, reader: IO[bytes]) -> None:
+        assert self.proc.stdin is not None
+        try:
+            while True:
+                data = reader.read(CHUNK_SIZE)
+                if not data:
+                    break
+                self.proc.stdin.write(data)
+        except BrokenPipeError:
+            pass
+        finally:
+            self.proc.stdin.close()
+
+    def read(self, n: int = -1) -> bytes:
+        assert self.proc.stdout is not None
+        return self.proc.stdout.read(n)
+
+    def close(self) -> None:
+        assert self.proc.stdout is not None
+        self.proc.stdout.close()
+        self.thread.join()
+        self.proc.wait()
+
+
+def decompress(name: str, reader: member_reader) -> Any:
+    # Buffered, as the decompressors want a binary file.
+    f = io.BufferedReader(reader, CHUNK_SIZE)
+    if name.endswith(".gz"):
+        return gzip.GzipFile(fileobj=f)
+    if name.endswith(".xz"):
+        return lzma.LZMAFile(f)
+    if name.endswith(".bz2"):
+        return bz2.BZ2File(f)
+    if name.endswith(".zst"):
+        if zstandard is not None:
+            return zstandard.ZstdDecompressor().stream_reader(f)
+        return zstd_pipe(f)
+    if name.endswith(".tar"):
+        return f
+    raise RuntimeError("Unknown compression for %s" % name)
+
+
+class searcher:
+    def __init__(self, literals: List[str], regexes: List[str]) -> None:
+        self.literals = [(p, p.encode()) for p in literals]
+        self.regexes: List[Tuple[str, Pattern[bytes]]] = [
+            (p, re.compile(p.encode())) for p in regexes
+        ]
+        overlap = max([len(b) for _, b in self.literals] + [1]) - 1
+        if self.regexes:
+            overlap = max(overlap, REGEX_OVERLAP)
+        self.overlap = overlap
+
+    def patterns(self) -> List[str]:
+        return [p for p, _ in self.literals] + [p for p, _ in self.regexes]
+
+    def search(self, f: IO[bytes], wanted: List[str]) -> List[str]:
+        # Which of the wanted patterns are somewhere in f.
+        found: List[str] = []
+        tail = b""
+        while len(found) < len(wanted):
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            buf = tail + data
+            for p, b in self.literals:
+                if p in wanted and p not in found and b in buf:
+                    found.append(p)
+            for p, r in self.regexes:
+                if p in wanted and p not in found and r.search(buf):
+                    found.append(p)
+            tail = buf[len(buf) - self.overlap :] if self.overlap else b""
+        return found
+
+
+def read_control(name: str, reader: member_reader) -> deb822.Deb822:
+    stream = decompress(name, reader)
+    try:
+        with tarfile.open(fileobj=stream, mode="r|") as tar:
+            for member in tar:
+                if member.name in ("control", "./control"):
+                    control_file = tar.extractfile(member)
+                    assert control_file is not None
+                    return deb822.Deb822(control_file.read())
+    finally:
+        stream.close()
+    raise RuntimeError("No control file in %s" % name)
+
+
+def deb_control(path: str) -> deb822.Deb822:
+    with open(path, "rb") as f:
+        for name, reader in ar_members(f):
+            if name.startswith("control.tar"):
+                return read_control(name, reader)
+    raise RuntimeError("No control.tar in %s" % path)
+
+
+def scan_deb(path: str, s: searcher) -> Dict[str, Any]:
+    result: Dict[str, Any] = {"deb": path, "matches": {}}
+    with open(path, "rb") as f:
+        for name, reader in ar_members(f):
+            if name.startswith("control.tar"):
+                control = read_control(name, reader)
+                result["package"] = control["Package"]
+                result["version"] = control["Version"]
+                source = control.get("Source", control["Package"])
+                result["source"] = source.split(" ")[0]
+
+            elif name.startswith("data.tar"):
+                # The control.tar comes first, so nothing after this is
+                # needed. Returning here also skips reading the rest of
+                # the archive once every pattern is found.
+                stream = decompress(name, reader)
+                wanted = s.patterns()
+                try:
+                    with tarfile.open(fileobj=stream, mode="r|") as tar:
+                        for member in tar:
+                            if not member.isfile():
+                                continue
+                            member_file = tar.extractfile(member)
+                            assert member_file is not None
+                            for p in s.search(member_file, wanted):
+                                result["matches"][p] = member.name
+                                wanted.remove(p)
+                            if not wanted:
+                                return result
+                finally:
+                    stream.close()
+                return result
+    return result
+
+
+def _scan(args: Tuple[str, searcher]) -> Optional[Dict[str, Any]]:
+    path, s = args
+    try:
+        return scan_deb(path, s)
+    except SCAN_ERRORS as e:
+        print("%s: %s" % (path, e), file=sys.stderr, flush=True)
+        return None
+
+
+def scan(
+    debs: List[str], s: searcher, jobs: Optional[int] = None
+) -> Iterator[Optional[Dict[str, Any]]]:
+    # None for every deb that could not be read.
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(_scan, [(deb, s) for deb in debs], chunksize=4)
+
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(
+        prog="bampkgbuild scan",
+        description="Find which packages contain files matching patterns.",
+    )
+    parser.add_argument(
+        "--literal",
+        "-F",
+        action="append",
+        default=[],
+        help="A string to search for.",
+    )
+    parser.add_argument(
+        "--regex",
+        "-E",
+        action="append",
+        default=[],
+        help="A regular expression to search for.",
+    )
+    parser.add_argument(
+        "--jobs", "-j", type=int, default=None, help="Processes, default one per cpu."
+    )
+    parser.add_argument(
+        "--format",
+        choices=["json", "text"],
+        default="json",
+        help="One JSON object per matching deb, or source and pattern pairs.",
+    )
+    parser.add_argument("--output", help="Write output to this file.")
+    parser.add_argument("debs", nargs="+", help="The .deb files to scan.")
+    args = parser.parse_args(argv)
+
+    if not args.literal and not args.regex:
+        parser.error("Nothing to search for")
+
+    s = searcher(args.literal, args.regex)
+    output = sys.stdout if args.output is None else open(args.output, "w")
+    failed = 0
+    try:
+        seen = set()
+        for result in scan(args.debs, s, args.jobs):
+            if result is None:
+                failed += 1
+                continue
+            if not result["matches"]:
+                continue
+            if args.format == "json":
+                print(json.dumps(result, sort_keys=True), file=output, flush=True)
+                continue
+            for p in sorted(result["matches"]):
+                if (result["source"], p) not in seen:
+                    seen.add((result["source"], p))
+                    print("%s %s" % (result["source"], p), file=output, flush=True)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    if failed:
+        sys.exit("%d of %d debs could not be scanned" % (failed, len(args.debs)))
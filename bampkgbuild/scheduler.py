@@ -0,0 +1,78 @@
+import logging
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Sequence, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class task:
+    def __init__(
+        self, name: str, func: Callable[[], Any], depends: Sequence[str]
+    ) -> None:
+        self.name = name
+        self.func = func
+        self.depends = list(depends)
+        self.result: Any = None
+
+
+class scheduler:
+    # Tasks are started in the order they were added, as soon as everything
+    # they depend on has finished. With jobs=1 this is a plain serial run.
+    def __init__(self, jobs: int = 1) -> None:
+        if jobs < 1:
+            raise RuntimeError("Need at least one job")
+        self.jobs = jobs
+        self.tasks: Dict[str, task] = {}
+
+    def add(
+        self, name: str, func: Callable[[], Any], depends: Sequence[str] = ()
+    ) -> str:
+        if name in self.tasks:
+            raise RuntimeError("Duplicate task %s" % name)
+        for depend in depends:
+            if depend not in self.tasks:
+                raise RuntimeError("Task %s depends on unknown %s" % (name, depend))
+        self.tasks[name] = task(name, func, depends)
+        return name
+
+    def result(self, name: str) -> Any:
+        return self.tasks[name].result
+
+    def run(self) -> None:
+        pending = list(self.tasks.values())
+        done: Set[str] = set()
+        running: Dict[Future, task] = {}
+        failed: List[Tuple[task, BaseException]] = []
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while pending or running:
+                if not failed:
+                    for t in list(pending):
+                        if len(running) >= self.jobs:
+                            break
+                        if all(depend in done for depend in t.depends):
+                            pending.remove(t)
+                            logger.info("Starting %s" % t.name)
+                            running[executor.submit(t.func)] = t
+
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    t = running.pop(future)
+                    try:
+                        t.result = future.result()
+                    except Exception as e:
+                        logger.error("Task %s failed: %s" % (t.name, e))
+                        failed.append((t, e))
+                    else:
+                        logger.info("Finished %s" % t.name)
+                        done.add(t.name)
+
+        if failed:
+            raise failed[0][1]
+
+        if pending:
+            names = ", ".join(t.name for t in pending)
+            raise RuntimeError("Tasks never became ready: %s" % names)
@@ -0,0 +1,182 @@
+import logging
+import subprocess
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import ExitStack
+from types import TracebackType
+from typing import Dict, List, Optional, Tuple, Type
+
+from debian import deb822
+
+from bampkgbuild import trace
+from bampkgbuild.docker import docker, docker_container
+
+logger = logging.getLogger(__name__)
+
+# How long to wait for more .changes files before signing what is there.
+BATCH_DELAY = 1.0
+
+# A .changes file to sign, its future, and the trace tags of whoever asked.
+pending_file = Tuple[str, Future, Dict[str, str]]
+
+
+def batch_tags(batch: List[pending_file]) -> Dict[str, str]:
+    # A debsign can sign for several builds at once, so a tag can have
+    # several values, e.g. architecture="amd64,i386".
+    values: Dict[str, List[str]] = {}
+    for _, _, tags in batch:
+        for key, value in tags.items():
+            if value not in values.setdefault(key, []):
+                values[key].append(value)
+    return {key: ",".join(sorted(v)) for key, v in values.items()}
+
+
+class signing_session:
+    # Signs .changes files in the background, in one container with one
+    # gpg-agent. Files that arrive close together are signed by a single
+    # debsign. The first thing signed is a throwaway clearsign with the key
+    # of the first file, so its passphrase is asked for up front and, while
+    # gpg-agent keeps it cached, not again. Prompts wait for the terminal,
+    # see docker._terminal, so they never mix with an interactive shell.
+    #
+    # Nothing here waits for a person; a file that cannot be signed fails
+    # its own future, and wait() raises for it.
+    def __init__(self, batch_delay: float = BATCH_DELAY) -> None:
+        self.batch_delay = batch_delay
+        self.cond = threading.Condition()
+        self.pending: List[pending_file] = []
+        self.futures: Dict[str, Future] = {}
+        self.chroot_name: Optional[str] = None
+        self.closing = False
+
+    def __enter__(self) -> "signing_session":
+        self.thread = threading.Thread(target=self._run, name="signing")
+        self.thread.start()
+        return self
+
+    def __exit__(
+        self,
+        type: Optional[Type[BaseException]],
+        value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        with self.cond:
+            self.closing = True
+            self.cond.notify()
+        self.thread.join()
+
+        failed = [
+            changes_file
+            for changes_file, future in self.futures.items()
+            if future.exception() is not None
+        ]
+        if failed and type is None:
+            raise RuntimeError("Cannot sign %s" % ", ".join(failed))
+
+    def sign(self, changes_file: str, chroot_name: str) -> Future:
+        # The session's container is started from the chroot of the first
+        # file it gets.
+        future: Future = Future()
+        with self.cond:
+            if self.closing:
+                raise RuntimeError("Signing session is closed")
+            if self.chroot_name is None:
+                self.chroot_name = chroot_name
+            self.pending.append((changes_file, future, trace.tags()))
+            self.futures[changes_file] = future
+            self.cond.notify()
+        return future
+
+    def wait(self, changes_file: str) -> None:
+        with self.cond:
+            future = self.futures.get(changes_file)
+        if future is None:
+            raise RuntimeError("%s was never signed" % changes_file)
+        future.result()
+
+    def _next_batch(self) -> Optional[List[pending_file]]:
+        with self.cond:
+            while not self.pending and not self.closing:
+                self.cond.wait()
+            if not self.pending:
+                return None
+            # Give the other builds finishing about now a chance to join.
+            deadline = time.monotonic() + self.batch_delay
+            while not self.closing:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                self.cond.wait(left)
+            batch = self.pending
+            self.pending = []
+            return batch
+
+    def _run(self) -> None:
+        with ExitStack() as stack:
+            chroot = None
+            while True:
+                batch = self._next_batch()
+                if batch is None:
+                    return
+                try:
+                    if chroot is None:
+                        assert self.chroot_name is not None
+                        chroot = stack.enter_context(
+                            docker(self.chroot_name, gpg=True, reuse=True)
+                        )
+                        self._preload(chroot, batch[0][0])
+                    self._sign(chroot, batch)
+                except Exception as e:
+                    for changes_file, future, _ in batch:
+                        if not future.done():
+                            logger.error("Cannot sign %s: %s" % (changes_file, e))
+                            future.set_exception(e)
+
+    def _preload(self, chroot: docker_container, changes_file: str) -> None:
+        # The key debsign picks by default, from the .changes.
+        with open(changes_file) as f:
+            changes = deb822.Changes(f)
+        key_id = changes.get("Changed-By") or changes.get("Maintainer")
+        if key_id is None:
+            return
+        try:
+            chroot.check_call(
+                [
+                    "gpg",
+                    "--yes",
+                    "--local-user",
+                    key_id,
+                    "--clearsign",
+                    "--output",
+                    "/dev/null",
+                    "/dev/null",
+                ],
+                interactive=True,
+            )
+        except subprocess.CalledProcessError as e:
+            # debsign asks for it itself.
+            logger.debug("Cannot preload the passphrase for %s: %s" % (key_id, e))
+
+    def _sign(self, chroot: docker_container, batch: List[pending_file]) -> None:
+        names = [changes_file for changes_file, _, _ in batch]
+        try:
+            with trace.span("sign", files=str(len(names)), **batch_tags(batch)):
+                chroot.check_call(["debsign", "--no-re-sign"] + names, interactive=True)
+        except subprocess.CalledProcessError:
+            # One at a time, to find out which ones failed. What is already
+            # signed is left alone.
+            for changes_file, future, _ in batch:
+                try:
+                    chroot.check_call(
+                        ["debsign", "--no-re-sign", changes_file], interactive=True
+                    )
+                except subprocess.CalledProcessError as e:
+                    logger.error("Cannot sign %s: %s" % (changes_file, e))
+                    future.set_exception(e)
+                else:
+                    future.set_result(None)
+            return
+
+        for _, future, _ in batch:
+            future.set_result(None)
@@ -0,0 +1,172 @@
+import filecmp
+import fnmatch
+import glob
+import hashlib
+import logging
+import os
+import stat
+import subprocess
+from typing import Any, Dict, List, Optional
+
+from debian import changelog, deb822
+
+from bampkgbuild.cache import lru_cache, update_hashes
+from bampkgbuild.docker import image_id
+from bampkgbuild.staging import clone_file
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZE = 2.0
+
+
+def git_output(src_dir: str, args: List[str]) -> bytes:
+    return subprocess.check_output(
+        ["git", "-C", src_dir] + args, stderr=subprocess.DEVNULL
+    )
+
+
+# What dpkg-source -I leaves out of the tarball by default, matched against
+# every component of a path.
+TAR_IGNORE = [
+    "*.a",
+    "*.la",
+    "*.o",
+    "*.so",
+    ".*.sw?",
+    "*~",
+    ",,*",
+    ".[#~]*",
+    ".arch-ids",
+    ".arch-inventory",
+    ".be",
+    ".bzr",
+    ".bzr.backup",
+    ".bzr.tags",
+    ".bzrignore",
+    ".cvsignore",
+    ".deps",
+    ".git",
+    ".gitattributes",
+    ".gitignore",
+    ".gitmodules",
+    ".gbp.conf",
+    ".hg",
+    ".hgignore",
+    ".hgsigs",
+    ".hgtags",
+    ".mailmap",
+    ".mtn-ignore",
+    ".shelf",
+    ".svn",
+    "CVS",
+    "DEADJOE",
+    "RCS",
+    "_MTN",
+    "_darcs",
+    "{arch}",
+]
+
+
+def tar_ignored(name: str) -> bool:
+    return any(
+        fnmatch.fnmatchcase(part, pattern)
+        for part in name.split("/")
+        for pattern in TAR_IGNORE
+    )
+
+
+def hash_git_tree(h: Any, src_dir: str) -> None:
+    # The committed tree, then whatever is not committed yet: changes to
+    # tracked files, and untracked files. Those git ignores are in the
+    # source package all the same, unless dpkg-source ignores them too.
+    h.update(git_output(src_dir, ["rev-parse", "HEAD^{tree}"]))
+    h.update(git_output(src_dir, ["diff", "--binary", "HEAD"]))
+    untracked = git_output(src_dir, ["ls-files", "-z", "--others"])
+    for name in sorted(untracked.split(b"\0")):
+        if name and not tar_ignored(os.fsdecode(name)):
+            h.update(b"%s\0" % name)
+            hash_path(h, os.path.join(src_dir, os.fsdecode(name)))
+
+
+def hash_path(h: Any, path: str) -> None:
+    mode = os.lstat(path).st_mode
+    if stat.S_ISLNK(mode):
+        h.update(b"link %s\0" % os.fsencode(os.readlink(path)))
+    else:
+        h.update(b"%o\0" % stat.S_IMODE(mode))
+        update_hashes(path, h)
+
+
+def hash_tree(h: Any, src_dir: str) -> None:
+    for root, dirs, files in os.walk(src_dir):
+        dirs[:] = sorted(d for d in dirs if d != ".git")
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            h.update(b"%s\0" % os.fsencode(os.path.relpath(path, src_dir)))
+            hash_path(h, path)
+
+
+class source_cache(lru_cache):
+    # The source packages built from working trees, keyed by the state of
+    # the tree, so building from an unchanged tree needs no container.
+    what = "cached source package"
+
+    def __init__(self, budget: float = DEFAULT_SIZE) -> None:
+        super().__init__("sources", budget)
+
+    def key(self, src_dir: str, chroot_name: str) -> str:
+        h = hashlib.sha256()
+        h.update(("%s\n" % image_id(chroot_name)).encode())
+
+        # A git checkout by its tree hash, as hashing every file could take
+        # longer than building. Otherwise, or without git, by every file.
+        tree = None
+        if os.path.isdir(os.path.join(src_dir, ".git")):
+            tree = hashlib.sha256()
+            try:
+                hash_git_tree(tree, src_dir)
+            except (OSError, subprocess.CalledProcessError) as e:
+                logger.debug("Cannot hash %s with git: %s" % (src_dir, e))
+                tree = None
+        if tree is None:
+            tree = hashlib.sha256()
+            hash_tree(tree, src_dir)
+        h.update(tree.digest())
+
+        # The upstream tarballs next to the tree go into the source package
+        # too.
+        with open(os.path.join(src_dir, "debian/changelog")) as f:
+            cl = changelog.Changelog(f, max_blocks=1)
+        pattern = "%s_%s.orig*" % (cl.package, cl.upstream_version)
+        for path in sorted(glob.glob(os.path.join(src_dir, "..", pattern))):
+            h.update(("%s\n" % os.path.basename(path)).encode())
+            update_hashes(path, h)
+        return h.hexdigest()
+
+    def _name(self, entry: Dict[str, Any]) -> str:
+        return entry["dsc"]
+
+    def lookup(self, key: str, dst_dir: str) -> Optional[str]:
+        with self._use(key) as entry:
+            if entry is None:
+                return None
+            src_dir = os.path.join(self.dir, key)
+            for name in os.listdir(src_dir):
+                src_path = os.path.join(src_dir, name)
+                dst_path = os.path.join(dst_dir, name)
+                if os.path.exists(dst_path):
+                    # Such as the upstream tarball the key was made from.
+                    if filecmp.cmp(src_path, dst_path, shallow=False):
+                        continue
+                    os.remove(dst_path)
+                clone_file(src_path, dst_path)
+        return os.path.join(dst_dir, entry["dsc"])
+
+    def store(self, key: str, dsc_path: str) -> None:
+        with open(dsc_path) as f:
+            dsc = deb822.Dsc(f)
+        names = [os.path.basename(dsc_path)]
+        names.extend(f["name"] for f in dsc["files"])
+
+        tmp_dir, size = self._copy_in(os.path.dirname(dsc_path), names)
+        self._add(key, {"dsc": names[0], "size": size}, tmp_dir)
@@ -0,0 +1,150 @@
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from types import TracebackType
+from typing import Dict, List, Optional, Tuple, Type
+
+from debian import deb822
+
+from bampkgbuild.cache import hash_file, update_hashes
+
+logger = logging.getLogger(__name__)
+
+# From linux/fs.h.
+FICLONE = 0x40049409
+
+# Errors that mean this way of linking is not possible here, rather than
+# that something is wrong with the files.
+LINK_ERRORS = {
+    errno.EXDEV,
+    errno.EPERM,
+    errno.EMLINK,
+    errno.ENOTSUP,
+    errno.EOPNOTSUPP,
+    errno.ENOTTY,
+    errno.EINVAL,
+    errno.EBADF,
+}
+
+
+def reflink(src_path: str, dst_path: str) -> None:
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def clone_file(src_path: str, dst_path: str) -> str:
+    # Cheapest first: a copy on write reflink, then a hardlink, then a copy.
+    # Nothing ever writes to staged files, so sharing blocks is safe.
+    try:
+        reflink(src_path, dst_path)
+        return "reflink"
+    except OSError as e:
+        if os.path.exists(dst_path):
+            os.remove(dst_path)
+        if e.errno not in LINK_ERRORS:
+            raise
+
+    try:
+        os.link(src_path, dst_path)
+        return "hardlink"
+    except OSError as e:
+        if e.errno not in LINK_ERRORS:
+            raise
+
+    shutil.copyfile(src_path, dst_path)
+    return "copy"
+
+
+def checksums(dsc: deb822.Dsc) -> List[Tuple[str, str, str]]:
+    # (name, algorithm, checksum) for every file the .dsc lists.
+    if "Checksums-Sha256" in dsc:
+        return [(f["name"], "sha256", f["sha256"]) for f in dsc["Checksums-Sha256"]]
+    return [(f["name"], "md5", f["md5sum"]) for f in dsc["Files"]]
+
+
+def copy_verified(src_path: str, dst_path: str, algorithm: str, expected: str) -> str:
+    # Links cost nothing to make, so the checksum is read back from the
+    # result; a copy is checked as it is written. Either way every byte is
+    # read once.
+    h = hashlib.new(algorithm)
+    method = clone_file(src_path, dst_path)
+    if method == "copy":
+        os.remove(dst_path)
+        with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+            while True:
+                data = src.read(1024 * 1024)
+                if not data:
+                    break
+                h.update(data)
+                dst.write(data)
+    else:
+        update_hashes(dst_path, h)
+
+    if h.hexdigest() != expected:
+        os.remove(dst_path)
+        raise RuntimeError(
+            "%s checksum mismatch for %s" % (algorithm, os.path.basename(src_path))
+        )
+    return method
+
+
+def stage_source(dsc_path: str, dst_dir: str) -> str:
+    src_dir = os.path.dirname(dsc_path)
+    dsc_file = os.path.basename(dsc_path)
+    with open(dsc_path) as f:
+        dsc = deb822.Dsc(f)
+
+    clone_file(dsc_path, os.path.join(dst_dir, dsc_file))
+    for name, algorithm, expected in checksums(dsc):
+        method = copy_verified(
+            os.path.join(src_dir, name),
+            os.path.join(dst_dir, name),
+            algorithm,
+            expected,
+        )
+        logger.debug("Staged %s by %s" % (name, method))
+    return os.path.join(dst_dir, dsc_file)
+
+
+class source_store:
+    # One verified copy of each source package for the whole run. Every
+    # distribution links its own tmp_dir to it, instead of copying the
+    # source again.
+    def __init__(self, base_dir: Optional[str] = None) -> None:
+        self.base_dir = base_dir
+        self.lock = threading.Lock()
+        self.staged: Dict[str, str] = {}
+
+    def __enter__(self) -> "source_store":
+        self.dir = tempfile.mkdtemp(dir=self.base_dir)
+        return self
+
+    def __exit__(
+        self,
+        type: Optional[Type[BaseException]],
+        value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        shutil.rmtree(self.dir)
+
+    def _stage(self, dsc_path: str) -> str:
+        key = hash_file(dsc_path)
+
+        with self.lock:
+            if key not in self.staged:
+                dst_dir = os.path.join(self.dir, key)
+                os.mkdir(dst_dir)
+                self.staged[key] = stage_source(dsc_path, dst_dir)
+            return self.staged[key]
+
+    def copy(self, dsc_path: str, dst_dir: str) -> str:
+        staged_path = self._stage(dsc_path)
+        src_dir = os.path.dirname(staged_path)
+        for name in os.listdir(src_dir):
+            clone_file(os.path.join(src_dir, name), os.path.join(dst_dir, name))
+        return os.path.join(dst_dir, os.path.basename(dsc_path))
@@ -0,0 +1,93 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List
+
+# Tags added to every span started in this context, e.g. the distribution
+# and architecture of the build a scheduler task is working on.
+_tags: contextvars.ContextVar[Dict[str, str]] = contextvars.ContextVar(
+    "trace_tags", default={}
+)
+
+_lock = threading.Lock()
+_spans: List[Dict[str, Any]] = []
+_start = time.perf_counter()
+
+
+@contextmanager
+def tagged(**tags: str) -> Iterator[None]:
+    token = _tags.set({**_tags.get(), **tags})
+    try:
+        yield
+    finally:
+        _tags.reset(token)
+
+
+def tags() -> Dict[str, str]:
+    # The tags of this context, to start spans with them in another thread.
+    return dict(_tags.get())
+
+
+@contextmanager
+def span(name: str, **tags: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        with _lock:
+            _spans.append(
+                {
+                    "name": name,
+                    "start": start - _start,
+                    "duration": end - start,
+                    "thread": threading.get_ident(),
+                    "tags": {**_tags.get(), **tags},
+                }
+            )
+
+
+def write_chrome_trace(path: str) -> None:
+    with _lock:
+        spans = list(_spans)
+
+    threads: Dict[int, int] = {}
+    events = []
+    for s in spans:
+        tid = threads.setdefault(s["thread"], len(threads) + 1)
+        events.append(
+            {
+                "name": s["name"],
+                "cat": "bampkgbuild",
+                "ph": "X",
+                "ts": int(s["start"] * 1000000),
+                "dur": int(s["duration"] * 1000000),
+                "pid": os.getpid(),
+                "tid": tid,
+                "args": s["tags"],
+            }
+        )
+
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def summary() -> str:
+    with _lock:
+        spans = list(_spans)
+
+    totals: Dict[str, List[float]] = {}
+    for s in spans:
+        totals.setdefault(s["name"], []).append(s["duration"])
+
+    lines = ["%-24s %6s %10s %10s %10s" % ("phase", "count", "total", "mean", "max")]
+    for name, durations in sorted(totals.items(), key=lambda item: -sum(item[1])):
+        total = sum(durations)
+        lines.append(
+            "%-24s %6d %9.1fs %9.1fs %9.1fs"
+            % (name, len(durations), total, total / len(durations), max(durations))
+        )
+    return "\n".join(lines)
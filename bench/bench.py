@@ -0,0 +1,339 @@
+#!/usr/bin/python3
+# Offline benchmarks of bampkgbuild's own overhead.
+#
+# fake_podman.py is put on PATH as podman and docker, so nothing is built or
+# downloaded; what is measured is the number of container operations
+# bampkgbuild issues and how long it takes to issue them with the given
+# latencies, across matrix sizes and package counts.
+import argparse
+import collections
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TOP = os.path.dirname(HERE)
+sys.path.insert(0, TOP)
+
+DISTRIBUTIONS = ["sid", "experimental", "bookworm", "stable"]
+
+DEFAULT_LATENCY = {
+    "create": 0.05,
+    "start": 0.1,
+    "exec": 0.02,
+    "cp": 0.02,
+    "kill": 0.05,
+    "rm": 0.02,
+    "commit": 0.2,
+    "exec:apt-get": 0.05,
+    "exec:dpkg-buildpackage": 0.5,
+}
+
+MAIN_VARIANTS = {
+    "serial": [
+        "--jobs=1",
+        "--no-pool",
+        "--no-cache",
+        "--image-max-age=0",
+        "--builddep-cache-size=0",
+    ],
+    "parallel": [
+        "--jobs=8",
+        "--no-pool",
+        "--no-cache",
+        "--image-max-age=0",
+        "--builddep-cache-size=0",
+    ],
+    "pool": ["--jobs=8", "--no-cache", "--image-max-age=0", "--builddep-cache-size=0"],
+    "pipeline": [
+        "--jobs=8",
+        "--pipeline",
+        "--no-cache",
+        "--image-max-age=0",
+        "--builddep-cache-size=0",
+    ],
+    "default": ["--jobs=8"],
+    "api": ["--jobs=8", "--podman-api={api_socket}"],
+}
+
+DSC = """Format: 3.0 (quilt)
+Source: hello
+Binary: hello
+Architecture: any
+Version: 2.10-3
+Build-Depends: debhelper-compat (= 13)
+"""
+
+
+class fake_env:
+    def __init__(self, latency: Dict[str, float]) -> None:
+        self.latency = latency
+
+    def __enter__(self) -> "fake_env":
+        self.tmp = tempfile.TemporaryDirectory(prefix="bampkgbuild-bench-")
+        root = self.tmp.name
+        bin_dir = os.path.join(root, "bin")
+        os.makedirs(bin_dir)
+        for name in ["podman", "docker"]:
+            os.symlink(
+                os.path.join(HERE, "fake_podman.py"), os.path.join(bin_dir, name)
+            )
+        os.makedirs(os.path.join(root, "gpg"))
+
+        self.log = os.path.join(root, "log")
+        self.saved = dict(os.environ)
+        os.environ.update(
+            {
+                "PATH": bin_dir + os.pathsep + os.environ["PATH"],
+                "PYTHONPATH": TOP,
+                "FAKE_PODMAN_STATE": os.path.join(root, "state"),
+                "FAKE_PODMAN_LOG": self.log,
+                "FAKE_PODMAN_LATENCY": json.dumps(self.latency),
+                "GNUPGHOME": os.path.join(root, "gpg"),
+            }
+        )
+        self.new_cache()
+
+        self.api_socket = os.path.join(root, "podman.sock")
+        self.api = subprocess.Popen(
+            [sys.executable, os.path.join(HERE, "fake_podman_api.py"), self.api_socket]
+        )
+        while not os.path.exists(self.api_socket):
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, type: str, value: str, traceback: str) -> None:
+        self.api.terminate()
+        self.api.wait()
+        os.environ.clear()
+        os.environ.update(self.saved)
+        self.tmp.cleanup()
+
+    def new_cache(self) -> None:
+        os.environ["XDG_CACHE_HOME"] = tempfile.mkdtemp(dir=self.tmp.name)
+
+    def make_dsc(self) -> str:
+        src_dir = tempfile.mkdtemp(dir=self.tmp.name)
+        files = []
+        sha256 = []
+        for name in ["hello_2.10.orig.tar.gz", "hello_2.10-3.debian.tar.xz"]:
+            data = b"fake\n"
+            with open(os.path.join(src_dir, name), "wb") as f:
+                f.write(data)
+            files.append(" %s %d %s" % (hashlib.md5(data).hexdigest(), len(data), name))
+            sha256.append(
+                " %s %d %s" % (hashlib.sha256(data).hexdigest(), len(data), name)
+            )
+        with open(os.path.join(src_dir, "hello_2.10-3.dsc"), "w") as f:
+            f.write(DSC)
+            f.write("Checksums-Sha256:\n%s\n" % "\n".join(sha256))
+            f.write("Files:\n%s\n" % "\n".join(files))
+        return os.path.join(src_dir, "hello_2.10-3.dsc")
+
+    @contextmanager
+    def measure(self, results: List[Dict[str, Any]], **info: Any) -> Iterator[None]:
+        if os.path.exists(self.log):
+            os.remove(self.log)
+        start = time.perf_counter()
+        yield
+        wall = time.perf_counter() - start
+
+        ops: collections.Counter = collections.Counter()
+        if os.path.exists(self.log):
+            with open(self.log) as f:
+                for line in f:
+                    ops[json.loads(line)["op"]] += 1
+        result = {**info, "wall": wall, "ops": dict(ops)}
+        results.append(result)
+        print(format_result(result), flush=True)
+
+
+def format_result(result: Dict[str, Any]) -> str:
+    ops = result["ops"]
+    return (
+        "%-16s %-10s %5s %8.2fs %5d ops  create=%-3d exec=%-4d cp=%-3d commit=%-3d"
+        % (
+            result["scenario"],
+            result["variant"],
+            result["size"],
+            result["wall"],
+            sum(ops.values()),
+            ops.get("create", 0),
+            ops.get("exec", 0),
+            ops.get("cp", 0),
+            ops.get("commit", 0),
+        )
+    )
+
+
+def run(cmd: List[str], cwd: str) -> None:
+    subprocess.run(
+        cmd, cwd=cwd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+
+def bench_docker(
+    env: fake_env, results: List[Dict[str, Any]], sizes: List[int]
+) -> None:
+    from bampkgbuild.docker import container_pool, docker
+
+    def uses(n: int) -> None:
+        for _ in range(n):
+            with docker("brianmay/debian-amd64:sid", reuse=True) as chroot:
+                chroot.check_call(["true"])
+
+    for n in sizes:
+        with env.measure(results, scenario="docker", variant="plain", size=n):
+            uses(n)
+        with env.measure(results, scenario="docker", variant="pool", size=n):
+            with container_pool():
+                uses(n)
+
+
+def bench_deb_build(
+    env: fake_env, results: List[Dict[str, Any]], sizes: List[int]
+) -> None:
+    from bampkgbuild.main import deb_build, deb_copy_source, deb_test
+
+    for n in sizes:
+        changes_files = []
+        with env.measure(results, scenario="deb_build", variant="plain", size=n):
+            for _ in range(n):
+                tmp_dir = tempfile.mkdtemp(dir="/tmp")
+                dsc_path = deb_copy_source(tmp_dir, env.make_dsc())
+                changes_file = deb_build(
+                    tmp_dir,
+                    dsc_path,
+                    "brianmay/debian-amd64:sid",
+                    "unstable",
+                    "amd64",
+                    True,
+                    True,
+                    True,
+                    None,
+                    interactive=False,
+                )
+                assert changes_file is not None
+                changes_files.append(changes_file)
+
+        with env.measure(results, scenario="deb_test", variant="plain", size=n):
+            for changes_file in changes_files:
+                deb_test(changes_file, "brianmay/debian-amd64:sid", "auto", None)
+
+
+def bench_main(
+    env: fake_env,
+    results: List[Dict[str, Any]],
+    sizes: List[int],
+    variants: List[str],
+) -> None:
+    dsc_path = env.make_dsc()
+    for n in sizes:
+        distributions = []
+        for distribution in DISTRIBUTIONS[:n]:
+            distributions.extend(["--distributions", distribution])
+        for variant in variants:
+            env.new_cache()
+            cmd = [sys.executable, "-m", "bampkgbuild.main", "--dsc", dsc_path]
+            cmd.extend(distributions)
+            cmd.extend(["--architectures", "i386", "--architectures", "amd64"])
+            cmd.extend(
+                arg.format(api_socket=env.api_socket) for arg in MAIN_VARIANTS[variant]
+            )
+            with env.measure(results, scenario="main", variant=variant, size=n):
+                run(cmd, TOP)
+
+
+def bench_script(
+    env: fake_env,
+    results: List[Dict[str, Any]],
+    sizes: List[int],
+    script: str,
+    extra: List[str],
+) -> None:
+    for n in sizes:
+        env.new_cache()
+        work_dir = tempfile.mkdtemp(dir=env.tmp.name)
+        packages = ["package%d" % i for i in range(n)]
+        cmd = [sys.executable, os.path.join(TOP, script)]
+        cmd.extend(["--distribution", "sid", "--architecture", "amd64"])
+        cmd.extend(extra)
+        cmd.extend(packages)
+        with env.measure(results, scenario=script, variant="default", size=n):
+            run(cmd, work_dir)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmark bampkgbuild against a fake podman."
+    )
+    parser.add_argument(
+        "--scenario",
+        choices=["docker", "deb_build", "main", "download", "build_rdepends"],
+        action="append",
+        default=[],
+        help="What to benchmark, default everything.",
+    )
+    parser.add_argument(
+        "--variant",
+        choices=sorted(MAIN_VARIANTS),
+        action="append",
+        default=[],
+        help="Which main() options to compare, default all of them.",
+    )
+    parser.add_argument(
+        "--latency",
+        action="append",
+        default=[],
+        metavar="OP=SECONDS",
+        help="Override the latency of a fake podman operation, "
+        "e.g. create=0.5 or exec:dpkg-buildpackage=2.",
+    )
+    parser.add_argument(
+        "--quick", action="store_true", default=False, help="Only the smallest sizes."
+    )
+    parser.add_argument("--json", help="Also write the results to this file.")
+    args = parser.parse_args()
+
+    latency = dict(DEFAULT_LATENCY)
+    for value in args.latency:
+        op, _, seconds = value.partition("=")
+        latency[op] = float(seconds)
+
+    scenarios = args.scenario or [
+        "docker",
+        "deb_build",
+        "main",
+        "download",
+        "build_rdepends",
+    ]
+    variants = args.variant or list(MAIN_VARIANTS)
+    matrix_sizes = [1, 2] if args.quick else [1, 2, 3, 4]
+    counts = [1, 10] if args.quick else [1, 10, 50, 200]
+
+    results: List[Dict[str, Any]] = []
+    with fake_env(latency) as env:
+        if "docker" in scenarios:
+            bench_docker(env, results, [1, 10] if args.quick else [1, 10, 50])
+        if "deb_build" in scenarios:
+            bench_deb_build(env, results, [1, 4] if args.quick else [1, 4, 8])
+        if "main" in scenarios:
+            bench_main(env, results, matrix_sizes, variants)
+        if "download" in scenarios:
+            bench_script(env, results, counts, "download", ["--download", "binaries"])
+        if "build_rdepends" in scenarios:
+            bench_script(env, results, counts, "build_rdepends", [])
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump({"latency": latency, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+#!/usr/bin/python3
+# A stand-in for podman/docker, for benchmarking bampkgbuild offline.
+#
+# Every call is appended to $FAKE_PODMAN_LOG as a line of JSON. Latencies
+# come from $FAKE_PODMAN_LATENCY, a JSON object mapping an operation
+# ("create", "start", "exec", "cp", "kill", "rm", ...) or a command run by
+# exec ("exec:dpkg-buildpackage") to seconds. Just enough of what the
+# commands would do is faked for bampkgbuild to carry on: dpkg-buildpackage
+# writes a .changes and its .debs, apt-get download writes .debs, and so on.
+# Paths under /tmp are the host's /tmp, like the real containers; anything
+# else lives under $FAKE_PODMAN_STATE/<container>.
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import sys
+import tarfile
+import time
+import uuid
+
+STATE = os.environ.get("FAKE_PODMAN_STATE", "/tmp/fake-podman")
+LOG = os.environ.get("FAKE_PODMAN_LOG", os.path.join(STATE, "log"))
+LATENCY = json.loads(os.environ.get("FAKE_PODMAN_LATENCY", "{}"))
+
+REAL_DISTRIBUTION = {"unstable": "sid", "stable": "trixie", "oldstable": "bookworm"}
+
+SOURCES = 1000
+
+EXEC_OPTIONS_WITH_VALUE = {"--user", "-u", "--workdir", "-w", "--env", "-e"}
+
+
+def log(op, args):
+    line = json.dumps({"op": op, "args": args, "time": time.time()}) + "\n"
+    with open(LOG, "a") as f:
+        f.write(line)
+
+
+def sleep(key):
+    time.sleep(LATENCY.get(key, 0.0))
+
+
+def host_path(container, path):
+    if path == "/tmp" or path.startswith("/tmp/"):
+        return path
+    return os.path.join(STATE, container, path.lstrip("/"))
+
+
+def option_value(cmd, prefix):
+    for arg in cmd:
+        if arg.startswith(prefix):
+            return arg[len(prefix) :]
+    return None
+
+
+def ar_member(name, data):
+    header = "%-16s%-12d%-6d%-6d%-8o%-10d`\n" % (name, 0, 0, 0, 0o644, len(data))
+    return header.encode() + data + (b"\n" if len(data) % 2 else b"")
+
+
+def tar_gz(files):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def write_deb(path, package, version, arch, source):
+    control = (
+        "Package: %s\nSource: %s\nVersion: %s\nArchitecture: %s\n"
+        "Maintainer: Fake <fake@example.com>\nDescription: fake\n"
+        % (package, source, version, arch)
+    )
+    with open(path, "wb") as f:
+        f.write(b"!<arch>\n")
+        f.write(ar_member("debian-binary", b"2.0\n"))
+        f.write(ar_member("control.tar.gz", tar_gz({"./control": control.encode()})))
+        f.write(ar_member("data.tar.gz", tar_gz({"./usr/share/doc/fake": b"fake\n"})))
+
+
+def fake_build(container, cmd, cwd):
+    with open(os.path.join(host_path(container, cwd), ".fake-dsc")) as f:
+        dsc_path = f.read()
+    with open(host_path(container, dsc_path)) as f:
+        text = f.read()
+    source = re.search(r"^Source: (.*)$", text, re.M).group(1)
+    version = re.search(r"^Version: (.*)$", text, re.M).group(1)
+    file_version = re.sub(r"^\d+:", "", version)
+
+    build = option_value(cmd, "--build=").split(",")
+    distribution = option_value(cmd, "--changes-option=-DDistribution=")
+    real_distribution = REAL_DISTRIBUTION.get(distribution, distribution)
+    arch = "source" if build == ["source"] else "amd64"
+    parent = os.path.dirname(host_path(container, cwd).rstrip("/"))
+
+    binaries = re.search(r"^Binary: (.*)$", text, re.M)
+    binaries = [source] if binaries is None else binaries.group(1).split(", ")
+    debs = []
+    for part in build:
+        if part == "any":
+            debs.extend((binary, arch) for binary in binaries)
+        elif part == "all":
+            debs.append((source + "-doc", "all"))
+
+    names = []
+    for package, deb_arch in debs:
+        name = "%s_%s_%s.deb" % (package, file_version, deb_arch)
+        write_deb(os.path.join(parent, name), package, version, deb_arch, source)
+        names.append(name)
+
+    changes = os.path.join(parent, "%s_%s_%s.changes" % (source, file_version, arch))
+    with open(changes, "w") as f:
+        f.write("Format: 1.8\n")
+        f.write("Source: %s\n" % source)
+        f.write("Version: %s\n" % version)
+        f.write("Distribution: %s\n" % distribution)
+        f.write("Changes:\n")
+        f.write(" %s (%s) %s; urgency=low\n" % (source, version, real_distribution))
+        f.write(" .\n   * Fake build.\n")
+        f.write("Files:\n")
+        for name in names:
+            size = os.path.getsize(os.path.join(parent, name))
+            f.write(
+                " 00000000000000000000000000000000 %d misc optional %s\n" % (size, name)
+            )
+
+
+def fake_deb(package):
+    return "fake deb %s\n" % package
+
+
+def fake_package(package, source):
+    print("Package: %s" % package)
+    if source is not None and source != package:
+        print("Source: %s" % source)
+    print("Version: 1.0")
+    print("Architecture: amd64")
+    print("Filename: pool/main/%s_1.0_amd64.deb" % package)
+    print("SHA256: %s" % hashlib.sha256(fake_deb(package).encode()).hexdigest())
+    print()
+
+
+def fake_sources():
+    # package<n> is built by source<n>, which build depends on
+    # package<n+1>, and everything build depends on debhelper.
+    for i in range(SOURCES):
+        print("Package: source%d" % i)
+        print("Binary: package%d, package%d-doc" % (i, i))
+        print("Build-Depends: debhelper-compat (= 13), package%d [amd64]" % (i + 1))
+        print()
+
+
+def fake_command(container, cmd, cwd):
+    sleep("exec:" + cmd[0])
+    if cmd[:2] == ["dpkg-source", "-x"]:
+        build_dir = host_path(container, cmd[3])
+        os.makedirs(build_dir, exist_ok=True)
+        with open(os.path.join(build_dir, ".fake-dsc"), "w") as f:
+            f.write(cmd[2])
+    elif cmd[0] == "dpkg-buildpackage":
+        fake_build(container, cmd, cwd)
+    elif cmd[:2] == ["tar", "-x"]:
+        dst_dir = host_path(container, cmd[cmd.index("-C") + 1])
+        os.makedirs(dst_dir, exist_ok=True)
+        with tarfile.open(fileobj=sys.stdin.buffer, mode="r|") as tar:
+            tar.extractall(dst_dir)
+    elif cmd[:2] == ["tar", "-c"]:
+        src_dir = host_path(container, cmd[cmd.index("-C") + 1])
+        names = cmd[cmd.index("--") + 1 :]
+        with tarfile.open(fileobj=sys.stdout.buffer, mode="w|") as tar:
+            for name in names:
+                tar.add(os.path.join(src_dir, name), arcname=name)
+        sys.stdout.buffer.flush()
+    elif cmd[:2] == ["df", "-P"]:
+        print("Filesystem 1024-blocks Used Available Capacity Mounted on")
+        print("tmpfs 1048576 1024 1047552 1%% %s" % cmd[2])
+    elif cmd[:2] == ["sh", "-c"] and cmd[2].startswith("dcmd cp "):
+        src_dir, dst_dir = host_path(container, cmd[4]), host_path(container, cmd[5])
+        os.makedirs(dst_dir, exist_ok=True)
+        for name in os.listdir(src_dir):
+            if os.path.isfile(os.path.join(src_dir, name)):
+                shutil.copy(os.path.join(src_dir, name), dst_dir)
+    elif cmd[:2] == ["ccache", "--print-stats"]:
+        print("direct_cache_hit\t3\npreprocessed_cache_hit\t1\ncache_miss\t2")
+    elif cmd[0] == "grep-sources":
+        package = cmd[-1]
+        print("%s-rdep1\n%s-rdep2" % (package, package))
+    elif cmd[:2] == ["apt-get", "download"]:
+        for package in cmd[2:]:
+            package = package.split("=")[0]
+            path = os.path.join(host_path(container, cwd), "%s_1.0_amd64.deb" % package)
+            with open(path, "w") as f:
+                f.write(fake_deb(package))
+    elif cmd[:3] == ["apt-get", "build-dep", "--simulate"]:
+        print("Inst debhelper (13.11 Debian:unstable [all])")
+        print("Conf debhelper (13.11 Debian:unstable [all])")
+    elif cmd[:2] == ["dpkg", "--print-architecture"]:
+        print("amd64")
+    elif cmd[:2] == ["apt-cache", "dumpavail"]:
+        print("Package: debhelper\nVersion: 13.11\nArchitecture: all")
+        print("Provides: debhelper-compat (= 13)\n")
+        for i in range(SOURCES):
+            for package in ["package%d" % i, "package%d-data" % i]:
+                fake_package(package, "package%d" % i)
+    elif cmd[:3] == ["apt-cache", "show", "--no-all-versions"]:
+        for package in cmd[3:]:
+            fake_package(package, None)
+    elif cmd[:2] == ["apt-get", "source"]:
+        for package in cmd[2:]:
+            path = os.path.join(host_path(container, cwd), "%s_1.0.dsc" % package)
+            with open(path, "w") as f:
+                f.write("Source: %s\nVersion: 1.0\n" % package)
+    elif cmd[:2] == ["sh", "-c"] and "*Release" in cmd[2]:
+        print("Origin: Debian\nSuite: unstable")
+    elif cmd[:2] == ["sh", "-c"] and cmd[2].startswith("lz4cat "):
+        fake_sources()
+    elif cmd[:2] == ["sh", "-c"] and cmd[2].startswith("cat "):
+        print("deb http://deb.debian.org/debian sid main")
+
+
+def do_exec(args):
+    i = 0
+    cwd = "/build"
+    while args[i].startswith("-"):
+        if args[i] in EXEC_OPTIONS_WITH_VALUE:
+            if args[i] in ("--workdir", "-w"):
+                cwd = args[i + 1]
+            i += 2
+        else:
+            i += 1
+    container = args[i]
+    os.makedirs(host_path(container, cwd), exist_ok=True)
+    fake_command(container, args[i + 1 :], cwd)
+
+
+def do_cp(args):
+    src, dst = args[-2], args[-1]
+    if ":" in src:
+        container, path = src.split(":", 1)
+        src = host_path(container, path)
+    if ":" in dst:
+        container, path = dst.split(":", 1)
+        dst = host_path(container, path)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+    if src.endswith("/."):
+        shutil.copytree(src[:-2], dst, dirs_exist_ok=True)
+    elif os.path.isdir(src):
+        shutil.copytree(src, dst, dirs_exist_ok=True)
+    else:
+        shutil.copyfile(src, dst)
+
+
+def main():
+    os.makedirs(STATE, exist_ok=True)
+    args = sys.argv[1:]
+    op = args[0]
+    if op in ("image", "container") and len(args) > 1:
+        op = "%s %s" % (args[0], args[1])
+        args = args[1:]
+    log(op, sys.argv[1:])
+    sleep(op)
+
+    if op == "create":
+        print(uuid.uuid4().hex)
+    elif op == "exec":
+        do_exec(args[1:])
+    elif op == "cp":
+        do_cp(args[1:])
+    elif op == "run":
+        print("deb http://deb.debian.org/debian sid main")
+    elif op == "commit":
+        print("sha256:" + uuid.uuid4().hex)
+    elif op == "image inspect":
+        if "{{.Size}}" in args:
+            print(100 * 1024 * 1024)
+        else:
+            print("sha256:fake-" + re.sub(r"[^a-z0-9]", "-", args[-1]))
+    elif op == "rm":
+        shutil.rmtree(os.path.join(STATE, args[-1]), ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+#!/usr/bin/python3
+# A stand-in for the podman service, for benchmarking bampkgbuild's podman
+# API backend offline. It serves just the libpod endpoints bampkgbuild uses
+# over a unix socket, and fakes what they do with fake_podman.py, sharing
+# its state, log and latencies.
+#
+# usage: fake_podman_api.py SOCKET
+import http.server
+import io
+import json
+import os
+import re
+import shutil
+import socketserver
+import struct
+import sys
+import tarfile
+import threading
+import uuid
+from contextlib import redirect_stdout
+from urllib.parse import parse_qs, urlparse
+
+import fake_podman
+
+API_PREFIX = "/v4.0.0/libpod"
+
+# fake_command prints its output, so only one can run at a time.
+command_lock = threading.Lock()
+
+execs = {}
+
+
+def frame(stream, data):
+    return struct.pack(">BxxxL", stream, len(data)) + data
+
+
+class handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            body = b""
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return body
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def reply(self, status, data=None):
+        body = b"" if data is None else json.dumps(data).encode()
+        self.send_response(status)
+        if data is not None:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def route(self, method):
+        url = urlparse(self.path)
+        path = url.path[len(API_PREFIX) :]
+        body = self.read_body()
+        m = re.fullmatch(r"/containers/([^/]+)(/[a-z]+)?", path)
+        if path == "/_ping":
+            self.reply(200, "OK")
+        elif method == "POST" and path == "/containers/create":
+            self.create(json.loads(body))
+        elif m is not None and m.group(2) == "/exec":
+            self.exec_create(m.group(1), json.loads(body))
+        elif m is not None and m.group(2) == "/archive":
+            self.archive(m.group(1), parse_qs(url.query)["path"][0], body)
+        elif m is not None and m.group(2) in ("/start", "/kill"):
+            op = m.group(2)[1:]
+            fake_podman.log(op, [op, m.group(1)])
+            fake_podman.sleep(op)
+            self.reply(204)
+        elif m is not None and method == "DELETE":
+            fake_podman.log("rm", ["rm", m.group(1)])
+            fake_podman.sleep("rm")
+            shutil.rmtree(os.path.join(fake_podman.STATE, m.group(1)), True)
+            self.reply(200, [])
+        elif re.fullmatch(r"/exec/[^/]+/start", path):
+            self.exec_start(path.split("/")[2])
+        elif re.fullmatch(r"/exec/[^/]+/json", path):
+            exec_id = path.split("/")[2]
+            e = execs[exec_id]
+            if "ExitCode" in e:
+                del execs[exec_id]
+            self.reply(
+                200, {"ExitCode": e.get("ExitCode"), "Running": "ExitCode" not in e}
+            )
+        else:
+            self.reply(404, {"message": "no such endpoint %s" % path})
+
+    def do_GET(self):
+        self.route("GET")
+
+    def do_POST(self):
+        self.route("POST")
+
+    def do_PUT(self):
+        self.route("PUT")
+
+    def do_DELETE(self):
+        self.route("DELETE")
+
+    def create(self, spec):
+        fake_podman.log("create", ["create", spec["image"]])
+        fake_podman.sleep("create")
+        self.reply(201, {"Id": uuid.uuid4().hex})
+
+    def exec_create(self, container, config):
+        exec_id = uuid.uuid4().hex
+        execs[exec_id] = {"container": container, "config": config}
+        self.reply(201, {"Id": exec_id})
+
+    def exec_start(self, exec_id):
+        e = execs[exec_id]
+        container, cmd = e["container"], e["config"]["Cmd"]
+        cwd = e["config"].get("WorkingDir", "/build")
+        fake_podman.log("exec", ["exec", container] + cmd)
+
+        # Like podman, the response starts before the command runs.
+        self.send_response(200)
+        self.send_header("Content-Type", "application/vnd.docker.multiplexed-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = True
+
+        fake_podman.sleep("exec")
+        os.makedirs(fake_podman.host_path(container, cwd), exist_ok=True)
+
+        stdout = io.TextIOWrapper(io.BytesIO(), write_through=True)
+        with command_lock, redirect_stdout(stdout):
+            try:
+                fake_podman.fake_command(container, cmd, cwd)
+                e["ExitCode"] = 0
+            except Exception as ex:
+                print("%s" % ex, file=sys.stderr)
+                e["ExitCode"] = 1
+        output = stdout.buffer.getvalue()
+        if output:
+            try:
+                self.wfile.write(frame(1, output))
+            except BrokenPipeError:
+                pass
+
+    def archive(self, container, path, body):
+        fake_podman.log("cp", ["cp", "-", "%s:%s" % (container, path)])
+        fake_podman.sleep("cp")
+        dst_dir = fake_podman.host_path(container, path)
+        os.makedirs(dst_dir, exist_ok=True)
+        with tarfile.open(fileobj=io.BytesIO(body), mode="r:") as tar:
+            tar.extractall(dst_dir)
+        self.reply(200)
+
+
+class server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # BaseHTTPRequestHandler wants a client address it can format.
+        request, _ = super().get_request()
+        return request, ("local", 0)
+
+
+def main():
+    os.makedirs(fake_podman.STATE, exist_ok=True)
+    socket_path = sys.argv[1]
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    with server(socket_path, handler) as s:
+        s.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
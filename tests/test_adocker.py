@@ -0,0 +1,156 @@
+import asyncio
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import List, Tuple
+
+import pytest
+
+from bampkgbuild import docker
+from bampkgbuild.adocker import adocker
+from bampkgbuild.podman_api import podman_api
+
+# Runs what is exec'd on this host instead. The reset of a pooled container
+# is not run, it would empty the host's /build.
+FAKE_PODMAN = """#!%s
+import os, sys, uuid
+args = sys.argv[1:]
+with open(os.environ["FAKE_PODMAN_LOG"], "a") as f:
+    f.write(" ".join(args[:2]) + "\\n")
+if args[0] == "create":
+    print(uuid.uuid4().hex)
+elif args[0] == "exec":
+    i = 1
+    while args[i].startswith("-"):
+        i += 2 if args[i] in ("--user", "--workdir", "--env") else 1
+    cmd = args[i + 1 :]
+    if %r not in cmd:
+        os.execvp(cmd[0], cmd)
+"""
+
+
+@pytest.fixture
+def podman_log(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    podman = tmp_path / "podman"
+    podman.write_text(FAKE_PODMAN % (sys.executable, docker.RESET_CMD))
+    podman.chmod(0o755)
+    log = tmp_path / "log"
+    log.write_text("")
+    monkeypatch.setenv("PATH", "%s:%s" % (tmp_path, os.environ["PATH"]))
+    monkeypatch.setenv("FAKE_PODMAN_LOG", str(log))
+    return log
+
+
+def ops(log: Path) -> List[str]:
+    return [line.split()[0] for line in log.read_text().splitlines()]
+
+
+def test_long_lines(podman_log: Path) -> None:
+    lines: List[Tuple[str, str]] = []
+
+    async def run() -> bytes:
+        async with adocker("image") as container:
+            return await container.output(
+                [
+                    sys.executable,
+                    "-c",
+                    "import sys; print('x' * 200000); print('err', file=sys.stderr)",
+                ],
+                sink=lambda stream, line: lines.append((stream, line)),
+            )
+
+    output = asyncio.run(run())
+    assert output == b"x" * 200000 + b"\n"
+    assert sorted(lines) == [("stderr", "err"), ("stdout", "x" * 200000)]
+    assert ops(podman_log) == ["create", "start", "exec", "kill", "rm"]
+
+
+def test_failure(podman_log: Path) -> None:
+    async def run() -> None:
+        async with adocker("image") as container:
+            await container.run(["sh", "-c", "echo out; exit 3"])
+
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        asyncio.run(run())
+    assert e.value.returncode == 3
+    assert e.value.output == b"out\n"
+
+
+def test_timeout(podman_log: Path) -> None:
+    async def run() -> None:
+        async with adocker("image") as container:
+            await container.run(["sleep", "30"], timeout=0.5)
+
+    start = time.monotonic()
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(run())
+    assert time.monotonic() - start < 10
+    assert ops(podman_log)[-2:] == ["kill", "rm"]
+
+
+def test_cancel(podman_log: Path) -> None:
+    async def run() -> None:
+        async with adocker("image") as container:
+            await container.run(["sleep", "30"])
+
+    async def cancel() -> None:
+        task = asyncio.ensure_future(run())
+        await asyncio.sleep(0.5)
+        task.cancel()
+        await task
+
+    start = time.monotonic()
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(cancel())
+    assert time.monotonic() - start < 10
+    assert ops(podman_log)[-2:] == ["kill", "rm"]
+
+
+def test_pool(podman_log: Path) -> None:
+    # A container is kept for reuse, unless a command in it timed out.
+    async def run(timeout: float) -> None:
+        async with adocker("image", reuse=True) as container:
+            await container.run(["sleep", "1"], timeout=timeout)
+
+    with docker.container_pool() as pool:
+        asyncio.run(run(10))
+        assert sum(len(idle) for idle in pool.idle.values()) == 1
+        with pytest.raises(asyncio.TimeoutError):
+            asyncio.run(run(0.1))
+        assert sum(len(idle) for idle in pool.idle.values()) == 0
+
+
+def test_api_timeout(tmp_path: Path) -> None:
+    # Through the podman API, with bench's fake service taking 30s to run
+    # anything.
+    socket_path = str(tmp_path / "podman.sock")
+    bench = os.path.join(os.path.dirname(__file__), "..", "bench")
+    env = dict(
+        os.environ,
+        FAKE_PODMAN_STATE=str(tmp_path / "state"),
+        FAKE_PODMAN_LATENCY='{"exec": 30}',
+    )
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(bench, "fake_podman_api.py"), socket_path],
+        env=env,
+    )
+    try:
+        while not os.path.exists(socket_path):
+            time.sleep(0.05)
+
+        async def run() -> None:
+            async with adocker("image") as container:
+                await container.run(["true"], timeout=0.5)
+
+        start = time.monotonic()
+        with podman_api(socket_path):
+            with pytest.raises(asyncio.TimeoutError):
+                asyncio.run(run())
+        assert time.monotonic() - start < 10
+        log = (tmp_path / "state" / "log").read_text()
+        assert '"op": "rm"' in log
+    finally:
+        server.kill()
+        server.wait()
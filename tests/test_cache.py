@@ -0,0 +1,37 @@
+import os
+import shutil
+from pathlib import Path
+
+import pytest
+
+from bampkgbuild.result_cache import result_cache
+
+
+@pytest.fixture
+def results(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> result_cache:
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    for i in range(3):
+        (tmp_path / ("p%d.deb" % i)).write_bytes(b"x" * 600000)
+        (tmp_path / ("p%d.changes" % i)).write_text(
+            "Format: 1.8\nFiles:\n 0 600000 misc optional p%d.deb\n" % i
+        )
+    # About 1 MiB, room for one of them.
+    return result_cache(0.001)
+
+
+def test_evicts_least_recently_used(results: result_cache, tmp_path: Path) -> None:
+    results.store("k0", str(tmp_path / "p0.changes"))
+    results.store("k1", str(tmp_path / "p1.changes"))
+    assert results.lookup("k0", str(tmp_path / "out")) is None
+    assert results.lookup("k1", str(tmp_path / "out")) == str(
+        tmp_path / "out" / "p1.changes"
+    )
+    assert (tmp_path / "out" / "p1.deb").read_bytes() == b"x" * 600000
+    assert not os.path.exists(os.path.join(results.dir, "k0"))
+
+
+def test_missing_directory_is_a_miss(results: result_cache, tmp_path: Path) -> None:
+    results.store("k0", str(tmp_path / "p0.changes"))
+    shutil.rmtree(os.path.join(results.dir, "k0"))
+    assert results.lookup("k0", str(tmp_path / "out")) is None
+    assert "k0" not in open(results.index_path).read()
@@ -0,0 +1,74 @@
+import io
+import json
+import os
+import tarfile
+from pathlib import Path
+from typing import Dict
+
+import pytest
+
+from bampkgbuild import scan
+
+
+def tar_xz(files: Dict[str, bytes]) -> bytes:
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:xz") as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def ar(members: Dict[str, bytes]) -> bytes:
+    out = [scan.AR_MAGIC]
+    for name, data in members.items():
+        header = "%-16s%-12s%-6s%-6s%-8s%-10d`\n" % (name, 0, 0, 0, 100644, len(data))
+        out.append(header.encode())
+        out.append(data)
+        if len(data) % 2 == 1:
+            out.append(b"\n")
+    return b"".join(out)
+
+
+def make_deb(path: str, package: str, content: bytes) -> None:
+    control = b"Package: %s\nVersion: 1.0\n" % package.encode()
+    with open(path, "wb") as f:
+        f.write(
+            ar(
+                {
+                    "debian-binary": b"2.0\n",
+                    "control.tar.xz": tar_xz({"./control": control}),
+                    "data.tar.xz": tar_xz({"./usr/share/doc/README": content}),
+                }
+            )
+        )
+
+
+def test_scan_deb(tmp_path: Path) -> None:
+    path = os.path.join(tmp_path, "good.deb")
+    make_deb(path, "good", b"uses github.com/gorilla/websocket here")
+    s = scan.searcher(["gorilla/websocket", "absent"], [r"w.bsocket"])
+    result = scan.scan_deb(path, s)
+    assert result["package"] == "good"
+    assert result["matches"] == {
+        "gorilla/websocket": "./usr/share/doc/README",
+        r"w.bsocket": "./usr/share/doc/README",
+    }
+
+
+def test_truncated_deb(tmp_path: Path, capfd: pytest.CaptureFixture) -> None:
+    good = os.path.join(tmp_path, "good.deb")
+    make_deb(good, "good", b"websocket")
+    bad = os.path.join(tmp_path, "bad.deb")
+    make_deb(bad, "bad", b"websocket" * 10000)
+    with open(bad, "r+b") as f:
+        f.truncate(os.path.getsize(bad) - 200)
+
+    with pytest.raises(SystemExit) as e:
+        scan.main(["--literal", "websocket", "--jobs", "1", bad, good])
+    assert e.value.code == "1 of 2 debs could not be scanned"
+
+    out, err = capfd.readouterr()
+    assert [json.loads(line)["package"] for line in out.splitlines()] == ["good"]
+    assert err.startswith("%s: " % bad)